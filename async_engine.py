@@ -0,0 +1,105 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import logger_mgr
+
+logger = logger_mgr.initialize_logger(__name__)
+
+# Handlers of the same provider running at the same time, if not set in provider_concurrency
+default_provider_concurrency = 2
+
+
+async def run_domain_handlers(
+    process_handler,
+    domain_handlers: list,
+    handler_args: tuple,
+    provider_concurrency: dict = None,
+    cycle_deadline: float = None,
+    abandoned: threading.Event = None,
+):
+    """
+    Run process_handler(domain_handler, *handler_args) for every handler as its own task.
+
+    A slow provider only delays its own handlers. provider_concurrency limits how many
+    handlers of each provider run at the same time, handlers still running when
+    cycle_deadline seconds are reached are abandoned and retried on the next loop.
+    Their threads can't be stopped, abandoned is set so they send no more updates.
+
+    Returns:
+    dict: domain_handler -> result of process_handler, only for the handlers that finished.
+    """
+
+    if not domain_handlers:
+        return {}
+
+    provider_concurrency = provider_concurrency or {}
+    provider_limits = {
+        domain_handler.provider: provider_concurrency.get(
+            domain_handler.provider, default_provider_concurrency
+        )
+        for domain_handler in domain_handlers
+    }
+    semaphores = {
+        provider: asyncio.Semaphore(limit) for provider, limit in provider_limits.items()
+    }
+
+    async def run_handler(domain_handler):
+        async with semaphores[domain_handler.provider]:
+            # Keep the log correlation IDs of the cycle in the pool thread
+            return await asyncio.get_running_loop().run_in_executor(
+                executor,
+                contextvars.copy_context().run,
+                process_handler,
+                domain_handler,
+                *handler_args,
+            )
+
+    # The handlers do blocking I/O, every one allowed to run needs its own thread
+    max_workers = min(len(domain_handlers), sum(provider_limits.values()))
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    tasks = {
+        asyncio.create_task(run_handler(domain_handler)): domain_handler
+        for domain_handler in domain_handlers
+    }
+
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=cycle_deadline)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if pending and abandoned:
+        abandoned.set()
+    for task in pending:
+        task.cancel()
+        logger.warning(
+            f"Cycle deadline reached before {tasks[task].provider} - {tasks[task].domains} finished, "
+            "trying on next loop..."
+        )
+
+    handler_results = {}
+    for task in done:
+        if task.exception():
+            logger.error(
+                f"Error while updating {tasks[task].provider} - {tasks[task].domains}: {task.exception()}"
+            )
+            continue
+        handler_results[tasks[task]] = task.result()
+
+    return handler_results
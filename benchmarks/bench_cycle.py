@@ -0,0 +1,247 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Benchmark run_ip_check_cycle against local stand-ins, nothing leaves the host.
+
+Every size runs in its own process, so the peak RSS belongs to that size only.
+Results are printed as one JSON object per line:
+
+    python benchmarks/bench_cycle.py --domains 10 1000 10000 > bench_output.txt
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarks_dir))
+
+current_ipv4 = "203.0.113.10"
+current_ipv6 = "2001:db8::10"
+stale_ipv4 = "203.0.113.99"
+stale_ipv6 = "2001:db8::99"
+
+
+def generate_config(domains: int, http_url: str, stale_ratio: float, general: dict):
+    """Return the config of a fleet with domains names spread over every provider."""
+
+    names = [f"host{index}.bench.example" for index in range(domains)]
+    random.seed(domains)
+    stale_names = set(random.sample(names, int(len(names) * stale_ratio)))
+
+    # 40% DuckDNS (5 names per token), 20% FreeDNS, 20% No-IP (5 names per account),
+    # 20% CloudFlare (20 names per zone)
+    duckdns_end = int(domains * 0.4)
+    freedns_end = duckdns_end + int(domains * 0.2)
+    noip_end = freedns_end + int(domains * 0.2)
+
+    def chunks(chunk_names, size):
+        return [chunk_names[index : index + size] for index in range(0, len(chunk_names), size)]
+
+    domain_info = [
+        {
+            "provider": "DUCKDNS",
+            "domain_list": [
+                {"domain_data": {"token": f"token{index}", "names": chunk}}
+                for index, chunk in enumerate(chunks(names[:duckdns_end], 5))
+            ],
+        },
+        {
+            "provider": "FREEDNS",
+            "domain_list": [
+                {"domain_data": {"token": f"token{index}", "names": [name]}}
+                for index, name in enumerate(names[duckdns_end:freedns_end])
+            ],
+        },
+        {
+            "provider": "NOIP",
+            "domain_list": [
+                {"domain_data": {"username": f"user{index}", "password": "password", "names": chunk}}
+                for index, chunk in enumerate(chunks(names[freedns_end:noip_end], 5))
+            ],
+        },
+        {
+            "provider": "CLOUDFLARE",
+            "domain_list": [
+                {"domain_data": {"token": "token", "zone_id": f"zone{index}", "names": chunk}}
+                for index, chunk in enumerate(chunks(names[noip_end:], 20))
+            ],
+        },
+    ]
+
+    config = {
+        "GENERAL": {
+            "update_delay": 300,
+            "hide_update_queries_on_logs": True,
+            "continue_on_provider_fail": True,
+            "log_level": "WARNING",
+            "dns_servers": ["127.0.0.1"],
+            "ipv4_servers": [f"{http_url}/ipv4"],
+            "ipv6_servers": [f"{http_url}/ipv6"],
+            **general,
+        },
+        # The stand-ins have no rate limit
+        "RATE_LIMITS": {
+            provider: {"updates_per_hour": 10**9, "burst": 10**9}
+            for provider in ("DUCKDNS", "FREEDNS", "NOIP", "CLOUDFLARE")
+        },
+        "DOMAIN_INFO": [entry for entry in domain_info if entry["domain_list"]],
+    }
+
+    return config, stale_names
+
+
+def run_size(domains: int, cycles: int, stale_ratio: float, latency: float, failure_rate: float, general: dict):
+    import yaml
+
+    from fake_servers import FakeDNSServer, FakeHTTPHandler, FakeHTTPServer, RequestCounter
+
+    counter = RequestCounter()
+    http_server = FakeHTTPServer(
+        FakeHTTPHandler, counter, current_ipv4, current_ipv6, latency, failure_rate
+    ).start()
+
+    work_dir = tempfile.mkdtemp(prefix="syncddns_bench_")
+    config, stale_names = generate_config(
+        domains, http_server.url, stale_ratio, general
+    )
+    dns_server = FakeDNSServer(
+        counter, current_ipv4, current_ipv6, stale_ipv4, stale_ipv6, stale_names
+    ).start()
+    config["GENERAL"]["dns_port"] = dns_server.port
+
+    # CloudFlare zones start with the stale records
+    for entry in config["DOMAIN_INFO"]:
+        if entry["provider"] != "CLOUDFLARE":
+            continue
+        for domain_list in entry["domain_list"]:
+            zone_id = domain_list["domain_data"]["zone_id"]
+            records = http_server.cloudflare_records.setdefault(zone_id, {})
+            for name in domain_list["domain_data"]["names"]:
+                for record_type, current_ip, stale_ip in (
+                    ("A", current_ipv4, stale_ipv4),
+                    ("AAAA", current_ipv6, stale_ipv6),
+                ):
+                    record_id = f"{zone_id}-{len(records)}"
+                    records[record_id] = {
+                        "id": record_id,
+                        "type": record_type,
+                        "name": name,
+                        "content": stale_ip if name in stale_names else current_ip,
+                    }
+
+    config_path = os.path.join(work_dir, "config.yaml")
+    with open(config_path, "w") as file:
+        yaml.safe_dump(config, file)
+
+    import domain_mgr
+    import sync_ddns
+
+    domain_mgr.duckdns_update_url = f"{http_server.url}/duckdns/update"
+    domain_mgr.freedns_update_url = f"{http_server.url}/freedns/update.php"
+    domain_mgr.noip_update_url = http_server.url.replace(
+        "http://", "http://{username}:{password}@"
+    ) + "/noip/update"
+    domain_mgr.cloudflare_api_url = f"{http_server.url}/cloudflare"
+    sync_ddns.config_path = config_path
+    sync_ddns.config_snapshot_path = os.path.join(work_dir, "config.snapshot")
+    sync_ddns.state_path = os.path.join(work_dir, "state.json")
+    sync_ddns.getter_health_path = os.path.join(work_dir, "getter_health.json")
+
+    load_start = time.perf_counter()
+    sync_ddns.load_config()
+    load_time = time.perf_counter() - load_start
+
+    results = []
+    for cycle in range(cycles):
+        counter.reset()
+        cycle_start = time.perf_counter()
+        sync_ddns.run_ip_check_cycle()
+        results.append(
+            {
+                "domains": domains,
+                "cycle": cycle,
+                "load_config_seconds": round(load_time, 4),
+                "cycle_seconds": round(time.perf_counter() - cycle_start, 4),
+                "requests": dict(sorted(counter.counts.items())),
+                "requests_total": sum(counter.counts.values()),
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "settings": general,
+            }
+        )
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--domains", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--cycles", type=int, default=2, help="cycles per size, the first one is cold")
+    parser.add_argument("--stale-ratio", type=float, default=0.1, help="ratio of names needing an update")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every HTTP answer")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="ratio of HTTP answers failing with 503")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="GENERAL setting to benchmark, VALUE is parsed as YAML, e.g. --set engine=async",
+    )
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    import yaml
+
+    general = {}
+    for setting in args.set:
+        key, _, value = setting.partition("=")
+        general[key] = yaml.safe_load(value)
+
+    if args.worker:
+        sys.path.insert(0, benchmarks_dir)
+        for result in run_size(
+            args.domains[0], args.cycles, args.stale_ratio, args.latency, args.failure_rate, general
+        ):
+            print(json.dumps(result), flush=True)
+        return
+
+    for domains in args.domains:
+        worker_args = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--worker",
+            "--domains", str(domains),
+            "--cycles", str(args.cycles),
+            "--stale-ratio", str(args.stale_ratio),
+            "--latency", str(args.latency),
+            "--failure-rate", str(args.failure_rate),
+        ]
+        for setting in args.set:
+            worker_args += ["--set", setting]
+
+        completed = subprocess.run(worker_args, stdout=subprocess.PIPE, text=True)
+        sys.stdout.write(completed.stdout)
+        if completed.returncode != 0:
+            sys.exit(completed.returncode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Measure the memory kept by the config and the domain handlers of big fleets.
+
+Every load runs in its own process, the RSS is read right before and after
+load_config, the difference is what stays in memory while the daemon runs. Every
+size is loaded three times: as the baseline, with yaml.safe_load and the former
+handlers, then by load_config from the YAML and from the config snapshot. Results
+are printed as one JSON object per line:
+
+    python benchmarks/bench_memory.py --domains 10000 100000 > memory_output.txt
+"""
+
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarks_dir))
+sys.path.insert(0, benchmarks_dir)
+
+
+def get_rss_kb() -> int:
+    try:
+        with open("/proc/self/statm") as file:
+            resident_pages = int(file.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        # Not Linux, the peak is the best available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_peak_rss_kb() -> int:
+    # ru_maxrss survives exec on Linux, it would include the parent's peak
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class BaselineDomainMgr:
+    """
+    A handler as kept before the slotted DomainMgr: an instance __dict__, strings
+    not interned, and the provider's functions bound on every handler.
+    """
+
+    def __init__(self, provider, domain_data):
+        self.provider = provider
+        self.token = domain_data.get("token", None)
+        self.zone_id = domain_data.get("zone_id", None)
+        self.dns_record_id = domain_data.get("dns_record_id", None)
+        self.username = domain_data.get("username", None)
+        self.password = domain_data.get("password", None)
+        self.update_ipv4 = False if domain_data.get("ip_version", "both") == "ipv6" else True
+        self.update_ipv6 = False if domain_data.get("ip_version", "both") == "ipv4" else True
+        self.domains = domain_data.get("names", [])
+        self.handle_response = self.handle_provider_response
+        self.get_update_query = self.get_provider_update_query
+
+    def handle_provider_response(self, response):
+        return "OK"
+
+    def get_provider_update_query(self, new_ipv4: str = None, new_ipv6: str = None):
+        return {}
+
+
+def load_baseline(config_path: str) -> list:
+    """Load the handlers as the daemon did before the config snapshot and the slotted handlers."""
+
+    import yaml
+
+    with open(config_path, "r") as file:
+        config = yaml.safe_load(file)
+
+    return [
+        BaselineDomainMgr(domains_info["provider"], domain_list["domain_data"])
+        for domains_info in config["DOMAIN_INFO"]
+        for domain_list in domains_info["domain_list"]
+    ]
+
+
+def load_size(work_dir: str, domains: int, mode: str) -> dict:
+    import sync_ddns
+
+    sync_ddns.config_path = os.path.join(work_dir, "config.yaml")
+    sync_ddns.config_snapshot_path = os.path.join(work_dir, "config.snapshot")
+    sync_ddns.state_path = os.path.join(work_dir, "state.json")
+    sync_ddns.getter_health_path = os.path.join(work_dir, "getter_health.json")
+    if mode == "baseline":
+        # Imported beforehand, like load_config does, so only the loaded data is counted
+        import yaml  # noqa: F401
+
+    gc.collect()
+    rss_before = get_rss_kb()
+    load_start = time.perf_counter()
+    if mode == "baseline":
+        domain_handlers = load_baseline(sync_ddns.config_path)
+    else:
+        sync_ddns.load_config(daemon=False)
+        domain_handlers = sync_ddns.config_settings["domain_handlers"]
+    load_time = time.perf_counter() - load_start
+    gc.collect()
+    rss_after = get_rss_kb()
+
+    handlers = len(domain_handlers)
+    return {
+        "domains": domains,
+        "handlers": handlers,
+        "mode": mode,
+        "load_config_seconds": round(load_time, 4),
+        "rss_before_kb": rss_before,
+        "rss_after_kb": rss_after,
+        "retained_kb": rss_after - rss_before,
+        "bytes_per_handler": round((rss_after - rss_before) * 1024 / max(1, handlers)),
+        "peak_rss_kb": get_peak_rss_kb(),
+    }
+
+
+def write_config(work_dir: str, domains: int):
+    import yaml
+
+    from bench_cycle import generate_config
+
+    config, _ = generate_config(domains, "http://127.0.0.1:9", 0, {})
+    with open(os.path.join(work_dir, "config.yaml"), "w") as file:
+        yaml.safe_dump(config, file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--domains", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--child", nargs=3, metavar=("WORK_DIR", "DOMAINS", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        work_dir, domains, mode = args.child
+        print(json.dumps(load_size(work_dir, int(domains), mode)))
+        return
+
+    for domains in args.domains:
+        work_dir = tempfile.mkdtemp(prefix="syncddns_memory_")
+        write_config(work_dir, domains)
+        # The YAML load writes the snapshot, the next one reads it
+        for mode in ("baseline", "yaml", "snapshot"):
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", work_dir, str(domains), mode],
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Local stand-ins for the IP getters, the DNS and the DDNS providers."""
+
+import ipaddress
+import json
+import random
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class RequestCounter:
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind: str):
+        with self._lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, counter, ipv4, ipv6, latency=0, failure_rate=0):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.counter = counter
+        self.ipv4 = ipv4
+        self.ipv6 = ipv6
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.cloudflare_records = {}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class FakeHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body: str, content_type: str = "text/plain"):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def handle_request(self, method: str):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if server.failure_rate and random.random() < server.failure_rate:
+            self.reply(503, "")
+            return
+
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        body = self.read_body() if method != "GET" else None
+
+        if url.path.startswith("/ipv4"):
+            server.counter.add("getter")
+            self.reply(200, server.ipv4 + "\n")
+        elif url.path.startswith("/ipv6"):
+            server.counter.add("getter")
+            self.reply(200, server.ipv6 + "\n")
+        elif url.path == "/duckdns/update":
+            server.counter.add("DUCKDNS")
+            self.reply(200, "OK" if query.get("token") else "KO")
+        elif url.path == "/freedns/update.php":
+            server.counter.add("FREEDNS")
+            self.reply(200, f"Updated 1 host(s) to {query.get('address', [''])[0]}")
+        elif url.path == "/noip/update":
+            server.counter.add("NOIP")
+            # One line per hostname, as No-IP does
+            hostnames = query.get("hostname", [""])[0].split(",")
+            self.reply(200, "\n".join(f"good {query.get('myip', [''])[0]}" for _ in hostnames))
+        elif url.path.startswith("/cloudflare/"):
+            server.counter.add("CLOUDFLARE")
+            self.reply(200, json.dumps(self.handle_cloudflare(method, url, query, body)), "application/json")
+        else:
+            self.reply(404, "")
+
+    def handle_cloudflare(self, method, url, query, body):
+        zone_id = url.path.split("/")[3]
+        records = self.server.cloudflare_records.setdefault(zone_id, {})
+
+        if method == "GET":
+            per_page = int(query.get("per_page", ["100"])[0])
+            page = int(query.get("page", ["1"])[0])
+            all_records = list(records.values())
+            total_pages = max(1, -(-len(all_records) // per_page))
+            return {
+                "success": True,
+                "result": all_records[(page - 1) * per_page : page * per_page],
+                "result_info": {"page": page, "total_pages": total_pages},
+            }
+
+        for patch in body.get("patches", []):
+            records[patch["id"]]["content"] = patch["content"]
+        for post in body.get("posts", []):
+            record_id = f"{zone_id}-{len(records)}"
+            records[record_id] = {"id": record_id, **post}
+
+        return {"success": True}
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+
+class FakeDNSServer(socketserver.ThreadingUDPServer):
+    """
+    Answer A and AAAA questions for any name, as the authoritative server of zone.
+
+    The names in stale_names get stale_ipv4/stale_ipv6, so they need an update.
+    The zone's NS is ns1.<zone>, which is this server (127.0.0.1).
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, counter, ipv4, ipv6, stale_ipv4, stale_ipv6, stale_names=(), ttl=300, zone="bench.example"
+    ):
+        super().__init__(("127.0.0.1", 0), FakeDNSHandler)
+        self.counter = counter
+        self.answers = {
+            1: (ipaddress.IPv4Address(ipv4).packed, ipaddress.IPv4Address(stale_ipv4).packed),
+            28: (ipaddress.IPv6Address(ipv6).packed, ipaddress.IPv6Address(stale_ipv6).packed),
+        }
+        self.stale_names = set(stale_names)
+        self.ttl = ttl
+        self.zone = zone
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class FakeDNSHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+        server = self.server
+        server.counter.add("dns")
+
+        transaction_id, flags = struct.unpack_from("!HH", data)
+        offset = 12
+        labels = []
+        while data[offset]:
+            length = data[offset]
+            labels.append(data[offset + 1 : offset + 1 + length].decode())
+            offset += 1 + length
+        question_end = offset + 5
+        question_type = struct.unpack_from("!H", data, offset + 1)[0]
+        name = ".".join(labels).lower()
+
+        answers = []
+        if question_type == 2:
+            if name == server.zone:
+                rdata = b"".join(
+                    bytes([len(label)]) + label.encode() for label in f"ns1.{server.zone}".split(".")
+                ) + b"\0"
+                answers.append(struct.pack("!HHHIH", 0xC00C, 2, 1, server.ttl, len(rdata)) + rdata)
+        elif name == f"ns1.{server.zone}" and question_type == 1:
+            rdata = ipaddress.IPv4Address("127.0.0.1").packed
+            answers.append(struct.pack("!HHHIH", 0xC00C, 1, 1, server.ttl, len(rdata)) + rdata)
+        elif question_type in server.answers:
+            current, stale = server.answers[question_type]
+            rdata = stale if name in server.stale_names else current
+            answers.append(
+                struct.pack("!HHHIH", 0xC00C, question_type, 1, server.ttl, len(rdata)) + rdata
+            )
+
+        # Authoritative answer (AA), keeping the RD flag of the question
+        header = struct.pack(
+            "!HHHHHH", transaction_id, 0x8580 | (flags & 0x0100), 1, len(answers), 0, 0
+        )
+        sock.sendto(header + data[12:question_end] + b"".join(answers), self.client_address)
@@ -0,0 +1,534 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Replay a timeline of public IP changes and provider outages against the update loop.
+
+The real scheduler, handlers and run_ip_check_cycle run on a virtual clock, the IP
+getters, the DNS and the providers (DuckDNS and No-IP) are simulated, so thousands
+of days take seconds. Every policy, a set of GENERAL settings, replays the same
+timeline in its own process and prints one JSON object per line:
+
+    python benchmarks/simulate_trace.py --days 1000 --policy fast:update_delay=60 \\
+        --policy no_retries:retry_attempts=0 > simulation_output.txt
+
+The timeline is generated from the --ip-changes-per-day and --outages-per-day rates,
+or read from --trace, one JSON object per line:
+
+    {"time": 0, "ipv4": "198.51.100.1"}
+    {"time": 86400, "ipv4": "198.51.100.2", "ipv6": "2001:db8::2"}
+    {"time": 90000, "outage": "DUCKDNS", "seconds": 1800}
+
+time is in seconds from the start. The DNS answers the IP accepted by a provider
+--dns-delay seconds after the update, with --dns-ttl as TTL.
+
+Once the DNS answers the public IP and nothing is pending, the cycles until the next
+IP change are skipped, their IP and DNS lookups aren't counted. --no-fast-forward runs
+them all.
+"""
+
+import argparse
+import bisect
+import heapq
+import ipaddress
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs, urlsplit
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+package_dir = os.path.dirname(benchmarks_dir)
+sys.path.insert(0, package_dir)
+
+# Both the virtual time() and monotonic() start here
+start_epoch = 1_700_000_000
+start_monotonic = 1000
+
+
+class VirtualClock:
+    """Stand-in of the time module, only moves when advanced."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self) -> float:
+        return start_epoch + self.now
+
+    def monotonic(self) -> float:
+        return start_monotonic + self.now
+
+    perf_counter = monotonic
+
+    def sleep(self, seconds: float):
+        self.now += max(0, seconds)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def generate_trace(
+    days: float, ip_changes_per_day: float, outages_per_day: float, outage_seconds: float, ipv6: bool, seed: int
+) -> list:
+    rng = random.Random(seed)
+    duration = days * 86400
+    events = []
+
+    def next_ipv4(index):
+        return str(ipaddress.IPv4Address("198.51.100.0") + index % 250 + 1)
+
+    def next_ipv6(index):
+        return str(ipaddress.IPv6Address("2001:db8::") + index + 1)
+
+    index = 0
+    event_time = 0.0
+    while event_time < duration:
+        event = {"time": round(event_time, 3), "ipv4": next_ipv4(index)}
+        if ipv6:
+            event["ipv6"] = next_ipv6(index)
+        events.append(event)
+        index += 1
+        if ip_changes_per_day <= 0:
+            break
+        event_time += rng.expovariate(ip_changes_per_day / 86400)
+
+    if outages_per_day > 0:
+        for provider in ("DUCKDNS", "NOIP"):
+            event_time = rng.expovariate(outages_per_day / 86400)
+            while event_time < duration:
+                events.append(
+                    {
+                        "time": round(event_time, 3),
+                        "outage": provider,
+                        "seconds": round(rng.expovariate(1 / outage_seconds), 3),
+                    }
+                )
+                event_time += rng.expovariate(outages_per_day / 86400)
+
+    return sorted(events, key=lambda event: event["time"])
+
+
+def generate_config(domains: int, general: dict) -> dict:
+    """Half of the names on DuckDNS, half on No-IP, 5 names per token or account."""
+
+    names = [f"host{index}.sim.example" for index in range(domains)]
+    duckdns_end = (domains + 1) // 2
+
+    def chunks(chunk_names, size):
+        return [chunk_names[index : index + size] for index in range(0, len(chunk_names), size)]
+
+    domain_info = [
+        {
+            "provider": "DUCKDNS",
+            "domain_list": [
+                {"domain_data": {"token": f"token{index}", "names": chunk}}
+                for index, chunk in enumerate(chunks(names[:duckdns_end], 5))
+            ],
+        },
+        {
+            "provider": "NOIP",
+            "domain_list": [
+                {"domain_data": {"username": f"user{index}", "password": "password", "names": chunk}}
+                for index, chunk in enumerate(chunks(names[duckdns_end:], 5))
+            ],
+        },
+    ]
+
+    return {
+        "GENERAL": {
+            "update_delay": 300,
+            "hide_update_queries_on_logs": True,
+            "continue_on_provider_fail": True,
+            "log_level": "ERROR",
+            "async_logging": False,
+            "watch_config": False,
+            "dns_servers": ["192.0.2.53"],
+            "ipv4_servers": ["http://ipv4.sim.example/"],
+            "ipv6_servers": ["http://ipv6.sim.example/"],
+            **general,
+        },
+        "DOMAIN_INFO": [entry for entry in domain_info if entry["domain_list"]],
+    }
+
+
+class SimulatedWorld:
+    """The public IPs, the providers and the DNS, as seen at clock.now."""
+
+    def __init__(self, clock, events: list, domains: list, dns_delay: float, dns_ttl: int, failure_rate: float, seed: int):
+        self.clock = clock
+        self.dns_delay = dns_delay
+        self.dns_ttl = dns_ttl
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+
+        # Public IPs, as (time, ipv4, ipv6) from every change
+        self.ip_changes = []
+        ipv4 = ipv6 = None
+        for event in events:
+            if "ipv4" in event or "ipv6" in event:
+                ipv4 = event.get("ipv4", ipv4)
+                ipv6 = event.get("ipv6", ipv6)
+                self.ip_changes.append((event["time"], ipv4, ipv6))
+        self.ip_change_times = [change[0] for change in self.ip_changes]
+        self.outages = {}
+        for event in events:
+            if "outage" in event:
+                self.outages.setdefault(event["outage"], []).append(
+                    (event["time"], event["time"] + event["seconds"])
+                )
+
+        first_ipv4, first_ipv6 = self.ip_changes[0][1:] if self.ip_changes else (None, None)
+        # (domain, record type) -> times the DNS starts answering every IP, and the IPs,
+        # in sync with the first public IPs at the start
+        self.dns_times = {}
+        self.dns_ips = {}
+        # (domain, record type) -> IP the provider holds
+        self.provider_records = {}
+        for domain in domains:
+            for record_type, ip in (("A", first_ipv4), ("AAAA", first_ipv6)):
+                if ip:
+                    self.dns_times[(domain, record_type)] = [0.0]
+                    self.dns_ips[(domain, record_type)] = [ip]
+                    self.provider_records[(domain, record_type)] = ip
+
+        self.counts = {"ip_lookups": 0, "dns_queries": 0, "failed_updates": 0, "redundant_updates": 0}
+        self.update_requests = {}
+
+    def get_public_ips(self) -> tuple:
+        index = bisect.bisect_right(self.ip_change_times, self.clock.now) - 1
+        ipv4, ipv6 = self.ip_changes[index][1:] if index >= 0 else (None, None)
+        self.counts["ip_lookups"] += 2
+        return ipv4, ipv6
+
+    def get_next_ip_change(self):
+        index = bisect.bisect_right(self.ip_change_times, self.clock.now)
+        return self.ip_change_times[index] if index < len(self.ip_change_times) else None
+
+    def get_dns_ip(self, domain: str, record_type: str, at: float = None):
+        key = (domain, record_type)
+        if key not in self.dns_times:
+            return None
+        index = bisect.bisect_right(self.dns_times[key], self.clock.now if at is None else at) - 1
+        return self.dns_ips[key][index] if index >= 0 else None
+
+    def get_public_ip(self, record_type: str, at: float):
+        index = bisect.bisect_right(self.ip_change_times, at) - 1
+        if index < 0:
+            return None
+        return self.ip_changes[index][1 if record_type == "A" else 2]
+
+    def is_converged(self) -> bool:
+        """True when every record answers the public IP and no update is still on its way to the DNS."""
+
+        for key, dns_times in self.dns_times.items():
+            if dns_times[-1] > self.clock.now or self.dns_ips[key][-1] != self.get_public_ip(key[1], self.clock.now):
+                return False
+        return True
+
+    def is_down(self, provider: str) -> bool:
+        return any(start <= self.clock.now < end for start, end in self.outages.get(provider, ()))
+
+    def request_update(self, query_url: str) -> dict:
+        """Answer an update request like DuckDNS or No-IP, see domain_mgr."""
+
+        url = urlsplit(query_url)
+        query = parse_qs(url.query)
+        if "duckdns" in url.path or "duckdns" in url.netloc:
+            provider = "DUCKDNS"
+            names = query["domains"][0].split(",")
+            ips = query.get("ip", []) + query.get("ipv6", [])
+        else:
+            provider = "NOIP"
+            names = query["hostname"][0].split(",")
+            ips = query.get("myip", [""])[0].split(",")
+        self.update_requests[provider] = self.update_requests.get(provider, 0) + 1
+
+        if self.is_down(provider) or self.rng.random() < self.failure_rate:
+            self.counts["failed_updates"] += 1
+            return {"status_code": 503, "response_text": "", "headers": {}}
+
+        changed = False
+        for name in names:
+            for ip in filter(None, ips):
+                key = (name, "AAAA" if ":" in ip else "A")
+                if self.provider_records.get(key) != ip:
+                    changed = True
+                    self.provider_records[key] = ip
+                    self.dns_times.setdefault(key, []).append(self.clock.now + self.dns_delay)
+                    self.dns_ips.setdefault(key, []).append(ip)
+        if not changed:
+            self.counts["redundant_updates"] += 1
+
+        if provider == "DUCKDNS":
+            return {"status_code": 200, "response_text": "OK", "headers": {}}
+        return {
+            "status_code": 200,
+            "response_text": "\n".join(f"{'good' if changed else 'nochg'} {ips[0]}" for _ in names),
+            "headers": {},
+        }
+
+    def get_staleness(self, end: float) -> list:
+        """Seconds of every period a record pointed to another IP than the public one."""
+
+        stale_periods = []
+        for (domain, record_type), dns_times in self.dns_times.items():
+            stale_since = None
+            # Both IPs only change at these times
+            for change_time in sorted(set(self.ip_change_times) | set(dns_times)):
+                if change_time >= end:
+                    break
+                public_ip = self.get_public_ip(record_type, change_time)
+                stale = public_ip is not None and self.get_dns_ip(domain, record_type, change_time) != public_ip
+                if stale and stale_since is None:
+                    stale_since = change_time
+                elif not stale and stale_since is not None:
+                    stale_periods.append(change_time - stale_since)
+                    stale_since = None
+            if stale_since is not None:
+                stale_periods.append(end - stale_since)
+
+        return stale_periods
+
+
+class SimulatedDNSClient:
+    """Stand-in of dns_client.DNSClient answering from the simulated world."""
+
+    world = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def resolve(self, questions: list) -> dict:
+        answers = {}
+        for domain, record_type in questions:
+            self.world.counts["dns_queries"] += 1
+            ip = self.world.get_dns_ip(domain, record_type)
+            answers[(domain, record_type)] = {
+                "answers": [(ip, self.world.dns_ttl)] if ip else [],
+                "seconds": 0.001,
+                "server": "simulated",
+            }
+
+        return answers
+
+
+def fast_forward(scheduler, domain_handlers: list, until: float) -> int:
+    """
+    Move every job past until as if each run in between found nothing to do, return how
+    many job runs were skipped. The jobs keep their pace, as wait_due_handlers does.
+    """
+
+    skipped = 0
+    with scheduler._lock:
+        jobs = []
+        for due_time, counter, job_key in scheduler.jobs:
+            if due_time < until:
+                interval = scheduler.get_interval(job_key, domain_handlers)
+                runs = math.ceil((until - due_time) / interval)
+                due_time += runs * interval
+                skipped += runs
+            jobs.append((due_time, counter, job_key))
+        heapq.heapify(jobs)
+        scheduler.jobs = jobs
+
+    return skipped
+
+
+def get_percentile(values: list, percentile: float):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(0, math.ceil(len(values) * percentile / 100) - 1)]
+
+
+def run_policy(name: str, general: dict, args, events: list) -> dict:
+    import yaml
+
+    work_dir = tempfile.mkdtemp(prefix="syncddns_simulation_")
+    config = generate_config(args.domains, general)
+    with open(os.path.join(work_dir, "config.yaml"), "w") as file:
+        yaml.safe_dump(config, file)
+
+    import network_mgr
+    import sync_ddns
+
+    clock = VirtualClock()
+    # Every module of the package sees the virtual clock
+    for module in list(sys.modules.values()):
+        module_file = getattr(module, "__file__", None)
+        if module_file and os.path.dirname(os.path.abspath(module_file)) == package_dir:
+            if getattr(module, "time", None) is time:
+                module.time = clock
+    # The backoff jitter
+    random.seed(args.seed)
+
+    domains = [name for entry in config["DOMAIN_INFO"] for data in entry["domain_list"] for name in data["domain_data"]["names"]]
+    world = SimulatedWorld(clock, events, domains, args.dns_delay, args.dns_ttl, args.failure_rate, args.seed)
+    SimulatedDNSClient.world = world
+    network_mgr.DNSClient = SimulatedDNSClient
+    network_mgr.NetworkMgr.get_current_IPs = lambda self: world.get_public_ips()
+    network_mgr.NetworkMgr.request_ip_update = (
+        lambda self, query_url, request_method=None, query_headers=None, query_data=None: world.request_update(query_url)
+    )
+
+    sync_ddns.config_path = os.path.join(work_dir, "config.yaml")
+    sync_ddns.config_snapshot_path = os.path.join(work_dir, "config.snapshot")
+    sync_ddns.state_path = os.path.join(work_dir, "state.json")
+    sync_ddns.getter_health_path = os.path.join(work_dir, "getter_health.json")
+    sync_ddns.load_config(daemon=False)
+
+    # watch_interfaces checks right after an IP change, watch_debounce seconds later
+    watch = bool(general.get("watch_interfaces"))
+    watch_debounce = general.get("watch_debounce", 2)
+    scheduler = sync_ddns.config_settings["scheduler"]
+    end = args.days * 86400
+    cycles = 0
+    skipped_job_runs = 0
+    wall_start = time.perf_counter()
+    while clock.now < end:
+        next_run = scheduler.get_next_run()
+        next_time = clock.now + next_run if next_run is not None else clock.now
+        next_change = world.get_next_ip_change() if watch else None
+        if next_change is not None and next_change + watch_debounce < next_time:
+            clock.now = next_change + watch_debounce
+            scheduler.wake()
+        else:
+            # Past the due time, rounding must not leave the job a hair in the future
+            clock.now = next_time + 1e-6
+        if clock.now >= end:
+            break
+
+        domain_handlers = sync_ddns.config_settings["domain_handlers"]
+        due_handlers = scheduler.wait_due_handlers(domain_handlers)
+        if not due_handlers:
+            continue
+        update_requests = sum(world.update_requests.values())
+        sync_ddns.run_ip_check_cycle(due_handlers)
+        cycles += 1
+
+        # Nothing changes until the public IP does: the next cycles would all find the
+        # DNS up to date, they are skipped. Retries and sent requests may still be pending.
+        if (
+            args.fast_forward
+            and sum(world.update_requests.values()) == update_requests
+            and not any(job_key[0] == "retry" for _, _, job_key in scheduler.jobs)
+            and world.is_converged()
+        ):
+            next_change = world.get_next_ip_change()
+            skipped_job_runs += fast_forward(scheduler, domain_handlers, min(end, next_change or end))
+
+    wall_seconds = time.perf_counter() - wall_start
+    stale_periods = world.get_staleness(end)
+
+    return {
+        "policy": name,
+        "settings": general,
+        "days": args.days,
+        "domains": args.domains,
+        "ip_changes": max(0, len(world.ip_changes) - 1),
+        "cycles": cycles,
+        "skipped_job_runs": skipped_job_runs,
+        "stale_periods": len(stale_periods),
+        "stale_mean_seconds": round(sum(stale_periods) / len(stale_periods), 1) if stale_periods else 0,
+        "stale_p99_seconds": round(get_percentile(stale_periods, 99), 1),
+        "stale_ratio": round(sum(stale_periods) / (end * max(1, len(world.dns_times))), 6),
+        "update_requests": sum(world.update_requests.values()),
+        "update_requests_by_provider": dict(sorted(world.update_requests.items())),
+        "redundant_updates": world.counts["redundant_updates"],
+        "failed_updates": world.counts["failed_updates"],
+        "dns_queries": world.counts["dns_queries"],
+        "ip_lookups": world.counts["ip_lookups"],
+        "wall_seconds": round(wall_seconds, 2),
+        "simulated_days_per_second": round(args.days / wall_seconds, 1) if wall_seconds else None,
+    }
+
+
+def parse_policy(policy: str) -> tuple:
+    """name:key=value,key=value -> (name, GENERAL settings), values are parsed as YAML."""
+
+    import yaml
+
+    name, _, settings = policy.partition(":")
+    general = {}
+    for setting in filter(None, settings.split(",")):
+        key, _, value = setting.partition("=")
+        general[key.strip()] = yaml.safe_load(value)
+
+    return name, general
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--days", type=float, default=365)
+    parser.add_argument("--domains", type=int, default=10)
+    parser.add_argument("--trace", help="timeline to replay, generated if not set")
+    parser.add_argument("--save-trace", help="write the generated timeline to this file")
+    parser.add_argument("--ip-changes-per-day", type=float, default=1)
+    parser.add_argument("--ipv6", action="store_true", help="the generated timeline changes the IPv6 too")
+    parser.add_argument("--outages-per-day", type=float, default=0.05, help="per provider")
+    parser.add_argument("--outage-seconds", type=float, default=1800, help="mean length of an outage")
+    parser.add_argument("--failure-rate", type=float, default=0.01, help="ratio of update requests failing with 503")
+    parser.add_argument("--dns-delay", type=float, default=30, help="seconds until the DNS answers an accepted update")
+    parser.add_argument("--dns-ttl", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--no-fast-forward",
+        dest="fast_forward",
+        action="store_false",
+        help="run every cycle, even those with nothing to do",
+    )
+    parser.add_argument(
+        "--policy",
+        action="append",
+        default=[],
+        metavar="NAME:KEY=VALUE,...",
+        help="GENERAL settings to compare with the current ones, e.g. fast:update_delay=60,retry_attempts=0",
+    )
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        with open(args.trace) as file:
+            events = [json.loads(line) for line in file if line.strip()]
+        name, general = parse_policy(args.worker)
+        print(json.dumps(run_policy(name, general, args, events)), flush=True)
+        return
+
+    trace_path = args.trace or args.save_trace
+    if not args.trace:
+        events = generate_trace(
+            args.days, args.ip_changes_per_day, args.outages_per_day, args.outage_seconds, args.ipv6, args.seed
+        )
+        if not trace_path:
+            trace_path = os.path.join(tempfile.mkdtemp(prefix="syncddns_simulation_"), "trace.jsonl")
+        with open(trace_path, "w") as file:
+            file.writelines(json.dumps(event) + "\n" for event in events)
+
+    for policy in ["current"] + args.policy:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--trace", trace_path, "--worker", policy],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        sys.stdout.write(completed.stdout)
+        if completed.returncode != 0:
+            sys.exit(completed.returncode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import hashlib
+import json
+import marshal
+import os
+import select
+import struct
+import threading
+import time
+
+import logger_mgr
+from state_mgr import write_file_atomic
+
+logger = logger_mgr.initialize_logger(__name__)
+
+required_general_settings = (
+    "update_delay",
+    "hide_update_queries_on_logs",
+    "continue_on_provider_fail",
+    "log_level",
+    "dns_servers",
+    "ipv4_servers",
+    "ipv6_servers",
+)
+
+# inotify flags, see linux/inotify.h
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_NONBLOCK = 0x800
+IN_CLOEXEC = 0x80000
+
+
+class ConfigError(Exception):
+    """The configuration is invalid, the message tells why."""
+
+
+def read_config(path: str, snapshot_path: str = None) -> dict:
+    """
+    Read the config file and check it has every required section.
+
+    With snapshot_path the parsed config is saved there, and reused instead of parsing
+    the YAML again while the config file doesn't change.
+    """
+
+    fingerprint = get_config_fingerprint(path)
+    config = read_config_snapshot(snapshot_path, fingerprint) if snapshot_path else None
+
+    if config is None:
+        # Imported here, it is slow to import and not needed while the snapshot is valid
+        import yaml
+
+        try:
+            with open(path, "r") as file:
+                config = load_yaml_stream(file)
+        except FileNotFoundError:
+            raise ConfigError(
+                f"'{os.path.basename(path)}' not found. Please copy 'config.yaml.dev', "
+                f"rename it to '{os.path.basename(path)}', and then edit it with your own settings."
+            )
+        except yaml.YAMLError as error:
+            raise ConfigError(f"Invalid YAML in '{os.path.basename(path)}': {error}")
+
+        if snapshot_path:
+            write_config_snapshot(snapshot_path, fingerprint, config)
+
+    if not isinstance(config, dict) or not isinstance(config.get("GENERAL"), dict):
+        raise ConfigError("Missing GENERAL section")
+    for setting in required_general_settings:
+        if setting not in config["GENERAL"]:
+            raise ConfigError(f"Missing GENERAL setting - {setting}")
+    if not isinstance(config.get("DOMAIN_INFO"), list):
+        raise ConfigError("Missing DOMAIN_INFO section")
+
+    return config
+
+
+class UnsupportedYAML(Exception):
+    """The YAML needs yaml.safe_load, see load_yaml_stream."""
+
+
+def load_yaml_stream(file):
+    """
+    Build the document of file as yaml.safe_load does, straight from the parser events.
+
+    safe_load composes the node tree of the whole document first, a node with its
+    position marks for every value, several times the size of the config itself.
+    Here every value is built as soon as it is parsed. The libyaml parser is used
+    when available. A stream of several documents, or a tagged collection like !!set,
+    is loaded again by safe_load, so it gets the same value or error.
+    """
+
+    import yaml
+
+    loader_class = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    try:
+        return build_yaml_document(file, loader_class)
+    except UnsupportedYAML:
+        file.seek(0)
+        return yaml.load(file, Loader=loader_class)
+
+
+def build_yaml_document(file, loader_class):
+    """Build the single document of file, raises UnsupportedYAML for what safe_load must build."""
+
+    import yaml
+
+    # Tags of the collections built here, the mappings and sequences without a tag
+    collection_tags = {
+        yaml.MappingStartEvent: (None, "!", "tag:yaml.org,2002:map"),
+        yaml.SequenceStartEvent: (None, "!", "tag:yaml.org,2002:seq"),
+    }
+    loader = loader_class(file)
+    no_key = object()
+    anchors = {}
+    # [container, key waiting for its value, values merged with <<]
+    stack = []
+    root = None
+
+    def add_value(value):
+        nonlocal root
+        if not stack:
+            root = value
+            return
+
+        frame = stack[-1]
+        if isinstance(frame[0], list):
+            frame[0].append(value)
+        elif frame[1] is no_key:
+            frame[1] = value
+        else:
+            key, frame[1] = frame[1], no_key
+            if key is yaml.resolver.BaseResolver:
+                # Merge key, see https://yaml.org/type/merge.html
+                frame[2].append(value)
+            else:
+                try:
+                    frame[0][key] = value
+                except TypeError:
+                    raise yaml.constructor.ConstructorError(
+                        "while constructing a mapping", None, "found unhashable key", None
+                    )
+
+    try:
+        while not loader.check_event(yaml.DocumentEndEvent, yaml.StreamEndEvent):
+            event = loader.get_event()
+
+            if isinstance(event, yaml.ScalarEvent):
+                tag = event.tag
+                if tag is None or tag == "!":
+                    tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+                if tag == "tag:yaml.org,2002:merge":
+                    value = yaml.resolver.BaseResolver
+                else:
+                    constructor = loader.yaml_constructors.get(
+                        tag, loader.yaml_constructors[None]
+                    )
+                    value = constructor(loader, yaml.ScalarNode(tag, event.value, style=event.style))
+            elif isinstance(event, yaml.AliasEvent):
+                if event.anchor not in anchors:
+                    raise yaml.composer.ComposerError(
+                        None, None, f"found undefined alias {event.anchor!r}", event.start_mark
+                    )
+                value = anchors[event.anchor]
+            elif isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+                if event.tag not in collection_tags[type(event)]:
+                    raise UnsupportedYAML()
+                value = {} if isinstance(event, yaml.MappingStartEvent) else []
+                if event.anchor:
+                    anchors[event.anchor] = value
+                add_value(value)
+                stack.append([value, no_key, []])
+                continue
+            elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+                container, _, merged = stack.pop()
+                if merged:
+                    merge_mappings(container, merged, event.start_mark)
+                continue
+            else:
+                # Stream and document start
+                continue
+
+            if event.anchor:
+                anchors[event.anchor] = value
+            add_value(value)
+
+        if loader.check_event(yaml.DocumentEndEvent):
+            loader.get_event()
+            if not loader.check_event(yaml.StreamEndEvent):
+                raise UnsupportedYAML()
+    finally:
+        loader.dispose()
+
+    return root
+
+
+def merge_mappings(mapping: dict, merged: list, mark):
+    """Add the << mappings to mapping, in the order of safe_load, its own keys win."""
+
+    import yaml
+
+    merged_mappings = []
+    for value in merged:
+        merged_mappings += value if isinstance(value, list) else [value]
+    if not all(isinstance(merged_mapping, dict) for merged_mapping in merged_mappings):
+        raise yaml.constructor.ConstructorError(None, None, "expected a mapping for merging", mark)
+
+    own_items = list(mapping.items())
+    mapping.clear()
+    # The first merged mapping wins over the next ones
+    for merged_mapping in reversed(merged_mappings):
+        mapping.update(merged_mapping)
+    mapping.update(own_items)
+
+
+def read_config_snapshot(snapshot_path: str, fingerprint):
+    """Return the config saved in the snapshot, None if missing or taken from another version of the file."""
+
+    if fingerprint is None:
+        return None
+
+    try:
+        with open(snapshot_path, "rb") as file:
+            snapshot_fingerprint, config = marshal.load(file)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    return config if tuple(snapshot_fingerprint) == fingerprint else None
+
+
+def write_config_snapshot(snapshot_path: str, fingerprint, config: dict):
+    if fingerprint is None:
+        return
+
+    try:
+        # marshal only stores plain data, loading it can't run any code
+        write_file_atomic(snapshot_path, marshal.dumps((fingerprint, config)))
+    except (OSError, ValueError) as error:
+        # e.g. dates in the config, marshal can't store them
+        logger.debug("Config snapshot not saved: %s", error)
+
+
+def get_domain_handler_key(provider: str, domain_data: dict) -> bytes:
+    """
+    Identify a DOMAIN_INFO entry by its whole content, so any edit makes a new handler.
+
+    A digest is kept instead of the content, there is one key per handler.
+    """
+
+    return hashlib.blake2b(
+        json.dumps([provider, domain_data], sort_keys=True, default=str).encode(), digest_size=16
+    ).digest()
+
+
+def get_config_fingerprint(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+
+
+class ConfigWatcher:
+    """
+    Call on_change when the config file is written.
+
+    The directory of the file is watched with inotify, so editors replacing the file
+    are seen too. If inotify isn't available the file is checked every poll_interval
+    seconds. Writes within debounce seconds are merged into a single on_change call.
+    """
+
+    def __init__(self, path: str, on_change, debounce: float = 1, poll_interval: float = 10):
+        self.path = os.path.abspath(path)
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.fingerprint = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.fingerprint = get_config_fingerprint(self.path)
+        event_source = self.open_inotify() or self.poll_wait
+
+        self._thread = threading.Thread(
+            target=self.watch, args=(event_source,), name="config_watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def open_inotify(self):
+        """Return a function waiting for writes of the config file, None if unavailable."""
+
+        # Imported here, only the daemon watches the config
+        import ctypes
+        import ctypes.util
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if inotify_fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            watch = libc.inotify_add_watch(
+                inotify_fd,
+                os.path.dirname(self.path).encode(),
+                IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE,
+            )
+            if watch < 0:
+                os.close(inotify_fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        except (AttributeError, OSError) as error:
+            logger.warning(
+                f"inotify not available, checking the config every {self.poll_interval} seconds"
+            )
+            logger.debug("Error: %s", error)
+            return None
+
+        file_name = os.path.basename(self.path).encode()
+
+        def inotify_wait(timeout):
+            readable, _, _ = select.select([inotify_fd], [], [], timeout)
+            if not readable:
+                return False
+            try:
+                data = os.read(inotify_fd, 65536)
+            except BlockingIOError:
+                return False
+
+            # inotify_event (wd, mask, cookie, len) followed by the file name
+            changed = False
+            offset = 0
+            while offset + 16 <= len(data):
+                _, _, _, name_length = struct.unpack_from("iIII", data, offset)
+                name = data[offset + 16 : offset + 16 + name_length].rstrip(b"\0")
+                changed = changed or name == file_name
+                offset += 16 + name_length
+
+            return changed
+
+        return inotify_wait
+
+    def poll_wait(self, timeout):
+        self._stop_event.wait(min(timeout, self.poll_interval))
+        return get_config_fingerprint(self.path) != self.fingerprint
+
+    def watch(self, event_source):
+        while not self._stop_event.is_set():
+            try:
+                if not event_source(self.poll_interval):
+                    continue
+
+                # Wait for the editor to finish writing
+                deadline = time.monotonic() + self.debounce
+                while (remaining := deadline - time.monotonic()) > 0:
+                    event_source(remaining)
+
+                fingerprint = get_config_fingerprint(self.path)
+                if fingerprint is None or fingerprint == self.fingerprint:
+                    continue
+
+                self.fingerprint = fingerprint
+                logger.info("Config file changed")
+                self.on_change()
+            except Exception as error:
+                logger.error(f"Error while watching the config file: {error}")
+                self._stop_event.wait(self.poll_interval)
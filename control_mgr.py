@@ -0,0 +1,189 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import logger_mgr
+
+logger = logger_mgr.initialize_logger(__name__)
+
+# Bigger request bodies are rejected
+max_body_size = 4096
+
+
+class ControlMgr:
+    """
+    Local HTTP API to check the domains now, push a known IP and read the status.
+
+    Triggers arriving within debounce seconds of the first one are merged into a
+    single on_trigger call, so a flapping link doesn't start a cycle per event.
+    """
+
+    def __init__(
+        self, on_trigger, get_status, push_ip, check_ip, debounce: float = 5, token: str = None
+    ):
+        self.on_trigger = on_trigger
+        self.get_status = get_status
+        self.push_ip = push_ip
+        # Checked for every IP of a request before pushing any
+        self.check_ip = check_ip
+        self.debounce = debounce
+        self.token = token
+        self.trigger_all = False
+        self.providers = set()
+        self.handler_ids = set()
+        self.server = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def start(self, port: int, address: str = "127.0.0.1"):
+        self.server = ThreadingHTTPServer((address, port), ControlRequestHandler)
+        self.server.control_mgr = self
+        threading.Thread(
+            target=self.server.serve_forever, name="control_api", daemon=True
+        ).start()
+        logger.info(f"Control API available at http://{address}:{port}/")
+
+    def trigger(self, provider: str = None, handler_id: str = None):
+        """Check the handlers of provider, handler_id, or every one if none is set."""
+
+        with self._lock:
+            if provider:
+                self.providers.add(provider)
+            if handler_id:
+                self.handler_ids.add(handler_id)
+            if not provider and not handler_id:
+                self.trigger_all = True
+
+            if self._timer is None:
+                self._timer = threading.Timer(self.debounce, self.fire)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def fire(self):
+        with self._lock:
+            self._timer = None
+        self.on_trigger()
+
+    def take_triggered(self, domain_handlers: list) -> list:
+        """Return the handlers triggered since the last call."""
+
+        with self._lock:
+            trigger_all, self.trigger_all = self.trigger_all, False
+            providers, self.providers = self.providers, set()
+            handler_ids, self.handler_ids = self.handler_ids, set()
+
+        if trigger_all:
+            return list(domain_handlers)
+
+        return [
+            domain_handler
+            for domain_handler in domain_handlers
+            if domain_handler.provider in providers or domain_handler.handler_id in handler_ids
+        ]
+
+    def check_token(self, authorization: str) -> bool:
+        if not self.token:
+            return True
+        return hmac.compare_digest(authorization or "", f"Bearer {self.token}")
+
+
+class ControlRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        control_mgr = self.server.control_mgr
+        if not control_mgr.check_token(self.headers.get("Authorization")):
+            self.send_json(401, {"error": "Invalid token"})
+            return
+        if self.path.split("?")[0] != "/status":
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        self.send_json(200, control_mgr.get_status())
+
+    def do_POST(self):
+        control_mgr = self.server.control_mgr
+        if not control_mgr.check_token(self.headers.get("Authorization")):
+            self.send_json(401, {"error": "Invalid token"})
+            return
+
+        path = self.path.split("?")[0]
+        if path not in ("/sync", "/ip"):
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        body = self.read_json()
+        if body is None:
+            self.send_json(400, {"error": "The body must be a JSON object"})
+            return
+
+        for field in ("provider", "handler"):
+            if not isinstance(body.get(field) or "", str):
+                self.send_json(400, {"error": f"{field} must be a string"})
+                return
+
+        if path == "/ip":
+            ips = {
+                ip_version: body[ip_version] for ip_version in ("ipv4", "ipv6") if body.get(ip_version)
+            }
+            if not ips:
+                self.send_json(400, {"error": "Missing ipv4 or ipv6"})
+                return
+            # Nothing is pushed unless every IP is valid
+            for ip_version, ip in ips.items():
+                if (
+                    not isinstance(ip, str)
+                    or not control_mgr.check_ip(ip)
+                    or (":" in ip) != (ip_version == "ipv6")
+                ):
+                    self.send_json(400, {"error": f"Invalid {ip_version} - {ip}"})
+                    return
+            for ip in ips.values():
+                control_mgr.push_ip(ip)
+            logger.info(f"Control API - IPs pushed: {list(ips.values())}")
+
+        control_mgr.trigger(body.get("provider"), body.get("handler"))
+        self.send_json(202, {"queued": True, "debounce": control_mgr.debounce})
+
+    def read_json(self):
+        """Return the JSON object of the body, {} without body, None if invalid."""
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            return None
+        if not length:
+            return {}
+        if length > max_body_size:
+            return None
+
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            return None
+
+        return body if isinstance(body, dict) else None
+
+    def send_json(self, status: int, content: dict):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Control API - %s - %s", self.address_string(), format % args)
@@ -0,0 +1,75 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class DNSCache:
+    """LRU cache of DNS answers keyed by (domain, record type), honoring the record TTL."""
+
+    def __init__(self, max_size: int = 1024, max_ttl: int = 3600):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, domain: str, record_type: str):
+        """Return the cached IP, or None if it isn't cached or the TTL expired."""
+
+        key = (domain.lower(), record_type)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, domain: str, record_type: str, ip: str, ttl: int):
+        if self.max_size <= 0 or not ip or ttl is None or ttl <= 0:
+            return
+
+        key = (domain.lower(), record_type)
+        expires_at = time.monotonic() + min(ttl, self.max_ttl)
+
+        with self._lock:
+            self._entries[key] = (ip, expires_at)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, domain: str):
+        """Drop every cached record of the domain, e.g. right after updating it."""
+
+        with self._lock:
+            for record_type in ("A", "AAAA"):
+                self._entries.pop((domain.lower(), record_type), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
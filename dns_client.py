@@ -0,0 +1,342 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import ipaddress
+import secrets
+import select
+import socket
+import struct
+import time
+from collections import deque
+
+import logger_mgr
+
+logger = logger_mgr.initialize_logger(__name__)
+
+record_types = {"A": 1, "NS": 2, "AAAA": 28}
+CNAME = 5
+OPT = 41
+CLASS_IN = 1
+FLAG_RD = 0x0100
+FLAG_TC = 0x0200
+FLAG_AA = 0x0400
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+# Length of the rdata of A and AAAA records
+address_lengths = {"A": 4, "AAAA": 16}
+# Largest EDNS UDP payload that avoids IP fragmentation
+edns_payload_size = 1232
+
+
+def build_query(transaction_id: int, domain: str, record_type: str, recursion: bool = True) -> bytes:
+    header = struct.pack(
+        "!HHHHHH", transaction_id, FLAG_RD if recursion else 0, 1, 0, 0, 1
+    )
+    question = encode_name(domain) + struct.pack("!HH", record_types[record_type], CLASS_IN)
+    # EDNS OPT record, so bigger answers aren't truncated
+    opt = b"\0" + struct.pack("!HHIH", OPT, edns_payload_size, 0, 0)
+
+    return header + question + opt
+
+
+def encode_name(domain: str) -> bytes:
+    name = b""
+    for label in domain.rstrip(".").split("."):
+        label = label.encode("idna")
+        name += bytes([len(label)]) + label
+
+    return name + b"\0"
+
+
+def read_name(data: bytes, offset: int) -> tuple:
+    """
+    Return the name at offset, following compression pointers, and the offset after it.
+
+    Raises ValueError or IndexError for a truncated or malformed name.
+    """
+
+    labels = []
+    end_offset = None
+    for _ in range(128):
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end_offset is None:
+                end_offset = offset + 2
+            offset = struct.unpack_from("!H", data, offset)[0] & 0x3FFF
+            continue
+        if length & 0xC0:
+            raise ValueError(f"Unknown label type {length:#x}")
+        if length == 0:
+            return ".".join(labels).lower(), end_offset if end_offset is not None else offset + 1
+        if offset + 1 + length > len(data):
+            raise ValueError("Truncated name")
+
+        labels.append(data[offset + 1 : offset + 1 + length].decode("ascii", "replace"))
+        offset += 1 + length
+
+    raise ValueError("Too many compression pointers")
+
+
+def parse_response(data: bytes) -> dict:
+    """
+    Parse a DNS response.
+
+    Returns:
+    dict: transaction_id, flags, rcode, question (domain, record type number) and the
+    answer, authority and additional records as (name, type, ttl, rdata, rdata offset)
+    tuples, the offset is needed to read the compressed names of the rdata.
+
+    Raises ValueError, IndexError or struct.error for a truncated or malformed response.
+    """
+
+    transaction_id, flags, question_count, answer_count, authority_count, additional_count = (
+        struct.unpack_from("!HHHHHH", data)
+    )
+    offset = 12
+
+    question = None
+    for _ in range(question_count):
+        name, offset = read_name(data, offset)
+        question_type = struct.unpack_from("!H", data, offset)[0]
+        offset += 4
+        question = (name, question_type)
+
+    sections = []
+    for count in (answer_count, authority_count, additional_count):
+        records = []
+        for _ in range(count):
+            name, offset = read_name(data, offset)
+            record_type, _, ttl, length = struct.unpack_from("!HHIH", data, offset)
+            offset += 10
+            if offset + length > len(data):
+                raise ValueError("Truncated record")
+            records.append((name, record_type, ttl, data[offset : offset + length], offset))
+            offset += length
+        sections.append(records)
+
+    return {
+        "transaction_id": transaction_id,
+        "flags": flags,
+        "rcode": flags & 0x000F,
+        "question": question,
+        "answer": sections[0],
+        "authority": sections[1],
+        "additional": sections[2],
+        "data": data,
+    }
+
+
+def get_answer_records(response: dict, record_type: str) -> list:
+    """
+    Return the (value, TTL) of every record of the answer with the question's type.
+
+    Values are IPs for A and AAAA, nameserver names for NS. The TTL of an A or AAAA
+    record reached through CNAMEs is the lowest TTL of the chain.
+
+    Raises ValueError or IndexError for a malformed record, e.g. an A record that isn't
+    4 bytes long.
+    """
+
+    type_number = record_types[record_type]
+    chain_ttl = None
+    answers = []
+    for name, answer_type, ttl, rdata, rdata_offset in response["answer"]:
+        if answer_type == CNAME:
+            chain_ttl = ttl if chain_ttl is None else min(chain_ttl, ttl)
+        elif answer_type != type_number:
+            continue
+        elif record_type == "NS":
+            # Only the NS of the name itself, the zone apex
+            if name == response["question"][0]:
+                answers.append((read_name(response["data"], rdata_offset)[0], ttl))
+        else:
+            if len(rdata) != address_lengths[record_type]:
+                raise ValueError(f"{record_type} record of {len(rdata)} bytes")
+            ip = ipaddress.IPv4Address(rdata) if record_type == "A" else ipaddress.IPv6Address(rdata)
+            answers.append((str(ip), ttl if chain_ttl is None else min(chain_ttl, ttl)))
+
+    return answers
+
+
+class DNSClient:
+    """
+    Resolve many A, AAAA and NS questions at once over a single UDP socket.
+
+    Up to max_in_flight questions are sent without waiting for the previous answers,
+    the answers are matched by transaction ID and question. The questions a server
+    doesn't answer within timeout seconds are asked to the next one. Without recursion
+    the servers are expected to be authoritative, other answers are rejected.
+    """
+
+    def __init__(
+        self,
+        servers: list,
+        port: int = 53,
+        timeout: float = 5,
+        max_in_flight: int = 64,
+        recursion: bool = True,
+    ):
+        self.servers = servers
+        self.port = port
+        self.timeout = timeout
+        self.max_in_flight = max(1, max_in_flight)
+        self.recursion = recursion
+
+    def resolve(self, questions: list) -> dict:
+        """
+        Parameters:
+        questions (list): (domain, record type) pairs, record type being A, AAAA or NS.
+
+        Returns:
+        dict: (domain, record type) -> {"answers": [(value, TTL), ...], "server", "seconds"},
+        answers is empty if the record doesn't exist. None if no server answered.
+        """
+
+        results = dict.fromkeys(questions)
+        pending = list(results)
+        for server in self.servers:
+            if not pending:
+                break
+            pending = self.resolve_with_server(server, pending, results)
+
+        return results
+
+    def resolve_with_server(self, server: str, questions: list, results: dict) -> list:
+        """Ask the questions to server, return the ones that didn't get a valid answer."""
+
+        family = socket.AF_INET6 if ":" in server else socket.AF_INET
+        failed = []
+        queued = deque(questions)
+        # transaction ID -> (question, sent time), in sending order
+        in_flight = {}
+
+        with socket.socket(family, socket.SOCK_DGRAM) as dns_socket:
+            try:
+                # Connected, so only the server's datagrams are received
+                dns_socket.connect((server, self.port))
+                dns_socket.setblocking(False)
+
+                while queued or in_flight:
+                    while queued and len(in_flight) < self.max_in_flight:
+                        question = queued[0]
+                        # Unpredictable, so off-path answers can't be forged easily
+                        transaction_id = secrets.randbelow(65536)
+                        while transaction_id in in_flight:
+                            transaction_id = secrets.randbelow(65536)
+                        try:
+                            dns_socket.send(
+                                build_query(transaction_id, *question, recursion=self.recursion)
+                            )
+                        except BlockingIOError:
+                            # Send buffer full, wait for some answers
+                            break
+                        queued.popleft()
+                        in_flight[transaction_id] = (question, time.monotonic())
+
+                    if in_flight:
+                        oldest_sent = next(iter(in_flight.values()))[1]
+                        wait = max(0, oldest_sent + self.timeout - time.monotonic())
+                    else:
+                        wait = 0.01
+                    readable, _, _ = select.select([dns_socket], [], [], wait)
+                    if readable:
+                        self.read_responses(server, dns_socket, in_flight, results, failed)
+
+                    now = time.monotonic()
+                    for transaction_id, (question, sent_time) in list(in_flight.items()):
+                        if sent_time + self.timeout > now:
+                            break
+                        del in_flight[transaction_id]
+                        failed.append(question)
+            except OSError as error:
+                # e.g. ICMP port unreachable, the server isn't usable
+                logger.debug("DNS server %s failed: %s", server, error)
+                failed += [question for question, _ in in_flight.values()] + list(queued)
+
+        if failed:
+            logger.debug("DNS server %s didn't answer %s questions", server, len(failed))
+
+        return failed
+
+    def read_responses(self, server, dns_socket, in_flight: dict, results: dict, failed: list):
+        while True:
+            try:
+                data = dns_socket.recv(65535)
+            except BlockingIOError:
+                return
+
+            try:
+                response = parse_response(data)
+            except (ValueError, IndexError, struct.error) as error:
+                logger.debug("Invalid DNS response from %s: %s", server, error)
+                continue
+
+            sent = in_flight.get(response["transaction_id"])
+            if sent is None:
+                continue
+            question, sent_time = sent
+            # Reject answers for another question, e.g. spoofed
+            if response["question"] != (question[0].rstrip(".").lower(), record_types[question[1]]):
+                continue
+            del in_flight[response["transaction_id"]]
+
+            if response["flags"] & FLAG_TC:
+                response = self.query_tcp(server, *question)
+                if response is None:
+                    failed.append(question)
+                    continue
+
+            if response["rcode"] not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+                # SERVFAIL, REFUSED... the next server may answer
+                failed.append(question)
+                continue
+            if not self.recursion and not response["flags"] & FLAG_AA:
+                # A referral or a cached answer, not the truth of the zone
+                failed.append(question)
+                continue
+
+            try:
+                answers = get_answer_records(response, question[1])
+            except (ValueError, IndexError, struct.error) as error:
+                # A failed lookup, the next server may answer
+                logger.debug("Invalid DNS answer from %s for %s: %s", server, question, error)
+                failed.append(question)
+                continue
+
+            results[question] = {
+                "answers": answers,
+                "server": server,
+                "seconds": time.monotonic() - sent_time,
+            }
+
+    def query_tcp(self, server: str, domain: str, record_type: str):
+        """Ask again over TCP, for the truncated answers."""
+
+        transaction_id = secrets.randbelow(65536)
+        query = build_query(transaction_id, domain, record_type, recursion=self.recursion)
+        try:
+            with socket.create_connection((server, self.port), timeout=self.timeout) as tcp_socket:
+                tcp_socket.sendall(struct.pack("!H", len(query)) + query)
+                data = b""
+                while len(data) < 2 or len(data) < 2 + struct.unpack_from("!H", data)[0]:
+                    chunk = tcp_socket.recv(65535)
+                    if not chunk:
+                        return None
+                    data += chunk
+            response = parse_response(data[2:])
+        except (OSError, ValueError, IndexError, struct.error) as error:
+            logger.debug("DNS TCP query to %s failed: %s", server, error)
+            return None
+
+        return response if response["transaction_id"] == transaction_id else None
@@ -0,0 +1,138 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import threading
+import time
+
+import logger_mgr
+from state_mgr import read_json, write_json_atomic
+
+logger = logger_mgr.initialize_logger(__name__)
+
+
+class HealthMgr:
+    """
+    Score the IP getter servers by their latency and success rate.
+
+    Both are exponentially weighted moving averages, so recent requests weigh more.
+    A server failing failure_threshold times in a row is skipped for cooldown seconds
+    (circuit open), after that it gets a single new try before being skipped again.
+    """
+
+    def __init__(
+        self,
+        health_path: str = None,
+        failure_threshold: int = 3,
+        cooldown: int = 900,
+        alpha: float = 0.3,
+    ):
+        self.health_path = health_path
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.servers = read_json(health_path, {}) if health_path else {}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def get_server(self, url: str):
+        return self.servers.setdefault(
+            url,
+            {
+                "latency": None,
+                "success_rate": 1.0,
+                "consecutive_failures": 0,
+                "open_until": 0,
+                "requests": 0,
+                "failures": 0,
+            },
+        )
+
+    def record_result(self, url: str, success: bool, latency: float):
+        with self._lock:
+            server = self.get_server(url)
+            server["requests"] += 1
+            server["success_rate"] += self.alpha * (
+                (1.0 if success else 0.0) - server["success_rate"]
+            )
+
+            if success:
+                server["latency"] = (
+                    latency
+                    if server["latency"] is None
+                    else server["latency"] + self.alpha * (latency - server["latency"])
+                )
+                server["consecutive_failures"] = 0
+                server["open_until"] = 0
+            else:
+                server["failures"] += 1
+                server["consecutive_failures"] += 1
+                if server["consecutive_failures"] >= self.failure_threshold:
+                    server["open_until"] = time.time() + self.cooldown
+                    logger.warning(
+                        f"IP getter {url} failed {server['consecutive_failures']} times in a row, "
+                        f"skipping it for {self.cooldown} seconds"
+                    )
+
+            self._dirty = True
+
+    def is_open(self, url: str) -> bool:
+        """True if the server's circuit is open, so it shouldn't be used."""
+
+        server = self.servers.get(url)
+        return bool(server) and server["open_until"] > time.time()
+
+    def get_score(self, url: str) -> float:
+        """Expected cost of asking the server, lower is better. Unknown servers go first."""
+
+        server = self.servers.get(url)
+        if not server or not server["requests"]:
+            return 0.0
+        if server["latency"] is None:
+            return float("inf")
+
+        return server["latency"] / max(server["success_rate"], 0.05)
+
+    def sort_servers(self, urls: list) -> list:
+        """
+        Return the servers to try, the best ones first.
+
+        Servers with an open circuit are left out, unless all of them are open.
+        """
+
+        with self._lock:
+            sorted_urls = sorted(urls, key=self.get_score)
+            available_urls = [url for url in sorted_urls if not self.is_open(url)]
+
+        return available_urls or sorted_urls
+
+    def dump(self) -> dict:
+        with self._lock:
+            return {url: dict(server) for url, server in self.servers.items()}
+
+    def save(self):
+        """Write the scores to disk if they changed since the last save."""
+
+        if not self.health_path:
+            return
+
+        with self._lock:
+            if not self._dirty:
+                return
+
+            try:
+                write_json_atomic(self.health_path, self.servers)
+                self._dirty = False
+            except OSError as error:
+                logger.error(f"Can't save the IP getters health to {self.health_path}")
+                logger.debug("Error: %s", error)
@@ -0,0 +1,124 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import logging
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import logger_mgr
+
+logger = logger_mgr.initialize_logger(__name__)
+
+
+class HttpMgr:
+    """
+    Keep one keep-alive session per host, so the TCP and TLS handshakes are reused
+    between cycles instead of being made again on every request.
+
+    With http2 enabled the requests go through httpx (pip install httpx[http2]),
+    falling back to requests if it isn't installed.
+    """
+
+    def __init__(self, pool_size: int = 4, http2: bool = False):
+        self.pool_size = pool_size
+        self.http2 = False
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+        if http2:
+            try:
+                import httpx
+                import h2  # noqa: F401, needed by httpx for HTTP/2
+
+                self.httpx = httpx
+                self.http2 = True
+            except ImportError:
+                logger.warning(
+                    "http2 is enabled but httpx[http2] is not installed, using HTTP/1.1"
+                )
+
+    def get_session(self, url: str):
+        url_parts = urlsplit(url)
+        # Credentials in the URL (No-IP) don't change the connection
+        host = (url_parts.scheme, url_parts.hostname, url_parts.port)
+
+        with self._lock:
+            session = self.sessions.get(host)
+            if session is None:
+                if self.http2:
+                    session = self.httpx.Client(
+                        http2=True,
+                        limits=self.httpx.Limits(
+                            max_connections=self.pool_size,
+                            max_keepalive_connections=self.pool_size,
+                        ),
+                    )
+                else:
+                    session = requests.Session()
+                    # Nothing is shared between requests, not even cookies
+                    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                self.sessions[host] = session
+
+        return session
+
+    def request(self, method: str, url: str, **kwargs):
+        """
+        Send the request through the host's session.
+
+        headers are only used for this request, they are never stored in the session.
+        Errors are raised as requests.exceptions.RequestException for both transports.
+        """
+
+        session = self.get_session(url)
+
+        if self.http2:
+            try:
+                response = session.request(method, url, **kwargs)
+            except self.httpx.HTTPError as error:
+                raise requests.exceptions.RequestException(str(error)) from error
+        else:
+            response = session.request(method, url, **kwargs)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            self.log_pool_stats(url)
+
+        return response
+
+    def log_pool_stats(self, url: str):
+        if self.http2:
+            return
+
+        url_parts = urlsplit(url)
+        adapter = self.get_session(url).get_adapter(url)
+        for pool_key in list(adapter.poolmanager.pools.keys()):
+            pool = adapter.poolmanager.pools.get(pool_key)
+            if pool is None or pool.host != url_parts.hostname:
+                continue
+            logger.debug(
+                f"HTTP pool {pool.host}: {pool.num_requests} requests "
+                f"over {pool.num_connections} connections"
+            )
+
+    def close(self):
+        with self._lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
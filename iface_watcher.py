@@ -0,0 +1,218 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import ipaddress
+import select
+import socket
+import struct
+import threading
+import time
+
+import logger_mgr
+
+logger = logger_mgr.initialize_logger(__name__)
+
+if_inet6_path = "/proc/net/if_inet6"
+
+# rtnetlink multicast groups, see linux/rtnetlink.h
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+NETLINK_ROUTE = 0
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RT_SCOPE_UNIVERSE = 0
+
+# /proc/net/if_inet6 flags of addresses that must not be published
+IFA_F_TEMPORARY = 0x01
+IFA_F_DEPRECATED = 0x20
+IFA_F_TENTATIVE = 0x40
+IFA_F_DADFAILED = 0x08
+
+
+def get_interfaces_ipv6(interfaces: list = None, if_inet6=if_inet6_path) -> dict:
+    """
+    Return the global, stable IPv6 address of every interface.
+
+    Parameters:
+    interfaces (list): Interface names to look at, every interface if not set.
+    if_inet6 (str): Path of the file with the format of /proc/net/if_inet6.
+
+    Returns:
+    dict: interface name -> IPv6 address.
+    """
+
+    interfaces_ipv6 = {}
+    try:
+        with open(if_inet6, "r") as file:
+            lines = file.readlines()
+    except OSError as error:
+        logger.debug("Can't read %s: %s", if_inet6, error)
+        return interfaces_ipv6
+
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 6:
+            continue
+
+        address, _, _, scope, flags, interface = fields[:6]
+        if interfaces and interface not in interfaces:
+            continue
+        # Only global scope addresses reachable from the internet
+        if int(scope, 16) != 0 or int(flags, 16) & (
+            IFA_F_TEMPORARY | IFA_F_DEPRECATED | IFA_F_TENTATIVE | IFA_F_DADFAILED
+        ):
+            continue
+
+        ip = ipaddress.IPv6Address(int(address, 16))
+        if not ip.is_global:
+            continue
+
+        interfaces_ipv6.setdefault(interface, str(ip))
+
+    return interfaces_ipv6
+
+
+class IfaceWatcher:
+    """
+    Watch the local interfaces and call on_change as soon as their addresses change.
+
+    Address events come from rtnetlink, if it isn't available /proc/net/if_inet6 is
+    polled every poll_interval seconds. Changes within debounce seconds are merged
+    into a single on_change call.
+    """
+
+    def __init__(
+        self,
+        interfaces: list,
+        on_change,
+        debounce: float = 2,
+        poll_interval: float = 10,
+        event_source=None,
+    ):
+        self.interfaces = interfaces
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        # Callable blocking until an address event arrives or the timeout, for tests
+        self.event_source = event_source
+        self.current_ipv6 = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def get_current_ipv6(self):
+        """The IPv6 of the first configured interface having one, None if there is none."""
+
+        interfaces_ipv6 = get_interfaces_ipv6(self.interfaces)
+        for interface in self.interfaces or interfaces_ipv6:
+            if interface in interfaces_ipv6:
+                return interfaces_ipv6[interface]
+
+        return None
+
+    def start(self):
+        self.current_ipv6 = self.get_current_ipv6()
+
+        if self.event_source is None:
+            self.event_source = self.open_netlink() or self.poll_wait
+
+        self._thread = threading.Thread(
+            target=self.watch, name="iface_watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def open_netlink(self):
+        """Return a function waiting for rtnetlink address events, None if unavailable."""
+
+        try:
+            netlink_socket = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE
+            )
+            netlink_socket.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        except (AttributeError, OSError) as error:
+            logger.warning(
+                f"rtnetlink not available, polling {if_inet6_path} every {self.poll_interval} seconds"
+            )
+            logger.debug("Error: %s", error)
+            return None
+
+        def netlink_wait(timeout):
+            readable, _, _ = select.select([netlink_socket], [], [], timeout)
+            if not readable:
+                return set()
+            return self.parse_netlink_events(netlink_socket.recv(65535))
+
+        return netlink_wait
+
+    def parse_netlink_events(self, data: bytes) -> set:
+        """Return the families (AF_INET/AF_INET6) of the global addresses added or removed."""
+
+        families = set()
+        offset = 0
+        # nlmsghdr (length, type, flags, seq, pid) followed by ifaddrmsg
+        while offset + 24 <= len(data):
+            length, message_type = struct.unpack_from("=IH", data, offset)
+            family, _, _, scope, index = struct.unpack_from("=BBBBI", data, offset + 16)
+            if (
+                message_type in (RTM_NEWADDR, RTM_DELADDR)
+                and scope == RT_SCOPE_UNIVERSE
+                and (not self.interfaces or index in self.get_interfaces_index())
+            ):
+                families.add(family)
+            if length < 16:
+                break
+            offset += (length + 3) & ~3
+
+        return families
+
+    def get_interfaces_index(self) -> set:
+        interfaces_index = set()
+        for interface in self.interfaces:
+            try:
+                interfaces_index.add(socket.if_nametoindex(interface))
+            except OSError:
+                # Not created yet, e.g. a PPP interface while reconnecting
+                pass
+
+        return interfaces_index
+
+    def poll_wait(self, timeout):
+        self._stop_event.wait(min(timeout, self.poll_interval))
+        return {socket.AF_INET6} if self.get_current_ipv6() != self.current_ipv6 else set()
+
+    def watch(self):
+        while not self._stop_event.is_set():
+            try:
+                families = self.event_source(self.poll_interval)
+                if not families:
+                    continue
+
+                # Wait for the burst of events of a prefix change to end
+                deadline = time.monotonic() + self.debounce
+                while (remaining := deadline - time.monotonic()) > 0:
+                    families |= self.event_source(remaining)
+
+                new_ipv6 = self.get_current_ipv6()
+                ipv6_changed = new_ipv6 != self.current_ipv6
+                if ipv6_changed:
+                    logger.info(f"Interface IPv6 changed: {self.current_ipv6} -> {new_ipv6}")
+                    self.current_ipv6 = new_ipv6
+
+                if ipv6_changed or socket.AF_INET in families:
+                    self.on_change()
+            except Exception as error:
+                logger.error(f"Error while watching the interfaces: {error}")
+                self._stop_event.wait(self.poll_interval)
@@ -0,0 +1,235 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import atexit
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import logger_mgr
+from config_mgr import ConfigError
+
+logger = logger_mgr.initialize_logger(__name__)
+
+# Row of the lease and of the published state in the database
+lease_name = "sync_ddns"
+
+
+def get_default_instance_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseMgr:
+    """
+    Elect a leader among the instances sharing lease_path, a small SQLite database.
+
+    The leader renews its lease every lease_duration / 3 seconds and a standby takes it
+    over once it expires, so a failover takes at most lease_duration plus a renewal.
+    The leader steps down on its own a renewal before its lease expires, in case the
+    clocks of the instances drift a little.
+
+    Every takeover increments the fencing token. An update is only sent while the lease
+    is still held under the token its cycle started with, so a leader paused past its
+    lease can't push stale IPs once it resumes.
+    """
+
+    def __init__(
+        self, lease_path: str, instance_id: str = None, lease_duration: float = 30, on_change=None
+    ):
+        self.lease_path = lease_path
+        self.instance_id = instance_id or get_default_instance_id()
+        self.lease_duration = lease_duration
+        self.renew_interval = lease_duration / 3
+        self.on_change = on_change
+        # Fencing token of the lease held, None while standby
+        self.token = None
+        # time.monotonic() until which the lease is surely held
+        self.valid_until = 0
+        # Role last reported to on_change
+        self.leader = False
+        # updated_at of the last state read by read_state
+        self.state_updated_at = None
+        self._stop = threading.Event()
+
+        try:
+            with closing(self.connect()) as connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS lease "
+                    "(name TEXT PRIMARY KEY, holder TEXT, fencing_token INTEGER, expires_at REAL)"
+                )
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS state "
+                    "(name TEXT PRIMARY KEY, fencing_token INTEGER, content TEXT, updated_at REAL)"
+                )
+        except sqlite3.Error as error:
+            raise ConfigError(f"Can't open ha_lease_path - {lease_path}: {error}")
+
+    def connect(self):
+        # A connection per call, they can't be shared between threads
+        return sqlite3.connect(self.lease_path, timeout=self.renew_interval, isolation_level=None)
+
+    def start(self):
+        """Try to take the lease now, then keep renewing it or waiting for it in the background."""
+
+        if not self.renew():
+            logger.info(f"HA - {self.instance_id} is standing by, another instance holds the lease")
+        threading.Thread(target=self.run, name="lease", daemon=True).start()
+        atexit.register(self.release)
+
+    def run(self):
+        while not self._stop.wait(self.renew_interval):
+            self.renew()
+
+    def is_leader(self) -> bool:
+        return self.token is not None and time.monotonic() < self.valid_until
+
+    def renew(self) -> bool:
+        """Take or renew the lease, return whether this instance is the leader."""
+
+        renew_start = time.monotonic()
+        now = time.time()
+        try:
+            with closing(self.connect()) as connection:
+                connection.execute("BEGIN IMMEDIATE")
+                row = connection.execute(
+                    "SELECT holder, fencing_token, expires_at FROM lease WHERE name = ?",
+                    (lease_name,),
+                ).fetchone()
+                holder, token, expires_at = row or (None, 0, 0)
+
+                if holder == self.instance_id and token == self.token and expires_at > now:
+                    new_token = token
+                elif expires_at <= now or holder == self.instance_id:
+                    new_token = token + 1
+                else:
+                    new_token = None
+
+                if new_token is None:
+                    connection.execute("ROLLBACK")
+                else:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO lease VALUES (?, ?, ?, ?)",
+                        (lease_name, self.instance_id, new_token, now + self.lease_duration),
+                    )
+                    connection.execute("COMMIT")
+        except sqlite3.Error as error:
+            # Keep the lease until it expires, the next renewal may work
+            logger.warning(f"Can't renew the HA lease in {self.lease_path}: {error}")
+        else:
+            self.token = new_token
+            if new_token is not None:
+                self.valid_until = renew_start + self.lease_duration - self.renew_interval
+
+        is_leader = self.is_leader()
+        if is_leader != self.leader:
+            self.leader = is_leader
+            if is_leader:
+                logger.info(f"HA - {self.instance_id} is now the leader (fencing token {self.token})")
+            else:
+                logger.warning(f"HA - {self.instance_id} lost the lease, standing by")
+            if self.on_change:
+                self.on_change(is_leader)
+
+        return is_leader
+
+    def release(self):
+        """Let a standby take over right away, e.g. on exit."""
+
+        self._stop.set()
+        if self.token is None:
+            return
+
+        try:
+            with closing(self.connect()) as connection:
+                connection.execute(
+                    "UPDATE lease SET expires_at = 0 WHERE name = ? AND fencing_token = ?",
+                    (lease_name, self.token),
+                )
+        except sqlite3.Error as error:
+            logger.debug("HA lease not released: %s", error)
+        self.token = None
+
+    def check_fence(self, token) -> bool:
+        """True while the lease is still held under token, asked right before sending an update."""
+
+        if token is None:
+            return False
+
+        try:
+            with closing(self.connect()) as connection:
+                row = connection.execute(
+                    "SELECT fencing_token, expires_at FROM lease WHERE name = ?", (lease_name,)
+                ).fetchone()
+        except sqlite3.Error as error:
+            logger.warning(f"Can't check the HA lease in {self.lease_path}: {error}")
+            return False
+
+        # Tokens are never reused, whoever holds this one is the instance that took it
+        return row is not None and row[0] == token and row[1] > time.time()
+
+    def publish_state(self, token, content: dict) -> bool:
+        """Save content for the standbys, only while the lease is held under token."""
+
+        try:
+            with closing(self.connect()) as connection:
+                connection.execute("BEGIN IMMEDIATE")
+                row = connection.execute(
+                    "SELECT fencing_token, expires_at FROM lease WHERE name = ?", (lease_name,)
+                ).fetchone()
+                if row is None or row[0] != token or row[1] <= time.time():
+                    connection.execute("ROLLBACK")
+                    return False
+
+                connection.execute(
+                    "INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)",
+                    (lease_name, token, json.dumps(content), time.time()),
+                )
+                connection.execute("COMMIT")
+        except sqlite3.Error as error:
+            logger.warning(f"Can't publish the update state to {self.lease_path}: {error}")
+            return False
+
+        return True
+
+    def read_state(self):
+        """Return the state published by the leader, None if it didn't change since the last call."""
+
+        try:
+            with closing(self.connect()) as connection:
+                row = connection.execute(
+                    "SELECT content, updated_at FROM state WHERE name = ?", (lease_name,)
+                ).fetchone()
+        except sqlite3.Error as error:
+            logger.debug("Can't read the published state: %s", error)
+            return None
+
+        if row is None or row[1] == self.state_updated_at:
+            return None
+
+        self.state_updated_at = row[1]
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            return None
+
+    def get_status(self) -> dict:
+        return {
+            "instance_id": self.instance_id,
+            "role": "leader" if self.is_leader() else "standby",
+            "fencing_token": self.token,
+        }
@@ -12,23 +12,183 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
 import os
+import queue
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 logger_path = os.path.join(script_dir, "console.log")
 
-# Create handlers for writing to file and printing to console
-file_handler = logging.FileHandler(logger_path, "w")
-console_handler = logging.StreamHandler()
-# Create a formatter and set it for both handlers
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
+# Correlation IDs of the cycle and the handler being processed, see ContextFilter
+cycle_id = contextvars.ContextVar("cycle_id", default=None)
+handler_id = contextvars.ContextVar("handler_id", default=None)
 
 # INFO by default, but can be set in the config
 default_log_level = "INFO"
 loggers = []
+# Handlers attached to every logger, the QueueHandler in async mode
+current_handlers = []
+# Queues read by the listener: the local one and the ones of the shard workers
+log_queues = [queue.SimpleQueue()]
+queue_listeners = []
+# Handlers writing the records, used directly or by the listener
+output_handlers = []
+
+
+class ContextFilter(logging.Filter):
+    """Add the correlation IDs to the record, it runs in the thread that logs."""
+
+    def filter(self, record):
+        record.cycle_id = cycle_id.get()
+        record.handler_id = handler_id.get()
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, for log collectors."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in ("cycle_id", "handler_id"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry)
+
+
+context_filter = ContextFilter()
+
+
+def create_output_handlers(
+    log_format: str = "text",
+    max_bytes: int = 10 * 1024 * 1024,
+    backup_count: int = 3,
+    rotate_when: str = None,
+) -> list:
+    """Return the file and console handlers, the file rotates by size, or by time if rotate_when is set."""
+
+    if rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            logger_path, when=rotate_when, backupCount=backup_count
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            logger_path, maxBytes=max_bytes, backupCount=backup_count
+        )
+    console_handler = logging.StreamHandler()
+
+    if log_format == "json":
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    file_handler.setFormatter(formatter)
+    console_handler.setFormatter(formatter)
+
+    return [file_handler, console_handler]
+
+
+def set_handlers(handlers: list):
+    global current_handlers
+
+    for logger in loggers:
+        for handler in current_handlers:
+            logger.removeHandler(handler)
+        for handler in handlers:
+            logger.addHandler(handler)
+    current_handlers = handlers
+
+
+def stop_listeners():
+    """Write the queued records and stop the listener threads."""
+
+    while queue_listeners:
+        queue_listeners.pop().stop()
+
+
+def configure(
+    log_format: str = "text",
+    max_bytes: int = 10 * 1024 * 1024,
+    backup_count: int = 3,
+    rotate_when: str = None,
+    async_logging: bool = True,
+):
+    """
+    Set the output of every logger.
+
+    With async_logging the loggers only put the records in a queue, a background
+    thread writes them, so logging never waits for the disk or the console.
+    """
+
+    global output_handlers
+
+    stop_listeners()
+    for handler in output_handlers:
+        handler.close()
+    output_handlers = create_output_handlers(log_format, max_bytes, backup_count, rotate_when)
+
+    # The queues of the shard workers are always read by a listener
+    for log_queue in log_queues if async_logging else log_queues[1:]:
+        start_listener(log_queue)
+
+    if async_logging:
+        set_handlers([logging.handlers.QueueHandler(log_queues[0])])
+    else:
+        set_handlers(output_handlers)
+
+
+def start_listener(log_queue):
+    queue_listener = logging.handlers.QueueListener(
+        log_queue, *output_handlers, respect_handler_level=True
+    )
+    queue_listener.start()
+    queue_listeners.append(queue_listener)
+
+
+def listen(log_queue):
+    """Write the records of another process' queue too, see forward_to_queue."""
+
+    log_queues.append(log_queue)
+    start_listener(log_queue)
+
+
+def stop_listening(log_queue, wait: bool = True):
+    """
+    Write the last records of log_queue and stop reading it, once its process exited.
+
+    Without wait the listener is only told to stop, a killed process may have left the
+    queue locked and the listener waiting on it.
+    """
+
+    for queue_listener in [
+        queue_listener for queue_listener in queue_listeners if queue_listener.queue is log_queue
+    ]:
+        if wait:
+            queue_listener.stop()
+        else:
+            queue_listener.enqueue_sentinel()
+        queue_listeners.remove(queue_listener)
+    if log_queue in log_queues:
+        log_queues.remove(log_queue)
+
+
+def forward_to_queue(log_queue):
+    """Send every record to log_queue, for the forked shard workers, their parent writes them."""
+
+    # The listener threads of the parent weren't forked
+    queue_listeners.clear()
+    set_handlers([logging.handlers.QueueHandler(log_queue)])
 
 
 def initialize_logger(name: str):
@@ -36,8 +196,9 @@ def initialize_logger(name: str):
 
     logger = logging.getLogger(name)
     logger.setLevel(default_log_level)
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    logger.addFilter(context_filter)
+    for handler in current_handlers:
+        logger.addHandler(handler)
     loggers.append(logger)
 
     return logger
@@ -49,3 +210,9 @@ def set_log_level(level: str):
 
     for logger in loggers:
         logger.setLevel(level)
+
+
+# Written synchronously until configure is called
+output_handlers = create_output_handlers()
+set_handlers(output_handlers)
+atexit.register(stop_listeners)
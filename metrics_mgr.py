@@ -0,0 +1,278 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import threading
+
+import logger_mgr
+from state_mgr import write_file_atomic
+
+logger = logger_mgr.initialize_logger(__name__)
+
+# Seconds, from a cached DNS answer to a provider timing out
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(label_names: tuple, label_values: tuple, bucket: str = None) -> str:
+    labels = [
+        f'{name}="{escape_label_value(value)}"'
+        for name, value in zip(label_names, label_values)
+    ]
+    if bucket is not None:
+        labels.append(f'le="{bucket}"')
+
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    metric_type = None
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def get_label_values(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def render(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        with self._lock:
+            for label_values, value in sorted(self.values.items()):
+                lines += self.render_value(label_values, value)
+
+        return lines
+
+    def render_value(self, label_values: tuple, value) -> list:
+        return [f"{self.name}{format_labels(self.label_names, label_values)} {value}"]
+
+    def take_values(self) -> dict:
+        """Return the values recorded since the last call, and start again from empty."""
+
+        with self._lock:
+            values, self.values = self.values, {}
+
+        return values
+
+    def add_values(self, values: dict):
+        with self._lock:
+            for label_values, value in values.items():
+                self.values[label_values] = self.values.get(label_values, 0) + value
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        label_values = self.get_label_values(labels)
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[self.get_label_values(labels)] = value
+
+    def add_values(self, values: dict):
+        with self._lock:
+            self.values.update(values)
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=default_buckets):
+        super().__init__(name, documentation, label_names)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        label_values = self.get_label_values(labels)
+        with self._lock:
+            histogram = self.values.setdefault(
+                label_values, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            )
+            for index, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def add_values(self, values: dict):
+        with self._lock:
+            for label_values, added in values.items():
+                histogram = self.values.setdefault(
+                    label_values, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                )
+                histogram["buckets"] = [
+                    count + added_count for count, added_count in zip(histogram["buckets"], added["buckets"])
+                ]
+                histogram["sum"] += added["sum"]
+                histogram["count"] += added["count"]
+
+    def render_value(self, label_values: tuple, histogram: dict) -> list:
+        lines = [
+            f"{self.name}_bucket{format_labels(self.label_names, label_values, bucket)} {count}"
+            for bucket, count in zip(self.buckets, histogram["buckets"])
+        ]
+        labels = format_labels(self.label_names, label_values)
+        lines += [
+            f"{self.name}_bucket{format_labels(self.label_names, label_values, '+Inf')} {histogram['count']}",
+            f"{self.name}_sum{labels} {histogram['sum']}",
+            f"{self.name}_count{labels} {histogram['count']}",
+        ]
+
+        return lines
+
+
+ip_getter_seconds = Histogram(
+    "syncddns_ip_getter_seconds", "Time to get the public IP from a getter server.", ("url",)
+)
+dns_lookup_seconds = Histogram(
+    "syncddns_dns_lookup_seconds", "Time to resolve a domain record.", ("resolver",)
+)
+update_request_seconds = Histogram(
+    "syncddns_update_request_seconds", "Time of the update requests sent to the providers.", ("provider",)
+)
+handler_results = Counter(
+    "syncddns_handler_results_total",
+    "Provider answers to the update requests (OK, CONTINUE, CANCEL).",
+    ("provider", "handler", "result"),
+)
+cycle_seconds = Histogram(
+    "syncddns_cycle_seconds", "Duration of a whole IP check cycle."
+)
+public_ip_change_time = Gauge(
+    "syncddns_public_ip_change_timestamp_seconds",
+    "Unix time when the public IP was last seen changing.",
+    ("version",),
+)
+domain_handlers = Gauge(
+    "syncddns_domain_handlers", "Number of active domain handlers."
+)
+propagation_seconds = Histogram(
+    "syncddns_propagation_seconds",
+    "Time from an accepted update until the DNS answers the new IP.",
+    ("provider", "source"),
+    buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+propagation_timeouts = Counter(
+    "syncddns_propagation_timeouts_total",
+    "Accepted updates whose new IP wasn't answered by the resolvers before propagation_deadline.",
+    ("provider",),
+)
+provider_propagation_failing = Gauge(
+    "syncddns_provider_propagation_failing",
+    "1 while the provider's last accepted updates never reached its nameservers.",
+    ("provider",),
+)
+ha_leader = Gauge(
+    "syncddns_ha_leader", "1 while this instance holds the HA lease, 0 while standby."
+)
+
+registry = [
+    ip_getter_seconds,
+    dns_lookup_seconds,
+    update_request_seconds,
+    handler_results,
+    cycle_seconds,
+    public_ip_change_time,
+    domain_handlers,
+    propagation_seconds,
+    propagation_timeouts,
+    provider_propagation_failing,
+    ha_leader,
+]
+
+
+# Only recorded by the shard workers, sent to the parent with every cycle result.
+# The parent counts the handler results and cycles itself.
+shard_registry = [
+    dns_lookup_seconds,
+    update_request_seconds,
+]
+
+
+def take_shard_values() -> dict:
+    """The values of shard_registry recorded since the last call, in a shard worker."""
+
+    return {metric.name: metric.take_values() for metric in shard_registry}
+
+
+def add_shard_values(shard_values: dict):
+    """Add the values sent by a shard worker, in the parent."""
+
+    for metric in shard_registry:
+        metric.add_values(shard_values.get(metric.name, {}))
+
+
+def render() -> str:
+    """Return every metric in the Prometheus text format."""
+
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: str):
+    """Write the metrics for the node_exporter textfile collector."""
+
+    try:
+        write_file_atomic(path, render())
+    except OSError as error:
+        logger.error(f"Can't write the metrics to {path}")
+        logger.debug("Error: %s", error)
+
+
+def start_http_exporter(port: int, address: str = "127.0.0.1"):
+    """Serve the metrics on http://address:port/metrics from a background thread."""
+
+    # Imported here, http.server is slow to import and only the daemon serves the metrics
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("Metrics exporter - %s - %s", self.address_string(), format % args)
+
+    server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    threading.Thread(
+        target=server.serve_forever, name="metrics_exporter", daemon=True
+    ).start()
+    logger.info(f"Metrics available at http://{address}:{port}/metrics")
+
+    return server
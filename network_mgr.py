@@ -12,11 +12,19 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import logging
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
 
 import logger_mgr
-from nslookup import Nslookup
+import metrics_mgr
+from dns_cache import DNSCache
+from dns_client import DNSClient
+from health_mgr import HealthMgr
+from http_mgr import HttpMgr
 
 logger = logger_mgr.initialize_logger(__name__)
 user_agent = {"User-Agent": "JDavid SyncDDNS/Python davidaristi.0504@gmail.com"}
@@ -27,8 +35,30 @@ class NetworkMgr:
     dns_servers = []
     ipv4_servers = []
     ipv6_servers = []
-
-    def __new__(cls, dns_servers=None, ipv4_servers=None, ipv6_servers=None):
+    dns_concurrency = 64
+    dns_timeout = 5
+    dns_port = 53
+    dns_cache = DNSCache()
+    # Ask the zone's authoritative nameservers instead of dns_servers
+    dns_authoritative = False
+    # Zone of every domain and nameserver IPs of every zone, cached for their TTL
+    ns_cache = DNSCache(4096, 86400)
+    ip_getter_concurrency = 1
+    ip_getter_quorum = 1
+    getter_health = HealthMgr()
+    http = HttpMgr()
+    # Optional callable returning the IPv6 without asking the getters, e.g. IfaceWatcher
+    ipv6_source = None
+    # IPs pushed through the control API, used once instead of asking the getters
+    pushed_ips = {}
+
+    def __new__(
+        cls,
+        dns_servers=None,
+        ipv4_servers=None,
+        ipv6_servers=None,
+        **options,
+    ):
         if cls._instance is None:
             if dns_servers is None or ipv4_servers is None or ipv6_servers is None:
                 raise ValueError(
@@ -39,96 +69,414 @@ class NetworkMgr:
             cls.dns_servers = dns_servers
             cls.ipv4_servers = ipv4_servers
             cls.ipv6_servers = ipv6_servers
+            cls.configure(**options)
 
         return cls._instance
 
+    @classmethod
+    def configure(cls, **options):
+        """Set the optional settings (dns_timeout, ip_getter_quorum...), None keeps the default."""
+
+        for option, value in options.items():
+            if value is None:
+                continue
+
+            if option == "dns_cache_size":
+                cls.dns_cache = DNSCache(value)
+            elif hasattr(cls, option) and not option.startswith("_"):
+                setattr(cls, option, value)
+            else:
+                raise ValueError(f"Unknown NetworkMgr option - {option}")
+
     def get_current_IP(self, ipv6: bool = False):
         """Try to return the current host's ip."""
 
-        request_result = None
-        getters_url = self.ipv6_servers if ipv6 else self.ipv4_servers
-
-        for url in getters_url:
-            try:
-                request_result = requests.get(url, timeout=5, headers=user_agent)
-                if request_result.status_code == 200:
-                    ip_result = self.check_ip_validity(request_result.text.rstrip())
-                    if not ip_result:
-                        logger.error(
-                            f"Server {url} responded, but it wasn't a valid IP address!"
-                        )
-                        logger.debug(f"Response: {request_result.text.rstrip()}")
-                    else:
-                        return ip_result
-            except requests.exceptions.RequestException as error:
-                logger.error(
-                    f"Can't get current {'IPv6' if ipv6 else 'IPv4'} using the server {url}, "
-                    f"check the status of the server or your internet connection"
-                )
-                logger.debug(f"Error: {error}")
+        pushed_ip = self.pushed_ips.pop(ipv6, None)
+        if pushed_ip:
+            logger.info("Using the pushed %s - %s", "IPv6" if ipv6 else "IPv4", pushed_ip)
+            return pushed_ip
 
-        if request_result is None or request_result.status_code != 200:
+        if ipv6 and self.ipv6_source:
+            ip_result = self.check_ip_validity(self.ipv6_source())
+            if ip_result:
+                return ip_result
+
+        getters_url = self.getter_health.sort_servers(
+            self.ipv6_servers if ipv6 else self.ipv4_servers
+        )
+
+        if self.ip_getter_concurrency > 1 or self.ip_getter_quorum > 1:
+            ip_result = self.race_ip_getters(getters_url, ipv6)
+        else:
+            ip_result = None
+            for url in getters_url:
+                ip_result = self.request_ip_getter(url, ipv6)
+                if ip_result:
+                    break
+
+        if not ip_result:
             logger.warning(
                 f"Not valid results from get_current_IP({'IPv6' if ipv6 else 'IPv4'}), "
                 f"check if {'IPV6' if ipv6 else 'IPV4'}_GETTER servers are working as intended."
             )
 
-            return None
+        return ip_result
 
-    def get_current_dns_IPs(self, domain: str, ipv6: bool = False):
-        """Try to return the current domain's A or AAAA record."""
-        dns_query = Nslookup(dns_servers=self.dns_servers)
+    def race_ip_getters(self, getters_url: list, ipv6: bool = False):
+        """
+        Ask ip_getter_concurrency servers at the same time.
+
+        The first IP returned by ip_getter_quorum servers wins, the requests not started
+        yet are cancelled and the ones in flight are left to finish in the background.
+        """
+
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(self.ip_getter_concurrency, len(getters_url)))
+        )
+        pending_requests = [
+            executor.submit(self.request_ip_getter, url, ipv6) for url in getters_url
+        ]
+        ip_votes = {}
         ip_result = None
 
         try:
-            ip_result = (
-                dns_query.dns_lookup6(domain).answer
-                if ipv6
-                else dns_query.dns_lookup(domain).answer
+            for request in as_completed(pending_requests):
+                ip = request.result()
+                if not ip:
+                    continue
+
+                ip_votes[ip] = ip_votes.get(ip, 0) + 1
+                if ip_votes[ip] >= self.ip_getter_quorum:
+                    ip_result = ip
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if not ip_result and ip_votes:
+            logger.error(
+                f"The {'IPv6' if ipv6 else 'IPv4'}_GETTER servers didn't agree on the current IP, "
+                f"{self.ip_getter_quorum} equal answers needed: {ip_votes}"
             )
 
-            ip_result = (
-                self.check_ip_validity(ip_result[0]) if len(ip_result) > 0 else None
+        return ip_result
+
+    def request_ip_getter(self, url: str, ipv6: bool = False):
+        """Return the IP reported by the server url, or None if it isn't valid."""
+
+        ip_result = None
+        start_time = time.monotonic()
+
+        try:
+            request_result = self.http.request("GET", url, timeout=5, headers=user_agent)
+            if request_result.status_code == 200:
+                ip_result = self.check_ip_validity(request_result.text.rstrip())
+                if not ip_result:
+                    logger.error(
+                        f"Server {url} responded, but it wasn't a valid IP address!"
+                    )
+                    logger.debug("Response: %s", request_result.text.rstrip())
+        except requests.exceptions.RequestException as error:
+            logger.error(
+                f"Can't get current {'IPv6' if ipv6 else 'IPv4'} using the server {url}, "
+                f"check the status of the server or your internet connection"
             )
+            logger.debug("Error: %s", error)
 
-            if not ip_result:
-                logger.warning(f"Obtained no {'A' if not ipv6 else 'AAAA'} record for domain: {domain}")
-        except Exception as error:
-            ip_result = None
+        request_time = time.monotonic() - start_time
+        self.getter_health.record_result(url, bool(ip_result), request_time)
+        metrics_mgr.ip_getter_seconds.observe(request_time, url=url)
+
+        return ip_result
+
+    def get_current_IPs(self):
+        """Return the current host's (IPv4, IPv6), both looked up at the same time."""
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            ipv4_request = executor.submit(self.get_current_IP)
+            ipv6_request = executor.submit(self.get_current_IP, True)
+
+            return ipv4_request.result(), ipv6_request.result()
+
+    def get_current_dns_IPs(self, domain: str, ipv6: bool = False):
+        """Try to return the current domain's A or AAAA record."""
+
+        return self.resolve_dns_IPs([(domain, ipv6)])[(domain, ipv6)]
+
+    def resolve_dns_IPs(self, dns_queries):
+        """
+        Resolve a batch of domains, the ones not cached are asked at once over one socket.
+
+        Parameters:
+        dns_queries (iterable): (domain, ipv6) pairs to resolve, duplicates are resolved once.
+
+        Returns:
+        dict: (domain, ipv6) -> current IP of the record, or None if it couldn't be obtained.
+        """
+
+        ip_results = {}
+        questions = []
+        for domain, ipv6 in dict.fromkeys(dns_queries):
+            record_type = "AAAA" if ipv6 else "A"
+            ip_results[(domain, ipv6)] = self.dns_cache.get(domain, record_type)
+            if not ip_results[(domain, ipv6)]:
+                questions.append((domain, record_type))
+
+        if not questions:
+            return ip_results
+
+        dns_answers = {}
+        if self.dns_authoritative:
+            dns_answers = self.resolve_authoritative(questions)
+            # Unreachable nameservers or zone not found, ask the resolvers
+            questions = [question for question in questions if not dns_answers.get(question)]
+
+        if questions:
+            dns_client = DNSClient(
+                self.dns_servers, self.dns_port, self.dns_timeout, self.dns_concurrency
+            )
+            dns_answers.update(dns_client.resolve(questions))
+
+        for (domain, record_type), dns_answer in dns_answers.items():
+            ip_results[(domain, record_type == "AAAA")] = self.get_dns_answer_IP(
+                domain, record_type, dns_answer
+            )
+
+        return ip_results
+
+    def lookup_dns_IPs(self, dns_queries, authoritative: bool = False) -> dict:
+        """
+        Resolve dns_queries without the cache, e.g. to watch a new IP propagate.
+
+        Parameters:
+        authoritative (bool): ask the zone's nameservers instead of dns_servers.
+
+        Returns:
+        dict: (domain, ipv6) -> every IP of the record, None if the servers didn't answer.
+        """
+
+        questions = [(domain, "AAAA" if ipv6 else "A") for domain, ipv6 in dict.fromkeys(dns_queries)]
+        if authoritative:
+            dns_answers = self.resolve_authoritative(questions)
+        else:
+            dns_client = DNSClient(
+                self.dns_servers, self.dns_port, self.dns_timeout, self.dns_concurrency
+            )
+            dns_answers = dns_client.resolve(questions)
+
+        ip_results = {}
+        for domain, record_type in questions:
+            dns_answer = dns_answers.get((domain, record_type))
+            ip_results[(domain, record_type == "AAAA")] = (
+                [ip for ip, _ in dns_answer["answers"]] if dns_answer else None
+            )
+
+        return ip_results
+
+    def resolve_authoritative(self, questions: list) -> dict:
+        """
+        Ask the questions to the authoritative nameservers of their zones, without recursion.
+
+        Right after an update they already have the new IP, while the resolvers may
+        keep the old one until the TTL expires.
+
+        Returns:
+        dict: question -> DNSClient answer, None if the nameservers didn't answer.
+        """
+
+        nameservers = self.get_authoritative_nameservers(
+            list(dict.fromkeys(domain for domain, _ in questions))
+        )
+        zone_questions = {}
+        for question in questions:
+            zone_nameservers = nameservers.get(question[0])
+            if zone_nameservers:
+                zone_questions.setdefault(zone_nameservers, []).append(question)
+
+        def resolve_zone(zone_nameservers):
+            dns_client = DNSClient(
+                list(zone_nameservers),
+                self.dns_port,
+                self.dns_timeout,
+                self.dns_concurrency,
+                recursion=False,
+            )
+            return dns_client.resolve(zone_questions[zone_nameservers])
+
+        dns_answers = {}
+        if not zone_questions:
+            return dns_answers
+
+        # One burst per zone, an unreachable zone must not delay the others
+        with ThreadPoolExecutor(max_workers=min(len(zone_questions), 16)) as executor:
+            for zone_answers in executor.map(resolve_zone, zone_questions):
+                dns_answers.update(zone_answers)
+
+        return dns_answers
+
+    def get_authoritative_nameservers(self, domains: list) -> dict:
+        """
+        Return the IPs of the authoritative nameservers of every domain's zone.
+
+        The zone is the longest suffix of the domain having NS records, every suffix is
+        asked to dns_servers at once. Zones and nameservers are cached for their TTL.
+
+        Returns:
+        dict: domain -> tuple of nameserver IPs, missing if the zone wasn't found.
+        """
+
+        resolver = DNSClient(self.dns_servers, self.dns_port, self.dns_timeout, self.dns_concurrency)
+
+        zones = {}
+        suffixes = {}
+        for domain in domains:
+            zone = self.ns_cache.get(domain, "ZONE")
+            if zone:
+                zones[domain] = zone
+                continue
+            labels = domain.rstrip(".").lower().split(".")
+            # Longest first, the TLD alone is never the zone of a DDNS name
+            suffixes[domain] = [".".join(labels[index:]) for index in range(len(labels) - 1)]
+
+        ns_answers = {}
+        if suffixes:
+            ns_answers = resolver.resolve(
+                [(suffix, "NS") for domain_suffixes in suffixes.values() for suffix in domain_suffixes]
+            )
+            for domain, domain_suffixes in suffixes.items():
+                # "." when no zone was found, the resolvers are used for a while
+                zones[domain] = "."
+                for suffix in domain_suffixes:
+                    ns_answer = ns_answers.get((suffix, "NS"))
+                    if ns_answer and ns_answer["answers"]:
+                        zones[domain] = suffix
+                        break
+                zone_ttl = 300
+                if zones[domain] != ".":
+                    zone_ttl = min(ttl for _, ttl in ns_answers[(zones[domain], "NS")]["answers"])
+                self.ns_cache.set(domain, "ZONE", zones[domain], zone_ttl)
+
+        zone_nameservers = {}
+        missing_zones = []
+        for zone in set(zones.values()) - {"."}:
+            zone_nameservers[zone] = self.ns_cache.get(zone, "NS")
+            if not zone_nameservers[zone]:
+                missing_zones.append(zone)
+
+        if missing_zones:
+            ns_answers.update(
+                resolver.resolve(
+                    [(zone, "NS") for zone in missing_zones if not ns_answers.get((zone, "NS"))]
+                )
+            )
+            ns_names = {
+                zone: ns_answers[(zone, "NS")]["answers"]
+                for zone in missing_zones
+                if ns_answers.get((zone, "NS"))
+            }
+            ip_answers = resolver.resolve(
+                [(name, "A") for answers in ns_names.values() for name, _ in answers]
+            )
+            for zone, answers in ns_names.items():
+                ips = []
+                ttls = []
+                for name, ns_ttl in answers:
+                    ip_answer = ip_answers.get((name, "A"))
+                    for ip, ttl in ip_answer["answers"] if ip_answer else []:
+                        ips.append(ip)
+                        ttls.append(min(ns_ttl, ttl))
+                if ips:
+                    zone_nameservers[zone] = tuple(ips)
+                    self.ns_cache.set(zone, "NS", zone_nameservers[zone], min(ttls))
+
+        return {
+            domain: zone_nameservers[zone]
+            for domain, zone in zones.items()
+            if zone_nameservers.get(zone)
+        }
+
+    def get_dns_answer_IP(self, domain: str, record_type: str, dns_answer: dict):
+        """Return the first valid IP of a DNSClient answer and cache it."""
+
+        if dns_answer is None:
             logger.error(
-                f"An error occurred while requesting domain {'A' if not ipv6 else 'AAAA'} record: {domain}"
+                f"An error occurred while requesting domain {record_type} record: {domain}"
             )
-            logger.debug(f"Error: {error}")
+            return None
+
+        metrics_mgr.dns_lookup_seconds.observe(
+            dns_answer["seconds"], resolver=dns_answer["server"]
+        )
+
+        ip_result = None
+        for ip, _ in dns_answer["answers"]:
+            ip_result = self.check_ip_validity(ip)
+            if ip_result:
+                break
+
+        if not ip_result:
+            logger.warning("Obtained no %s record for domain: %s", record_type, domain)
+            return None
+
+        self.dns_cache.set(
+            domain, record_type, ip_result, min(ttl for _, ttl in dns_answer["answers"])
+        )
 
         return ip_result
 
+    def invalidate_dns_cache(self, domains: list):
+        for domain in domains:
+            self.dns_cache.invalidate(domain)
+
     def request_ip_update(self, query_url: str, request_method: str, query_headers: dict, query_data: dict):
         try:
-            headers = user_agent
-            if query_headers:
-                headers.update(query_headers)
+            # Never modify user_agent, the headers of a provider must not leak into the next one
+            headers = {**user_agent, **(query_headers or {})}
 
             response = None
 
-            if request_method == "PATCH":
-                response = requests.patch(query_url, timeout=5, headers=headers, json=query_data)
+            if request_method in ("PATCH", "POST"):
+                response = self.http.request(
+                    request_method, query_url, timeout=5, headers=headers, json=query_data
+                )
             else:
-                response = requests.get(query_url, timeout=5, headers=headers)  
+                response = self.http.request("GET", query_url, timeout=5, headers=headers)
 
-            logger.debug(
-                f"request_ip_update - Request: {query_url, headers, query_data}"
-            )
-            logger.debug(
-                f"request_ip_update - Code: {response.status_code} - response: {response.text}"
-            )
-            
-            return {"status_code": response.status_code, "response_text": response.text}
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "request_ip_update - Request: %s", (query_url, headers, query_data)
+                )
+                logger.debug(
+                    "request_ip_update - Code: %s - response: %s",
+                    response.status_code,
+                    response.text,
+                )
+
+            return {
+                "status_code": response.status_code,
+                "response_text": response.text,
+                # Retry-After of 429 and 503 answers, see retry_mgr
+                "headers": response.headers,
+            }
         except requests.exceptions.RequestException as error:
             response = None
-            logger.error(f"request_ip_update - Error while requesting IP update")
-            logger.debug(f"Error: {error}")
+            logger.error("request_ip_update - Error while requesting IP update")
+            logger.debug("Error: %s", error)
+
+            return {
+                "status_code": 500,
+                "response_text": "",
+                "headers": {},
+                "error": "timeout" if isinstance(error, requests.exceptions.Timeout) else "connection",
+            }
+
+    def push_ip(self, ip: str) -> bool:
+        """Use ip on the next lookup of its version instead of asking the getters."""
+
+        if not self.check_ip_validity(ip):
+            return False
 
-            return {"status_code": 500, "response_text": ""}
+        self.pushed_ips[":" in ip] = ip
+        return True
 
     def check_ip_validity(self, ip: str) -> str | None:
         """
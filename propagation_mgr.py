@@ -0,0 +1,228 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import ipaddress
+import statistics
+import threading
+import time
+from collections import deque
+
+import logger_mgr
+import metrics_mgr
+
+logger = logger_mgr.initialize_logger(__name__)
+
+# Where the new IP is looked for, and whether it's asked to the zone's nameservers
+propagation_sources = (("authoritative", True), ("resolvers", False))
+
+
+def normalize_ip(ip: str):
+    try:
+        return str(ipaddress.ip_address(ip))
+    except ValueError:
+        return None
+
+
+class PropagationMgr:
+    """
+    Watch the accepted updates until the DNS answers the new IP.
+
+    Every updated record is asked in the background to the zone's nameservers and to
+    dns_servers, initial_delay seconds after the update and then with exponential
+    backoff, until the resolvers answer the new IP or deadline seconds pass. The time
+    taken by each source is recorded per provider. A provider whose nameservers didn't
+    answer the new IP of failure_threshold updates in a row is flagged.
+    """
+
+    def __init__(
+        self,
+        lookup_dns_IPs,
+        deadline: float = 600,
+        initial_delay: float = 2,
+        max_delay: float = 60,
+        failure_threshold: int = 3,
+    ):
+        # NetworkMgr().lookup_dns_IPs, called from the verifier thread only
+        self.lookup_dns_IPs = lookup_dns_IPs
+        self.deadline = deadline
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        # (domain, ipv6) -> record being watched, a newer update replaces it
+        self.records = {}
+        # provider -> propagation results
+        self.providers = {}
+        self._condition = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.run, name="propagation", daemon=True).start()
+
+    def track(self, domain_handler, ipv4: str, ipv6: str, record_types: list):
+        """
+        Watch the records of record_types just updated by domain_handler, it never waits for the DNS.
+
+        Only the record types whose IP changed are watched, the others would be seen
+        propagated right away.
+        """
+
+        updated_at = time.monotonic()
+        ips = (
+            (False, normalize_ip(ipv4) if ipv4 and "A" in record_types else None),
+            (True, normalize_ip(ipv6) if ipv6 and "AAAA" in record_types else None),
+        )
+        with self._condition:
+            for domain in domain_handler.domains:
+                for ipv6_record, ip in ips:
+                    if not ip:
+                        continue
+                    self.records[(domain, ipv6_record)] = {
+                        "provider": domain_handler.provider,
+                        "ip": ip,
+                        "updated_at": updated_at,
+                        "next_check": updated_at + self.initial_delay,
+                        "attempt": 0,
+                        # source -> seconds until it answered the new IP
+                        "seen": {},
+                    }
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            due_records = self.wait_due_records()
+            try:
+                self.check_records(due_records)
+            except Exception as error:
+                logger.exception(f"Error while checking the propagation: {error}")
+                with self._condition:
+                    for key, record in due_records.items():
+                        record["next_check"] = time.monotonic() + self.max_delay
+
+    def wait_due_records(self) -> dict:
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                next_check = min((record["next_check"] for record in self.records.values()), default=None)
+                if next_check is not None and next_check <= now:
+                    return {
+                        key: record
+                        for key, record in self.records.items()
+                        if record["next_check"] <= now
+                    }
+                self._condition.wait(None if next_check is None else next_check - now)
+
+    def check_records(self, due_records: dict):
+        # Every source is asked the whole batch at once
+        source_answers = {}
+        for source, authoritative in propagation_sources:
+            dns_queries = [key for key, record in due_records.items() if source not in record["seen"]]
+            if dns_queries:
+                source_answers[source] = self.lookup_dns_IPs(dns_queries, authoritative)
+
+        now = time.monotonic()
+        with self._condition:
+            for key, record in due_records.items():
+                if self.records.get(key) is not record:
+                    # Updated again meanwhile, the new record is watched instead
+                    continue
+
+                for source, answers in source_answers.items():
+                    ips = answers.get(key) or []
+                    if source not in record["seen"] and record["ip"] in map(normalize_ip, ips):
+                        record["seen"][source] = now - record["updated_at"]
+                        metrics_mgr.propagation_seconds.observe(
+                            record["seen"][source], provider=record["provider"], source=source
+                        )
+
+                if "resolvers" in record["seen"] or now - record["updated_at"] >= self.deadline:
+                    del self.records[key]
+                    self.finish_record(key, record)
+                else:
+                    record["attempt"] += 1
+                    record["next_check"] = now + min(
+                        self.max_delay, self.initial_delay * 2 ** record["attempt"]
+                    )
+
+    def finish_record(self, key: tuple, record: dict):
+        provider = record["provider"]
+        domain, ipv6 = key
+        record_name = f"{provider} - {domain} {'AAAA' if ipv6 else 'A'}"
+        seen = record["seen"]
+        stats = self.providers.setdefault(
+            provider,
+            {
+                "propagated": 0,
+                "timed_out": 0,
+                "consecutive_failures": 0,
+                "flagged": False,
+                "recent_seconds": deque(maxlen=100),
+            },
+        )
+
+        if "resolvers" in seen:
+            stats["propagated"] += 1
+            stats["recent_seconds"].append(seen["resolvers"])
+            logger.info(
+                f"{record_name} propagated in {round(seen['resolvers'], 1)} seconds"
+                + (f", {round(seen['authoritative'], 1)} on its nameservers" if "authoritative" in seen else "")
+            )
+        else:
+            stats["timed_out"] += 1
+            metrics_mgr.propagation_timeouts.inc(provider=provider)
+            if "authoritative" in seen:
+                logger.warning(
+                    f"{record_name} is {record['ip']} on its nameservers since {round(seen['authoritative'], 1)} "
+                    f"seconds, the resolvers still answer the old IP after {self.deadline} seconds"
+                )
+            else:
+                logger.warning(f"{record_name} still isn't {record['ip']} after {self.deadline} seconds")
+
+        if seen:
+            if stats["flagged"]:
+                logger.info(f"{provider} propagates its updates again")
+            stats["consecutive_failures"] = 0
+            stats["flagged"] = False
+        else:
+            stats["consecutive_failures"] += 1
+            if stats["consecutive_failures"] >= self.failure_threshold and not stats["flagged"]:
+                stats["flagged"] = True
+                logger.error(
+                    f"{provider} accepted {stats['consecutive_failures']} updates in a row that never "
+                    "reached the DNS, check the provider's status and the domain settings"
+                )
+        metrics_mgr.provider_propagation_failing.set(1 if stats["flagged"] else 0, provider=provider)
+
+    def get_status(self) -> dict:
+        """Propagation results per provider, for the control API."""
+
+        with self._condition:
+            status = {
+                provider: {
+                    "propagated": stats["propagated"],
+                    "timed_out": stats["timed_out"],
+                    "flagged": stats["flagged"],
+                    "median_seconds": (
+                        statistics.median(stats["recent_seconds"]) if stats["recent_seconds"] else None
+                    ),
+                    "watching": 0,
+                }
+                for provider, stats in self.providers.items()
+            }
+            for record in self.records.values():
+                provider_status = status.setdefault(
+                    record["provider"],
+                    {"propagated": 0, "timed_out": 0, "flagged": False, "median_seconds": None, "watching": 0},
+                )
+                provider_status["watching"] += 1
+
+        return status
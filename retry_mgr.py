@@ -0,0 +1,138 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import email.utils
+import random
+import threading
+import time
+
+import logger_mgr
+
+logger = logger_mgr.initialize_logger(__name__)
+
+# Status codes worth asking again soon, the others won't change by retrying
+retryable_status_codes = (408, 429, 500, 502, 503, 504)
+# No-IP answers 911 on its own errors, and asks to wait 30 minutes before trying again
+noip_error_retry_after = 1800
+
+
+def get_retry_after(response: dict):
+    """
+    Tell whether a failed update request is worth retrying soon.
+
+    Returns:
+    float | None: the minimum seconds to wait before retrying, 0 if the provider didn't
+    ask for any, None if retrying won't help.
+    """
+
+    if response.get("error"):
+        # Timeouts and connection errors
+        return 0
+
+    # One line per hostname, see update_planner
+    response_lines = str(response.get("response_text") or "").split()
+    if response_lines and all(line == "911" for line in response_lines):
+        return max(
+            noip_error_retry_after,
+            parse_retry_after((response.get("headers") or {}).get("Retry-After")),
+        )
+
+    if response["status_code"] not in retryable_status_codes:
+        return None
+
+    return parse_retry_after((response.get("headers") or {}).get("Retry-After"))
+
+
+def parse_retry_after(value) -> float:
+    """Seconds asked by a Retry-After header, in seconds or as an HTTP date."""
+
+    if not value:
+        return 0
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+
+def get_backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """Exponential backoff with jitter, so the handlers failing together don't retry together."""
+
+    return min(max_delay, base_delay * 2**attempt) * random.uniform(0.5, 1)
+
+
+class RetryMgr:
+    """
+    Check again soon the handlers whose update failed for a transient reason.
+
+    A retry is a one-off job of the scheduler, so the other handlers keep their pace
+    while it waits. Every handler is retried up to attempts times in a row, and every
+    retry takes one token of the retry budget of the handler's token or account
+    (RATE_LIMITS retries_per_hour).
+    """
+
+    def __init__(self, scheduler, attempts: int = 3, base_delay: float = 5, max_delay: float = 300):
+        self.scheduler = scheduler
+        # handler_id -> retries scheduled in a row
+        self.handler_attempts = {}
+        self._lock = threading.Lock()
+        self.configure(attempts, base_delay, max_delay)
+
+    def configure(self, attempts: int = 3, base_delay: float = 5, max_delay: float = 300):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def schedule(self, domain_handler, retry_after: float):
+        """Schedule a retry of domain_handler, return its delay, None if it waits for the next loop."""
+
+        if self.attempts <= 0:
+            return None
+
+        with self._lock:
+            attempt = self.handler_attempts.get(domain_handler.handler_id, 0)
+            if attempt >= self.attempts:
+                self.handler_attempts.pop(domain_handler.handler_id, None)
+                logger.warning(
+                    f"{domain_handler.provider} - {domain_handler.domains} still failing after "
+                    f"{attempt} retries, trying on next loop..."
+                )
+                return None
+
+            if not self.scheduler.acquire_retry(domain_handler.provider, domain_handler.get_credential()):
+                logger.warning(
+                    f"{domain_handler.provider} - {domain_handler.domains} retry budget exhausted (RATE_LIMITS), "
+                    "trying on next loop..."
+                )
+                return None
+
+            self.handler_attempts[domain_handler.handler_id] = attempt + 1
+
+        delay = max(retry_after, get_backoff_delay(attempt, self.base_delay, self.max_delay))
+        self.scheduler.schedule_retry(domain_handler, delay)
+        logger.info(
+            f"{domain_handler.provider} - {domain_handler.domains} retry {attempt + 1}/{self.attempts} "
+            f"in {round(delay, 1)} seconds"
+        )
+
+        return delay
+
+    def reset(self, handler_id: str):
+        with self._lock:
+            self.handler_attempts.pop(handler_id, None)
@@ -0,0 +1,295 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import heapq
+import itertools
+import threading
+import time
+
+import logger_mgr
+
+logger = logger_mgr.initialize_logger(__name__)
+
+# Update requests allowed per credential of a provider, overridden by RATE_LIMITS in the config
+default_rate_limits = {
+    "DUCKDNS": {"updates_per_hour": 12, "burst": 3},
+    "FREEDNS": {"updates_per_hour": 12, "burst": 3},
+    "NOIP": {"updates_per_hour": 4, "burst": 2},
+    "CLOUDFLARE": {"updates_per_hour": 600, "burst": 20},
+}
+
+# Retries of failed updates allowed per credential, see RetryMgr
+default_retry_limits = {"retries_per_hour": 12, "retry_burst": 3}
+
+# Jobs due within this many seconds are run in the same cycle
+job_grouping_window = 1
+
+
+class TokenBucket:
+    """Allow burst requests at once, refilled at updates_per_hour."""
+
+    def __init__(self, updates_per_hour: float, burst: int):
+        self.refill_rate = updates_per_hour / 3600
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate
+            )
+            self.last_refill = now
+
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+            return True
+
+    def take(self, count: int) -> int:
+        """Take up to count whole tokens at once, return how many were taken."""
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate
+            )
+            self.last_refill = now
+
+            taken = min(count, int(self.tokens))
+            self.tokens -= taken
+            return taken
+
+    def refund(self, count: int):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + count)
+
+
+class SchedulerMgr:
+    """
+    Decide when every handler has to be checked.
+
+    Handlers are grouped in jobs, one per provider, or one per handler when it sets its
+    own check_interval. Jobs are kept in a priority queue by due time, so the daemon
+    sleeps until the next job is due. wake() interrupts the sleep and runs every handler.
+    Retries are one-off jobs of a single handler.
+
+    Update budgets are kept per credential (token or account) of a provider, as the
+    providers count them, default_rate_limits unless RATE_LIMITS overrides them.
+    A shard worker has no budget of its own, it spends the updates granted by its
+    parent for the cycle, see grant_updates.
+    """
+
+    def __init__(self, default_interval: float, rate_limits: dict = None):
+        self.rate_limits = {}
+        self.buckets = {}
+        self.retry_buckets = {}
+        self.jobs = []
+        self.scheduled_jobs = set()
+        self.job_counter = itertools.count()
+        self.wake_event = threading.Event()
+        self.wake_all = False
+        # (provider, credential) -> updates granted by the parent, None out of a shard worker
+        self.update_grants = None
+        self._lock = threading.Lock()
+        self.configure(default_interval, rate_limits)
+
+    def configure(self, default_interval: float, rate_limits: dict = None):
+        """Set the intervals and limits, the budgets of the providers whose limits didn't change are kept."""
+
+        new_rate_limits = {
+            provider: dict(limits) for provider, limits in default_rate_limits.items()
+        }
+        for provider, limits in (rate_limits or {}).items():
+            new_rate_limits.setdefault(provider, {}).update(limits)
+
+        with self._lock:
+            self.default_interval = default_interval
+            for provider in set(self.rate_limits) | set(new_rate_limits):
+                if self.rate_limits.get(provider) != new_rate_limits.get(provider):
+                    for buckets in (self.buckets, self.retry_buckets):
+                        for bucket_key in [key for key in buckets if key[0] == provider]:
+                            del buckets[bucket_key]
+            self.rate_limits = new_rate_limits
+
+    def get_job_key(self, domain_handler):
+        if domain_handler.check_interval:
+            return ("handler", domain_handler.handler_id)
+        return ("provider", domain_handler.provider)
+
+    def get_interval(self, job_key, domain_handlers: list) -> float:
+        for domain_handler in domain_handlers:
+            if self.get_job_key(domain_handler) == job_key:
+                if domain_handler.check_interval:
+                    return domain_handler.check_interval
+                break
+
+        if job_key[0] == "provider":
+            return self.rate_limits.get(job_key[1], {}).get(
+                "check_interval", self.default_interval
+            )
+
+        return self.default_interval
+
+    def schedule_handlers(self, domain_handlers: list):
+        """Add a job, due now, for every handler not scheduled yet."""
+
+        now = time.monotonic()
+        with self._lock:
+            for domain_handler in domain_handlers:
+                job_key = self.get_job_key(domain_handler)
+                if job_key not in self.scheduled_jobs:
+                    self.scheduled_jobs.add(job_key)
+                    heapq.heappush(self.jobs, (now, next(self.job_counter), job_key))
+
+    def wait_due_handlers(self, domain_handlers: list) -> list:
+        """Sleep until the next job is due, then return the handlers to check."""
+
+        self.schedule_handlers(domain_handlers)
+
+        while True:
+            with self._lock:
+                timeout = self.jobs[0][0] - time.monotonic() if self.jobs else None
+
+            if timeout is not None and timeout <= 0:
+                break
+
+            if self.wake_event.wait(timeout):
+                with self._lock:
+                    self.wake_event.clear()
+                    wake_all, self.wake_all = self.wake_all, False
+                if not wake_all:
+                    return []
+                logger.info("Woken up, checking every domain now")
+                return list(domain_handlers)
+
+        now = time.monotonic()
+        due_jobs = {}
+        with self._lock:
+            while self.jobs and self.jobs[0][0] <= now + job_grouping_window:
+                due_time, _, job_key = heapq.heappop(self.jobs)
+                due_jobs[job_key] = due_time
+
+            for job_key, due_time in due_jobs.items():
+                if job_key[0] == "retry":
+                    continue
+                if any(self.get_job_key(handler) == job_key for handler in domain_handlers):
+                    # Keep the job's own pace even when run a bit early with other jobs
+                    next_due = max(due_time, now) + self.get_interval(job_key, domain_handlers)
+                    heapq.heappush(self.jobs, (next_due, next(self.job_counter), job_key))
+                else:
+                    # The handlers of the job were removed
+                    self.scheduled_jobs.discard(job_key)
+
+        return [
+            domain_handler
+            for domain_handler in domain_handlers
+            if self.get_job_key(domain_handler) in due_jobs
+            or ("retry", domain_handler.handler_id) in due_jobs
+        ]
+
+    def schedule_retry(self, domain_handler, delay: float):
+        """Check domain_handler once in delay seconds, out of its job's pace."""
+
+        with self._lock:
+            heapq.heappush(
+                self.jobs,
+                (time.monotonic() + delay, next(self.job_counter), ("retry", domain_handler.handler_id)),
+            )
+
+    def get_next_run(self):
+        """Seconds until the next job is due, None if there are no jobs."""
+
+        with self._lock:
+            if not self.jobs:
+                return None
+            return max(0, self.jobs[0][0] - time.monotonic())
+
+    def wake(self, check_all: bool = True):
+        """Interrupt the sleep, with check_all every handler is checked, else it only returns."""
+
+        with self._lock:
+            self.wake_all = self.wake_all or check_all
+            self.wake_event.set()
+
+    def get_update_bucket(self, provider: str, credential: str = None):
+        """The credential's update budget, None if the provider's updates aren't limited."""
+
+        with self._lock:
+            limits = self.rate_limits.get(provider, {})
+            if "updates_per_hour" not in limits and "burst" not in limits:
+                return None
+
+            bucket = self.buckets.get((provider, credential))
+            if bucket is None:
+                bucket = TokenBucket(
+                    limits.get("updates_per_hour", 60), limits.get("burst", 1)
+                )
+                self.buckets[(provider, credential)] = bucket
+
+        return bucket
+
+    def acquire_update(self, provider: str, credential: str = None) -> bool:
+        """Take one update request from the credential's budget, False if it is exhausted."""
+
+        with self._lock:
+            if self.update_grants is not None:
+                granted = self.update_grants.get((provider, credential), 0)
+                if granted <= 0:
+                    return False
+                self.update_grants[(provider, credential)] = granted - 1
+                return True
+
+        bucket = self.get_update_bucket(provider, credential)
+        return bucket is None or bucket.try_acquire()
+
+    def grant_updates(self, provider: str, credential: str, count: int) -> int:
+        """Take up to count updates from the credential's budget for a shard worker."""
+
+        bucket = self.get_update_bucket(provider, credential)
+        return count if bucket is None else bucket.take(count)
+
+    def refund_updates(self, provider: str, credential: str, count: int):
+        """Give back the updates a shard worker didn't send."""
+
+        bucket = self.get_update_bucket(provider, credential)
+        if bucket is not None and count > 0:
+            bucket.refund(count)
+
+    def set_update_grants(self, update_grants: dict):
+        """Spend only these updates until the next call, in a shard worker."""
+
+        with self._lock:
+            self.update_grants = dict(update_grants)
+
+    def take_update_grants(self) -> dict:
+        """Return the granted updates left unsent."""
+
+        with self._lock:
+            return {key: granted for key, granted in (self.update_grants or {}).items() if granted > 0}
+
+    def acquire_retry(self, provider: str, credential: str = None) -> bool:
+        """Take one retry from the credential's retry budget, False if it is exhausted."""
+
+        with self._lock:
+            bucket = self.retry_buckets.get((provider, credential))
+            if bucket is None:
+                limits = {**default_retry_limits, **self.rate_limits.get(provider, {})}
+                bucket = TokenBucket(limits["retries_per_hour"], limits["retry_burst"])
+                self.retry_buckets[(provider, credential)] = bucket
+
+        return bucket.try_acquire()
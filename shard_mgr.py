@@ -0,0 +1,328 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import atexit
+import hashlib
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+
+import logger_mgr
+import metrics_mgr
+
+logger = logger_mgr.initialize_logger(__name__)
+
+
+def get_shard(handler_key: bytes, shard_count: int) -> int:
+    """
+    Return the shard of the handler using rendezvous hashing.
+
+    handler_key is the get_domain_handler_key of its entry, unique unlike the handler_id.
+
+    A handler keeps its shard when other handlers are added or removed, and only
+    1/shard_count of them move when a shard is added, so the worker caches stay warm.
+    """
+
+    return max(
+        range(shard_count),
+        key=lambda shard: hashlib.blake2b(
+            f"{shard}:".encode() + handler_key, digest_size=8
+        ).digest(),
+    )
+
+
+def get_shard_path(path: str, shard: int) -> str:
+    """state.json -> state.shard0.json"""
+
+    root, extension = os.path.splitext(path)
+    return f"{root}.shard{shard}{extension}"
+
+
+def shard_worker(
+    shard: int, shard_count: int, task_queue, result_connection, log_queue, paths: dict
+):
+    # The parent writes the logs, so the log file is rotated by one process only
+    logger_mgr.forward_to_queue(log_queue)
+
+    # Imported here, sync_ddns imports this module
+    import sync_ddns
+
+    # A spawned worker imports sync_ddns again, with the default paths
+    for name, path in paths.items():
+        setattr(sync_ddns, name, path)
+
+    sync_ddns.load_config(shard=(shard, shard_count))
+    scheduler = sync_ddns.config_settings["scheduler"]
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        if task == "RELOAD":
+            sync_ddns.reload_config()
+            continue
+
+        (
+            cycle_id,
+            log_cycle_id,
+            handler_keys,
+            current_ipv4,
+            current_ipv6,
+            fencing_token,
+            update_grants,
+        ) = task
+        logger_mgr.cycle_id.set(log_cycle_id)
+        # The updates are only sent while the parent's HA lease holds
+        sync_ddns.config_settings["fencing_token"] = fencing_token
+        # and within the budgets of its scheduler
+        scheduler.set_update_grants(update_grants)
+        domain_handler_keys = sync_ddns.config_settings["domain_handler_keys"]
+        domain_handlers = [
+            domain_handler_keys[handler_key]
+            for handler_key in handler_keys
+            if handler_key in domain_handler_keys
+        ]
+        handler_key_of = {
+            domain_handler: handler_key
+            for handler_key, domain_handler in domain_handler_keys.items()
+        }
+
+        try:
+            handler_results = sync_ddns.run_ip_check_cycle(
+                domain_handlers, (current_ipv4, current_ipv6)
+            )
+            shard_results = [
+                (
+                    handler_key_of[domain_handler],
+                    result,
+                    sync_ddns.config_settings["retry_hints"].pop(domain_handler.handler_id, None),
+                    sync_ddns.config_settings["updated_record_types"].pop(
+                        domain_handler.handler_id, None
+                    ),
+                )
+                for domain_handler, result in handler_results.items()
+            ]
+        except Exception as error:
+            logger.exception(f"Shard {shard} - Error while running the cycle: {error}")
+            shard_results = []
+
+        # The unsent updates go back to the parent's budgets, the metrics to its /metrics
+        result_connection.send(
+            (
+                cycle_id,
+                shard,
+                shard_results,
+                scheduler.take_update_grants(),
+                metrics_mgr.take_shard_values(),
+            )
+        )
+
+
+class ShardMgr:
+    """
+    Spread the handlers over shard_count worker processes.
+
+    Every worker builds and keeps the handlers of its shard, the public IPs are looked up
+    once by the parent and sent with every cycle, with the updates each worker may send
+    from the parent's RATE_LIMITS budgets. The first workers are forked, so they must be
+    started before any other thread, a dead worker is replaced by a spawned one.
+
+    Every worker has its own queues and result pipe, a killed worker can't leave the
+    others blocked on a lock it held.
+
+    paths are the sync_ddns module paths (config_path, state_path...) the workers use.
+    """
+
+    def __init__(self, shard_count: int, cycle_timeout: float = 600, paths: dict = None):
+        self.shard_count = shard_count
+        self.cycle_timeout = cycle_timeout
+        self.paths = paths or {}
+        self.fork_context = multiprocessing.get_context("fork")
+        # Forking the parent once its threads run could copy their held locks
+        self.spawn_context = multiprocessing.get_context("spawn")
+        # shard -> (process, task queue, result connection, log queue)
+        self.workers = {}
+        self.cycle_id = 0
+
+    def start(self):
+        for shard in range(self.shard_count):
+            self.start_worker(shard, self.fork_context)
+        # Before multiprocessing closes the queues at exit
+        atexit.register(self.stop)
+
+    def start_worker(self, shard: int, context):
+        task_queue = context.Queue()
+        log_queue = context.Queue()
+        result_connection, worker_connection = context.Pipe(duplex=False)
+        worker = context.Process(
+            target=shard_worker,
+            args=(
+                shard,
+                self.shard_count,
+                task_queue,
+                worker_connection,
+                log_queue,
+                self.paths,
+            ),
+            name=f"sync_ddns_shard{shard}",
+            daemon=True,
+        )
+        worker.start()
+        # Only the worker writes, its death closes the pipe
+        worker_connection.close()
+        logger_mgr.listen(log_queue)
+        self.workers[shard] = (worker, task_queue, result_connection, log_queue)
+
+    def restart_worker(self, shard: int):
+        self.close_worker(*self.workers[shard])
+        self.start_worker(shard, self.spawn_context)
+
+    def close_worker(self, worker, task_queue, result_connection, log_queue):
+        worker.join(timeout=5)
+        result_connection.close()
+        if worker.exitcode != 0:
+            # Killed, the worker may have left its queues locked, they aren't flushed at exit
+            task_queue.cancel_join_thread()
+            log_queue.cancel_join_thread()
+        logger_mgr.stop_listening(log_queue, wait=worker.exitcode == 0)
+
+    def reload(self):
+        """Make every worker reload the config, they apply it before their next cycle."""
+
+        for _, task_queue, _, _ in self.workers.values():
+            task_queue.put("RELOAD")
+
+    def stop(self):
+        """Stop the workers once their current cycle ends, then write their last logs."""
+
+        workers, self.workers = self.workers, {}
+        for worker, task_queue, _, _ in workers.values():
+            if worker.is_alive():
+                task_queue.put(None)
+        for worker_queues in workers.values():
+            self.close_worker(*worker_queues)
+
+    def run_cycle(
+        self,
+        domain_handlers: list,
+        current_ipv4: str,
+        current_ipv6: str,
+        handler_keys: dict,
+        scheduler,
+        retry_hints: dict = None,
+        fencing_token: int = None,
+        updated_record_types: dict = None,
+    ):
+        """
+        Run a cycle of domain_handlers in their workers.
+
+        handler_keys is the get_domain_handler_key -> handler of every handler, the tasks
+        and results name the handlers by their key, the handler_ids may be shared.
+
+        Every worker gets the updates it may send from the budgets of scheduler, the
+        unsent ones are given back. The retry hints of the workers' failed updates are
+        added to retry_hints, the record types changed by their accepted ones to
+        updated_record_types. fencing_token is the HA lease token the updates are sent under.
+
+        Returns:
+        dict: domain_handler -> result, like run_ip_check_cycle.
+        """
+
+        self.cycle_id += 1
+        handler_key_of = {
+            domain_handler: handler_key for handler_key, domain_handler in handler_keys.items()
+        }
+        shard_handler_keys = {}
+        # shard -> (provider, credential) -> most update requests of its handlers
+        shard_requests = {}
+        for domain_handler in domain_handlers:
+            handler_key = handler_key_of[domain_handler]
+            shard = get_shard(handler_key, self.shard_count)
+            shard_handler_keys.setdefault(shard, set()).add(handler_key)
+            budget_key = (domain_handler.provider, domain_handler.get_credential())
+            requests = shard_requests.setdefault(shard, {})
+            # FreeDNS sends one request per IP type
+            requests[budget_key] = (
+                requests.get(budget_key, 0)
+                + 1
+                + bool(domain_handler.update_ipv4 and domain_handler.update_ipv6)
+            )
+
+        for shard, shard_keys in shard_handler_keys.items():
+            if not self.workers[shard][0].is_alive():
+                logger.error(f"Shard {shard} worker died, restarting it")
+                self.restart_worker(shard)
+            task_queue = self.workers[shard][1]
+            update_grants = {
+                budget_key: scheduler.grant_updates(*budget_key, requests)
+                for budget_key, requests in shard_requests[shard].items()
+            }
+            task_queue.put(
+                (
+                    self.cycle_id,
+                    logger_mgr.cycle_id.get(),
+                    shard_keys,
+                    current_ipv4,
+                    current_ipv6,
+                    fencing_token,
+                    update_grants,
+                )
+            )
+
+        handler_results = {}
+        # result connection -> shard
+        pending_shards = {self.workers[shard][2]: shard for shard in shard_handler_keys}
+        deadline = time.monotonic() + self.cycle_timeout
+        while pending_shards:
+            ready_connections = multiprocessing.connection.wait(
+                list(pending_shards), max(0, deadline - time.monotonic())
+            )
+            if not ready_connections:
+                logger.error(
+                    f"Shards {sorted(pending_shards.values())} didn't finish in {self.cycle_timeout} "
+                    "seconds, trying on next loop..."
+                )
+                break
+
+            for result_connection in ready_connections:
+                shard = pending_shards.pop(result_connection)
+                try:
+                    cycle_id, _, shard_results, unsent_updates, shard_values = (
+                        result_connection.recv()
+                    )
+                except EOFError:
+                    logger.error(f"Shard {shard} worker died during the cycle, trying on next loop...")
+                    continue
+
+                for budget_key, count in unsent_updates.items():
+                    scheduler.refund_updates(*budget_key, count)
+                metrics_mgr.add_shard_values(shard_values)
+                if cycle_id != self.cycle_id:
+                    # Late answer of a cycle that timed out, this one's comes next
+                    pending_shards[result_connection] = shard
+                    continue
+
+                for handler_key, result, retry_after, record_types in shard_results:
+                    domain_handler = handler_keys.get(handler_key)
+                    if domain_handler is None:
+                        # Removed by a reload during the cycle
+                        continue
+                    handler_results[domain_handler] = result
+                    if retry_after is not None and retry_hints is not None:
+                        retry_hints[domain_handler.handler_id] = retry_after
+                    if record_types and updated_record_types is not None:
+                        updated_record_types[domain_handler.handler_id] = record_types
+
+        return handler_results
@@ -0,0 +1,139 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+import logger_mgr
+
+logger = logger_mgr.initialize_logger(__name__)
+
+
+def write_file_atomic(path: str, content):
+    """Write content, str or bytes, to path, replacing the old file only once fully written."""
+
+    directory = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+    try:
+        with os.fdopen(file_descriptor, "wb" if isinstance(content, bytes) else "w") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def write_json_atomic(path: str, data):
+    write_file_atomic(path, json.dumps(data, indent=2, sort_keys=True))
+
+
+def read_json(path: str, default=None):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return default
+    except (OSError, json.JSONDecodeError) as error:
+        logger.warning(f"Can't read {path}, ignoring its content")
+        logger.debug("Error: %s", error)
+        return default
+
+
+class StateMgr:
+    """
+    Keep track of the last IP accepted by the provider for every handler and record type.
+
+    The state is saved to disk, so it survives restarts. While the pushed IP matches the
+    current one, the public DNS only needs to be checked every dns_verify_interval seconds.
+    """
+
+    _instance = None
+    state_path = None
+    dns_verify_interval = 3600
+    state = {}
+    _dirty = False
+    _lock = threading.Lock()
+
+    def __new__(cls, state_path=None, dns_verify_interval=None):
+        if cls._instance is None:
+            if state_path is None:
+                raise ValueError("state_path must be provided on the first instantiation.")
+
+            cls._instance = super(StateMgr, cls).__new__(cls)
+            cls.state_path = state_path
+            if dns_verify_interval is not None:
+                cls.dns_verify_interval = dns_verify_interval
+            cls.state = read_json(state_path, {})
+
+        return cls._instance
+
+    def get_record(self, handler_id: str, record_type: str):
+        return self.state.get(handler_id, {}).get(record_type)
+
+    def is_current(self, handler_id: str, record_type: str, ip: str) -> bool:
+        """True if ip was already pushed and verified within dns_verify_interval seconds."""
+
+        record = self.get_record(handler_id, record_type)
+        if not record or record["ip"] != ip:
+            return False
+
+        return time.time() - record["verified_at"] < self.dns_verify_interval
+
+    def set_record(self, handler_id: str, record_type: str, ip: str, pushed: bool = False):
+        """Save ip as the record's current value, pushed means the provider just accepted it."""
+
+        now = time.time()
+        with self._lock:
+            record = self.state.setdefault(handler_id, {}).get(record_type, {})
+            if pushed or record.get("ip") != ip:
+                record["updated_at"] = now
+            record["ip"] = ip
+            record["verified_at"] = now
+
+            self.state[handler_id][record_type] = record
+            self._dirty = True
+
+    def replace(self, state: dict):
+        """Take state as the whole update state, e.g. the one published by the HA leader."""
+
+        with self._lock:
+            self.state.clear()
+            self.state.update(state)
+            self._dirty = True
+
+    def forget(self, handler_id: str):
+        with self._lock:
+            if self.state.pop(handler_id, None) is not None:
+                self._dirty = True
+
+    def save(self):
+        """Write the state to disk if it changed since the last save."""
+
+        with self._lock:
+            if not self._dirty:
+                return
+
+            try:
+                write_json_atomic(self.state_path, self.state)
+                self._dirty = False
+            except OSError as error:
+                logger.error(f"Can't save the update state to {self.state_path}")
+                logger.debug("Error: %s", error)
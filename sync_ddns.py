@@ -12,134 +12,1103 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import argparse
+import contextvars
+import logging
 import os
+import secrets
+import signal
 import sys
+import threading
 import time
 
-import yaml
+# Measured by --timing, the modules below are the slow ones to import
+startup_start = time.perf_counter()
 
 import logger_mgr
+import metrics_mgr
+from config_mgr import ConfigError, ConfigWatcher, get_domain_handler_key, read_config
 from domain_mgr import DomainMgr
+from health_mgr import HealthMgr
+from http_mgr import HttpMgr
 from network_mgr import NetworkMgr
+from retry_mgr import RetryMgr, get_retry_after
+from scheduler_mgr import SchedulerMgr
+from state_mgr import StateMgr
+from update_planner import get_ip_type, plan_updates, result_severity
 
 logger = logger_mgr.initialize_logger("sync_ddns")
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 config_path = os.path.join(script_dir, "config.yaml")
+# The parsed config, reused while config.yaml doesn't change
+config_snapshot_path = os.path.join(script_dir, "config.snapshot")
+state_path = os.path.join(script_dir, "state.json")
+getter_health_path = os.path.join(script_dir, "getter_health.json")
 config_settings = None
+reload_requested = threading.Event()
+# Seconds taken by every startup step, printed with --timing
+startup_timings = {}
 
+# Exit codes of --once, an unexpected error exits with 1 too
+EXIT_OK = 0
+EXIT_CONFIG_ERROR = 1
+# Some domain couldn't be updated for now, or the public IPs are unknown
+EXIT_RETRY = 2
+# A provider rejected an update, check the credentials and domain names
+EXIT_REJECTED = 3
 
-def load_config():
-    """Load the configuration from the config.ini file."""
+# GENERAL settings only applied when the program starts
+restart_only_settings = (
+    "shards",
+    "watch_config",
+    "watch_interfaces",
+    "watch_debounce",
+    "ipv6_from_interface",
+    "metrics_port",
+    "metrics_address",
+    "control_port",
+    "control_address",
+    "control_token",
+    "control_debounce",
+    "ha_lease_path",
+    "ha_instance_id",
+    "ha_lease_duration",
+    "propagation_check",
+    "propagation_deadline",
+    "http_pool_size",
+    "http2",
+    "getter_failure_threshold",
+    "getter_cooldown",
+    "dns_verify_interval",
+)
+
+
+number = (int, float)
+# Type of every GENERAL setting, checked before any of the config is applied
+general_setting_types = {
+    "update_delay": number,
+    "hide_update_queries_on_logs": bool,
+    "continue_on_provider_fail": bool,
+    "log_level": str,
+    "dns_servers": list,
+    "ipv4_servers": list,
+    "ipv6_servers": list,
+    "engine": str,
+    "provider_concurrency": dict,
+    "cycle_deadline": number,
+    "shards": int,
+    "retry_attempts": int,
+    "retry_base_delay": number,
+    "retry_max_delay": number,
+    "ha_lease_path": str,
+    "ha_instance_id": str,
+    "ha_lease_duration": number,
+    "log_format": str,
+    "log_max_bytes": int,
+    "log_backup_count": int,
+    "log_rotate_when": str,
+    "async_logging": bool,
+    "metrics_port": int,
+    "metrics_address": str,
+    "metrics_textfile": str,
+    "control_port": int,
+    "control_address": str,
+    "control_token": str,
+    "control_debounce": number,
+    "http_pool_size": int,
+    "http2": bool,
+    "dns_concurrency": int,
+    "dns_timeout": number,
+    "dns_port": int,
+    "dns_cache_size": int,
+    "dns_authoritative": bool,
+    "dns_verify_interval": number,
+    "propagation_check": bool,
+    "propagation_deadline": number,
+    "watch_config": bool,
+    "watch_interfaces": list,
+    "watch_debounce": number,
+    "ipv6_from_interface": bool,
+    "ip_getter_concurrency": int,
+    "ip_getter_quorum": int,
+    "getter_failure_threshold": int,
+    "getter_cooldown": number,
+}
+# Settings that can be left empty, e.g. "metrics_textfile:"
+nullable_general_settings = (
+    "provider_concurrency",
+    "cycle_deadline",
+    "ha_lease_path",
+    "ha_instance_id",
+    "log_rotate_when",
+    "metrics_port",
+    "metrics_textfile",
+    "control_port",
+    "control_token",
+    "watch_interfaces",
+)
+# Numbers that must be above 0, the other ones can't be negative
+positive_general_settings = (
+    "update_delay",
+    "cycle_deadline",
+    "ha_lease_duration",
+    "http_pool_size",
+    "dns_concurrency",
+    "dns_timeout",
+    "dns_port",
+    "propagation_deadline",
+    "ip_getter_concurrency",
+    "ip_getter_quorum",
+    "getter_failure_threshold",
+)
+rate_limit_settings = ("check_interval", "updates_per_hour", "burst", "retries_per_hour", "retry_burst")
+
+
+def check_general_config(general: dict):
+    """Raise ConfigError if a GENERAL setting has the wrong type or value."""
+
+    for setting, setting_type in general_setting_types.items():
+        value = general.get(setting)
+        if value is None:
+            if setting in general and setting not in nullable_general_settings:
+                raise ConfigError(f"Empty GENERAL setting - {setting}")
+            continue
+
+        # bool is an int too, but "update_delay: yes" isn't a number
+        if not isinstance(value, setting_type) or (isinstance(value, bool) and setting_type is not bool):
+            raise ConfigError(f"Invalid {setting} - {value!r}")
+        if setting_type in (int, number) and (
+            value < 0 or (value == 0 and setting in positive_general_settings)
+        ):
+            raise ConfigError(f"Invalid {setting} - {value}")
+        if setting_type is list and not all(isinstance(item, str) for item in value):
+            raise ConfigError(f"Invalid {setting}, it must be a list of strings - {value}")
+
+    # The names accepted by Logger.setLevel, e.g. INFO
+    if not isinstance(logging.getLevelName(general["log_level"]), int):
+        raise ConfigError(f"Invalid log_level - {general['log_level']}")
+    engine = general.get("engine", "sequential")
+    if engine not in ("sequential", "async"):
+        raise ConfigError(f"Invalid engine - {engine}")
+    log_format = general.get("log_format", "text")
+    if log_format not in ("text", "json"):
+        raise ConfigError(f"Invalid log_format - {log_format}")
+    rotate_when = general.get("log_rotate_when") or "midnight"
+    if rotate_when.upper() not in ("S", "M", "H", "D", "MIDNIGHT") + tuple(f"W{day}" for day in range(7)):
+        raise ConfigError(f"Invalid log_rotate_when - {rotate_when}")
+    for provider, concurrency in (general.get("provider_concurrency") or {}).items():
+        if not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1:
+            raise ConfigError(f"Invalid provider_concurrency of {provider} - {concurrency!r}")
+
+
+def check_rate_limits(rate_limits):
+    """Raise ConfigError if RATE_LIMITS isn't a provider -> limits mapping of positive numbers."""
+
+    if rate_limits is None:
+        return
+    if not isinstance(rate_limits, dict):
+        raise ConfigError("Invalid RATE_LIMITS section")
+
+    for provider, limits in rate_limits.items():
+        if not isinstance(limits, dict):
+            raise ConfigError(f"Invalid RATE_LIMITS of {provider}")
+        for setting, value in limits.items():
+            if setting not in rate_limit_settings:
+                raise ConfigError(f"Unknown RATE_LIMITS setting of {provider} - {setting}")
+            if not isinstance(value, number) or isinstance(value, bool) or value <= 0:
+                raise ConfigError(f"Invalid RATE_LIMITS {setting} of {provider} - {value!r}")
+
+
+def get_general_settings(general: dict, shard: tuple = None) -> dict:
+    """The config_settings taken from GENERAL, they can change on reload."""
+
+    return {
+        "update_delay": general["update_delay"],
+        "hide_update_queries_on_logs": general["hide_update_queries_on_logs"],
+        "continue_on_provider_fail": general["continue_on_provider_fail"],
+        "dns_servers": general["dns_servers"],
+        "ipv4_servers": general["ipv4_servers"],
+        "ipv6_servers": general["ipv6_servers"],
+        "engine": general.get("engine", "sequential"),
+        "provider_concurrency": general.get("provider_concurrency", {}),
+        "cycle_deadline": general.get("cycle_deadline", None),
+        # Written by the parent only
+        "metrics_textfile": None if shard else general.get("metrics_textfile", None),
+    }
+
+
+def get_log_options(general: dict) -> dict:
+    """The logger_mgr.configure options of GENERAL."""
+
+    return {
+        "log_format": general.get("log_format", "text"),
+        "max_bytes": general.get("log_max_bytes", 10 * 1024 * 1024),
+        "backup_count": general.get("log_backup_count", 3),
+        "rotate_when": general.get("log_rotate_when", None),
+        "async_logging": general.get("async_logging", True),
+    }
+
+
+def get_retry_options(general: dict) -> dict:
+    """The RetryMgr options of GENERAL."""
+
+    return {
+        "attempts": general.get("retry_attempts", 3),
+        "base_delay": general.get("retry_base_delay", 5),
+        "max_delay": general.get("retry_max_delay", 300),
+    }
+
+
+def get_network_options(general: dict) -> dict:
+    """The NetworkMgr options of GENERAL, None keeps the current value."""
+
+    return {
+        "dns_concurrency": general.get("dns_concurrency"),
+        "dns_timeout": general.get("dns_timeout"),
+        "dns_port": general.get("dns_port"),
+        "dns_cache_size": general.get("dns_cache_size"),
+        "dns_authoritative": general.get("dns_authoritative"),
+        "ip_getter_concurrency": general.get("ip_getter_concurrency"),
+        "ip_getter_quorum": general.get("ip_getter_quorum"),
+    }
+
+
+def get_kept_config(config: dict) -> dict:
+    """The config without DOMAIN_INFO, the handlers hold everything needed from it."""
+
+    return {section: value for section, value in config.items() if section != "DOMAIN_INFO"}
+
+
+def build_domain_handlers(
+    config: dict, shard: tuple = None, current_handlers: dict = None, halted_keys: set = None
+) -> dict:
+    """
+    Create the handlers of DOMAIN_INFO, keyed by get_domain_handler_key.
+
+    The handlers of current_handlers whose entry didn't change are kept as they are,
+    with their caches and state. The entries of halted_keys, halted after a rejected
+    update, are left out until they are edited.
+    """
+
+    current_handlers = current_handlers or {}
+    halted_keys = halted_keys or set()
+    domain_handlers = {}
+    if shard:
+        from shard_mgr import get_shard
 
     try:
-        with open(config_path, "r") as file:
-            config = yaml.safe_load(file)
-    except FileNotFoundError:
-        logger.error(
-            "'config.yaml' not found. Please copy 'config.yaml.dev', "
-            "rename it to 'config.yaml', and then edit it with your own settings."
+        for domains_info in config["DOMAIN_INFO"]:
+            for domain_list in domains_info["domain_list"]:
+                provider = domains_info["provider"]
+                domain_data = domain_list["domain_data"]
+
+                key = get_domain_handler_key(provider, domain_data)
+                if key in domain_handlers:
+                    logger.warning(f"Duplicated {provider} entry - {domain_data.get('names')}")
+                    continue
+                if key in halted_keys:
+                    logger.info(
+                        f"{provider} - {domain_data.get('names')} stays halted after its rejected update, "
+                        "edit its entry to try again"
+                    )
+                    continue
+
+                domain_handler = current_handlers.get(key) or DomainMgr(provider, domain_data)
+                if shard and get_shard(key, shard[1]) != shard[0]:
+                    continue
+                domain_handlers[key] = domain_handler
+    except (KeyError, TypeError, AttributeError) as error:
+        raise ConfigError(f"Invalid DOMAIN_INFO entry - {error}")
+
+    return domain_handlers
+
+
+def load_config(shard: tuple = None, daemon: bool = True):
+    """
+    Load the configuration from the config.ini file.
+
+    shard is the (index, count) of a shard worker, only its handlers are loaded.
+    Without daemon (--once) the watchers and the HTTP servers aren't started.
+    """
+
+    load_start = time.perf_counter()
+    try:
+        config = read_config(config_path, config_snapshot_path)
+        general = config["GENERAL"]
+        check_general_config(general)
+        check_rate_limits(config.get("RATE_LIMITS"))
+        logger_mgr.set_log_level(general["log_level"])
+        startup_timings["read_config"] = time.perf_counter() - load_start
+        domain_handler_keys = build_domain_handlers(config, shard)
+        startup_timings["build_handlers"] = (
+            time.perf_counter() - load_start - startup_timings["read_config"]
         )
-        sys.exit(1)
+    except ConfigError as error:
+        logger.error(error)
+        sys.exit(EXIT_CONFIG_ERROR)
+
+    NetworkMgr(
+        general["dns_servers"],
+        general["ipv4_servers"],
+        general["ipv6_servers"],
+        **get_network_options(general),
+        getter_health=HealthMgr(
+            getter_health_path,
+            general.get("getter_failure_threshold", 3),
+            general.get("getter_cooldown", 900),
+        ),
+        http=HttpMgr(
+            general.get("http_pool_size", 4),
+            general.get("http2", False),
+        ),
+    )
+    dns_verify_interval = general.get("dns_verify_interval", 3600)
+    shard_mgr = None
+    shards = general.get("shards", 0)
+    if shard:
+        from shard_mgr import get_shard_path
+
+        # Forked from the parent, every shard keeps its own state file
+        StateMgr._instance = None
+        StateMgr(get_shard_path(state_path, shard[0]), dns_verify_interval)
+    else:
+        StateMgr(state_path, dns_verify_interval)
+
+        if shards > 1:
+            from shard_mgr import ShardMgr
 
-    update_delay = config["GENERAL"]["update_delay"]
-    hide_update_queries_on_logs = config["GENERAL"]["hide_update_queries_on_logs"]
-    continue_on_provider_fail = config["GENERAL"]["continue_on_provider_fail"]
-    logger_mgr.set_log_level(config["GENERAL"]["log_level"])
-    dns_servers = config["GENERAL"]["dns_servers"]
-    ipv4_servers = config["GENERAL"]["ipv4_servers"]
-    ipv6_servers = config["GENERAL"]["ipv6_servers"]
+            # Forked now, before any thread is started
+            shard_mgr = ShardMgr(
+                shards,
+                general.get("cycle_deadline") or 600,
+                {
+                    "config_path": config_path,
+                    "config_snapshot_path": config_snapshot_path,
+                    "state_path": state_path,
+                    "getter_health_path": getter_health_path,
+                },
+            )
+            shard_mgr.start()
 
-    NetworkMgr(dns_servers, ipv4_servers, ipv6_servers)
+    if not shard:
+        logger_mgr.configure(**get_log_options(general))
 
-    domain_handlers = []
+    scheduler = SchedulerMgr(general["update_delay"], config.get("RATE_LIMITS") or {})
 
-    for domains_info in config["DOMAIN_INFO"]:
-        for domain_list in domains_info["domain_list"]:
-            provider = domains_info["provider"]
-            domain_data = domain_list["domain_data"]
+    lease_mgr = None
+    if general.get("ha_lease_path", None):
+        from lease_mgr import LeaseMgr
 
-            domain_handlers.append(DomainMgr(provider, domain_data))
+        try:
+            lease_mgr = LeaseMgr(
+                general["ha_lease_path"],
+                general.get("ha_instance_id", None),
+                general.get("ha_lease_duration", 30),
+                on_leadership_change,
+            )
+        except ConfigError as error:
+            logger.error(error)
+            sys.exit(EXIT_CONFIG_ERROR)
 
     # Set the settings as a dictionary
     global config_settings
     config_settings = {
-        "update_delay": update_delay,
-        "hide_update_queries_on_logs": hide_update_queries_on_logs,
-        "continue_on_provider_fail": continue_on_provider_fail,
-        "dns_servers": dns_servers,
-        "ipv4_servers": ipv4_servers,
-        "ipv6_servers": ipv6_servers,
-        "domain_handlers": domain_handlers,
+        **get_general_settings(general, shard),
+        "domain_handlers": list(domain_handler_keys.values()),
+        "domain_handler_keys": domain_handler_keys,
+        # Keys of the handlers halted after a rejected update, see halt_domain_handler
+        "halted_handler_keys": set(),
+        "config": get_kept_config(config),
+        "shard": shard,
+        "scheduler": scheduler,
+        "retry_mgr": RetryMgr(scheduler, **get_retry_options(general)),
+        # handler_id -> Retry-After of its failed update, when worth retrying soon
+        "retry_hints": {},
+        # handler_id -> record types changed by its accepted update, see PropagationMgr.track
+        "updated_record_types": {},
+        # handler_id of the handlers sending updates, abandoned ones too, see cycle_deadline
+        "running_handler_ids": set(),
+        "shard_mgr": shard_mgr,
+        "control_mgr": None,
+        "lease_mgr": lease_mgr,
+        "propagation_mgr": None,
+        # HA lease token of the running cycle, its updates are fenced with it
+        "fencing_token": None,
+        "last_ipv4": None,
+        "last_ipv6": None,
+        # handler_id -> result and time of its last check
+        "handler_status": {},
     }
 
+    startup_timings["load_config"] = time.perf_counter() - load_start
+    if shard or not daemon:
+        return
+
+    watch_interfaces = general.get("watch_interfaces", [])
+    if watch_interfaces:
+        from iface_watcher import IfaceWatcher
+
+        iface_watcher = IfaceWatcher(
+            watch_interfaces,
+            scheduler.wake,
+            general.get("watch_debounce", 2),
+        )
+        iface_watcher.start()
+        if general.get("ipv6_from_interface", False):
+            NetworkMgr.configure(ipv6_source=iface_watcher.get_current_ipv6)
+
+    if general.get("watch_config", True):
+        ConfigWatcher(config_path, request_reload).start()
 
-def run_ip_check_cycle():
-    current_ipv4 = NetworkMgr().get_current_IP()
-    current_ipv6 = NetworkMgr().get_current_IP(ipv6=True)
+    metrics_port = general.get("metrics_port", None)
+    if metrics_port:
+        metrics_mgr.start_http_exporter(
+            metrics_port, general.get("metrics_address", "127.0.0.1")
+        )
+
+    control_port = general.get("control_port", None)
+    if control_port:
+        from control_mgr import ControlMgr
+
+        control_mgr = ControlMgr(
+            lambda: scheduler.wake(check_all=False),
+            get_status,
+            NetworkMgr().push_ip,
+            NetworkMgr().check_ip_validity,
+            general.get("control_debounce", 5),
+            general.get("control_token", None),
+        )
+        control_mgr.start(control_port, general.get("control_address", "127.0.0.1"))
+        config_settings["control_mgr"] = control_mgr
+
+    if general.get("propagation_check", False):
+        from propagation_mgr import PropagationMgr
 
-    for domain_handler in config_settings["domain_handlers"][:]:
-        ip_type = (
-            "IPv4 and IPv6"
-            if domain_handler.update_ipv4 and domain_handler.update_ipv6
-            else ("IPv4" if domain_handler.update_ipv4 else "IPv6")
+        propagation_mgr = PropagationMgr(
+            NetworkMgr().lookup_dns_IPs, general.get("propagation_deadline", 600)
         )
+        propagation_mgr.start()
+        config_settings["propagation_mgr"] = propagation_mgr
+
+    if lease_mgr:
+        lease_mgr.start()
+
+
+def request_reload():
+    """Reload the config before the next cycle, called by the config watcher and SIGHUP."""
+
+    reload_requested.set()
+    config_settings["scheduler"].wake(check_all=False)
+
+
+def on_leadership_change(leader: bool):
+    """Called by the lease thread when this instance becomes the HA leader or a standby."""
+
+    metrics_mgr.ha_leader.set(1 if leader else 0)
+    if leader:
+        # Start from the last state of the previous leader, then check every domain
+        sync_standby_state()
+        config_settings["scheduler"].wake()
+
+
+def sync_standby_state():
+    """Keep the update state published by the HA leader, so a takeover starts warm."""
+
+    content = config_settings["lease_mgr"].read_state()
+    if content is None:
+        return
+
+    StateMgr().replace(content["state"])
+    StateMgr().save()
+    for ip_version in ("ipv4", "ipv6"):
+        config_settings[f"last_{ip_version}"] = content[f"last_{ip_version}"]
+
+
+def get_status() -> dict:
+    """The status served by the control API."""
+
+    # Copied at once, the main thread may be updating them
+    domain_handlers = list(config_settings["domain_handlers"])
+    handler_status = dict(config_settings["handler_status"])
+
+    status = {
+        "last_ipv4": config_settings["last_ipv4"],
+        "last_ipv6": config_settings["last_ipv6"],
+        "next_run": config_settings["scheduler"].get_next_run(),
+        "handlers": {
+            domain_handler.handler_id: {
+                "provider": domain_handler.provider,
+                "domains": domain_handler.domains,
+                **handler_status.get(domain_handler.handler_id, {"result": None, "time": None}),
+            }
+            for domain_handler in domain_handlers
+        },
+    }
+    if config_settings["lease_mgr"]:
+        status["ha"] = config_settings["lease_mgr"].get_status()
+    if config_settings["propagation_mgr"]:
+        status["propagation"] = config_settings["propagation_mgr"].get_status()
+
+    return status
+
+
+def reload_config() -> bool:
+    """
+    Apply the changes of the config file without stopping the program.
+
+    Only the handlers of the DOMAIN_INFO entries that changed are created or removed,
+    the others keep their caches and state. An invalid config is rejected and the
+    running one is kept.
+    """
+
+    shard = config_settings["shard"]
+    current_handlers = config_settings["domain_handler_keys"]
+    try:
+        config = read_config(config_path, config_snapshot_path)
+        general = config["GENERAL"]
+        check_general_config(general)
+        check_rate_limits(config.get("RATE_LIMITS"))
+        domain_handler_keys = build_domain_handlers(
+            config, shard, current_handlers, config_settings["halted_handler_keys"]
+        )
+    except ConfigError as error:
+        logger.error(f"Config rejected, the running one is kept: {error}")
+        return False
+
+    current_config = config_settings["config"]
+    current_general = current_config["GENERAL"]
+    if not shard:
+        for setting in restart_only_settings:
+            if general.get(setting) != current_general.get(setting):
+                logger.warning(f"'{setting}' changed, it is applied on restart")
+
+    try:
+        apply_general_config(general, config.get("RATE_LIMITS"), current_general)
+    except Exception as error:
+        logger.exception(f"Config rejected, the running one is kept: {error}")
+        apply_general_config(current_general, current_config.get("RATE_LIMITS"), general)
+        return False
+
+    handler_ids = {domain_handler.handler_id for domain_handler in domain_handler_keys.values()}
+    removed_handlers = [
+        domain_handler
+        for key, domain_handler in current_handlers.items()
+        if key not in domain_handler_keys
+    ]
+    for domain_handler in removed_handlers:
+        if domain_handler.handler_id not in handler_ids:
+            StateMgr().forget(domain_handler.handler_id)
+            config_settings["handler_status"].pop(domain_handler.handler_id, None)
+            config_settings["retry_mgr"].reset(domain_handler.handler_id)
+    added_handlers = [key for key in domain_handler_keys if key not in current_handlers]
+
+    config_settings["domain_handlers"] = list(domain_handler_keys.values())
+    config_settings["domain_handler_keys"] = domain_handler_keys
+    config_settings["config"] = get_kept_config(config)
+
+    if config_settings["shard_mgr"]:
+        config_settings["shard_mgr"].reload()
+
+    logger.info(
+        f"Config reloaded - {len(added_handlers)} handlers added, {len(removed_handlers)} removed, "
+        f"{len(domain_handler_keys) - len(added_handlers)} kept"
+    )
+
+    return True
+
+
+def apply_general_config(general: dict, rate_limits: dict, current_general: dict):
+    """Apply the GENERAL settings and RATE_LIMITS that can change without a restart."""
+
+    shard = config_settings["shard"]
+    logger_mgr.set_log_level(general["log_level"])
+    if not shard and get_log_options(general) != get_log_options(current_general):
+        logger_mgr.configure(**get_log_options(general))
+    network_options = get_network_options(general)
+    if network_options["dns_cache_size"] == current_general.get("dns_cache_size"):
+        # Keep the cached answers
+        del network_options["dns_cache_size"]
+    NetworkMgr.configure(
+        dns_servers=general["dns_servers"],
+        ipv4_servers=general["ipv4_servers"],
+        ipv6_servers=general["ipv6_servers"],
+        **network_options,
+    )
+    config_settings["scheduler"].configure(general["update_delay"], rate_limits or {})
+    config_settings["retry_mgr"].configure(**get_retry_options(general))
+    config_settings.update(get_general_settings(general, shard))
+
+
+def run_ip_check_cycle(domain_handlers: list = None, current_ips: tuple = None):
+    """
+    Check and update domain_handlers, every handler if not set.
+
+    current_ips is the (IPv4, IPv6) already known, e.g. sent to a shard worker,
+    they are looked up if not set.
+
+    Returns:
+    dict: domain_handler -> OK, CONTINUE, CANCEL or None if no update was needed.
+    """
+
+    if domain_handlers is None:
+        domain_handlers = config_settings["domain_handlers"]
+
+    cycle_start = time.monotonic()
+    # Shard workers keep the ID of their parent's cycle
+    cycle_token = None if current_ips else logger_mgr.cycle_id.set(secrets.token_hex(6))
+    if current_ips:
+        current_ipv4, current_ipv6 = current_ips
+    else:
+        current_ipv4, current_ipv6 = NetworkMgr().get_current_IPs()
+        for ip_version, current_ip in (("ipv4", current_ipv4), ("ipv6", current_ipv6)):
+            if current_ip and current_ip != config_settings[f"last_{ip_version}"]:
+                metrics_mgr.public_ip_change_time.set(time.time(), version=ip_version)
+                config_settings[f"last_{ip_version}"] = current_ip
+        NetworkMgr().getter_health.save()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("IP getters health: %s", NetworkMgr().getter_health.dump())
+
+    lease_mgr = config_settings["lease_mgr"]
+    if lease_mgr and not config_settings["shard"]:
+        # The shard workers get the token of their parent's cycle
+        config_settings["fencing_token"] = lease_mgr.token
+
+    if config_settings["shard_mgr"]:
+        handler_results = config_settings["shard_mgr"].run_cycle(
+            domain_handlers,
+            current_ipv4,
+            current_ipv6,
+            config_settings["domain_handler_keys"],
+            config_settings["scheduler"],
+            config_settings["retry_hints"],
+            config_settings["fencing_token"],
+            config_settings["updated_record_types"],
+        )
+    else:
+        handler_results = run_domain_handlers(domain_handlers, current_ipv4, current_ipv6)
+
+    check_time = time.time()
+    for domain_handler, result in handler_results.items():
+        config_settings["handler_status"][domain_handler.handler_id] = {
+            "result": result or "NO_UPDATE",
+            "time": check_time,
+        }
+        if result:
+            metrics_mgr.handler_results.inc(
+                provider=domain_handler.provider,
+                handler=domain_handler.handler_id,
+                result=result,
+            )
+        if result == "CANCEL" and not config_settings["continue_on_provider_fail"]:
+            halt_domain_handler(domain_handler)
+        # The shard workers send their retry hints and updated records to the parent
+        if not config_settings["shard"]:
+            record_types = config_settings["updated_record_types"].pop(domain_handler.handler_id, None)
+            if result == "OK" and record_types and config_settings["propagation_mgr"]:
+                # Watched in the background, the cycle goes on
+                config_settings["propagation_mgr"].track(
+                    domain_handler, current_ipv4, current_ipv6, record_types
+                )
+
+            retry_after = config_settings["retry_hints"].pop(domain_handler.handler_id, None)
+            if result == "CONTINUE" and retry_after is not None:
+                config_settings["retry_mgr"].schedule(domain_handler, retry_after)
+            else:
+                config_settings["retry_mgr"].reset(domain_handler.handler_id)
+
+    StateMgr().save()
+    if lease_mgr and not config_settings["shard"] and not config_settings["shard_mgr"]:
+        # The standbys keep a copy, to take over without checking everything again
+        lease_mgr.publish_state(
+            config_settings["fencing_token"],
+            {
+                "state": StateMgr().state,
+                "last_ipv4": config_settings["last_ipv4"],
+                "last_ipv6": config_settings["last_ipv6"],
+            },
+        )
+
+    metrics_mgr.cycle_seconds.observe(time.monotonic() - cycle_start)
+    metrics_mgr.domain_handlers.set(len(config_settings["domain_handlers"]))
+    if config_settings["metrics_textfile"]:
+        metrics_mgr.write_textfile(config_settings["metrics_textfile"])
+
+    if cycle_token:
+        logger_mgr.cycle_id.reset(cycle_token)
+
+    return handler_results
+
+
+def halt_domain_handler(domain_handler):
+    """Stop checking domain_handler, a reload only brings it back once its entry is edited."""
+
+    config_settings["domain_handlers"].remove(domain_handler)
+    handler_keys = config_settings["domain_handler_keys"]
+    for key in [key for key, handler in handler_keys.items() if handler is domain_handler]:
+        del handler_keys[key]
+        config_settings["halted_handler_keys"].add(key)
+
+
+def run_domain_handlers(domain_handlers: list, current_ipv4: str, current_ipv6: str):
+    """Run process_domain_handler for every handler with the configured engine."""
+
+    running_handler_ids = config_settings["running_handler_ids"]
+    if running_handler_ids:
+        # Abandoned by an earlier cycle, still waiting on their provider
+        busy_handlers = [
+            domain_handler
+            for domain_handler in domain_handlers
+            if domain_handler.handler_id in running_handler_ids
+        ]
+        for domain_handler in busy_handlers:
+            logger.warning(
+                f"{domain_handler.provider} - {domain_handler.domains} still running from an earlier cycle, "
+                "trying on next loop..."
+            )
+        domain_handlers = [
+            domain_handler for domain_handler in domain_handlers if domain_handler not in busy_handlers
+        ]
+
+    # Resolve every domain of the cycle at once instead of one handler at a time
+    dns_queries = []
+    for domain_handler in domain_handlers:
+        dns_queries += domain_handler.get_dns_queries(current_ipv4, current_ipv6)
+    dns_answers = NetworkMgr().resolve_dns_IPs(dns_queries)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("DNS cache stats: %s", NetworkMgr().dns_cache.get_stats())
+
+    # Merge the requests of the handlers sharing a token or an account
+    planned_updates, handler_results = plan_updates(
+        domain_handlers, current_ipv4, current_ipv6, dns_answers
+    )
+
+    if config_settings["engine"] == "async":
+        # Imported here, asyncio is slow to import and only needed by this engine
+        import asyncio
+
+        import async_engine
+
+        # Set at cycle_deadline, the abandoned handlers send no more updates
+        abandoned = threading.Event()
+        update_results = asyncio.run(
+            async_engine.run_domain_handlers(
+                process_running_handler,
+                planned_updates,
+                (current_ipv4, current_ipv6, dns_answers, abandoned),
+                config_settings["provider_concurrency"],
+                config_settings["cycle_deadline"],
+                abandoned,
+            )
+        )
+    else:
+        # Every update sets its own log correlation ID
+        update_results = {
+            planned_update: contextvars.copy_context().run(
+                process_domain_handler, planned_update, current_ipv4, current_ipv6, dns_answers
+            )
+            for planned_update in planned_updates
+        }
+
+    for planned_results in update_results.values():
+        handler_results.update(planned_results)
+
+    return handler_results
+
+
+def process_running_handler(planned_update, *args):
+    """process_domain_handler, its handlers are skipped by the next cycles until it returns."""
+
+    handler_ids = [domain_handler.handler_id for domain_handler in planned_update.domain_handlers]
+    config_settings["running_handler_ids"].update(handler_ids)
+    try:
+        return process_domain_handler(planned_update, *args)
+    finally:
+        config_settings["running_handler_ids"].difference_update(handler_ids)
+
+
+def process_domain_handler(
+    planned_update, current_ipv4, current_ipv6, dns_answers, abandoned: threading.Event = None
+):
+    """
+    Send the updates of a PlannedUpdate, asking them to its handler first if not planned.
+
+    No update is sent once abandoned is set, its cycle gave up on the handler.
+
+    Returns:
+    dict: domain_handler -> the provider's answer (OK, CONTINUE or CANCEL), or None if
+    no update was needed. Merged No-IP handlers get the answer of their own hostnames.
+    """
+
+    logger_mgr.handler_id.set(planned_update.handler_id)
+
+    request_queries = planned_update.request_queries
+    if request_queries is None:
+        domain_handler = planned_update.domain_handlers[0]
         logger.info(
-            f"Checking {ip_type} changes for {domain_handler.provider} - {domain_handler.domains}"
+            "Checking %s changes for %s - %s",
+            get_ip_type(domain_handler),
+            domain_handler.provider,
+            domain_handler.domains,
         )
 
-        request_queries = domain_handler.get_update_query(current_ipv4, current_ipv6)
+        request_queries = domain_handler.get_update_query(
+            current_ipv4, current_ipv6, dns_answers
+        )
         if not request_queries:
             logger.info("... No updates were performed.")
+            return dict.fromkeys(planned_update.domain_handlers)
+    elif len(planned_update.domain_handlers) > 1:
+        logger.info(
+            "Updating %s - %s together", planned_update.provider, planned_update.domains
+        )
 
-        for query in request_queries.get("query_urls", []):
-            logger.info(
-                f"... An update will be performed with the following URL query:"
-            )
-            logger.info(
-                f"...... {'HIDE' if config_settings['hide_update_queries_on_logs'] else query}"
+    handler_results = dict.fromkeys(planned_update.domain_handlers, "OK")
+    retry_after = None
+    split_updates = []
+    for query in request_queries.get("query_urls", []):
+        logger.info("... An update will be performed with the following URL query:")
+        logger.info(
+            "...... %s", "HIDE" if config_settings["hide_update_queries_on_logs"] else query
+        )
+
+        if abandoned and abandoned.is_set():
+            logger.warning("... The cycle deadline was reached, the update is left to the next loop")
+            merge_handler_results(handler_results, dict.fromkeys(handler_results, "CONTINUE"))
+            break
+
+        lease_mgr = config_settings["lease_mgr"]
+        if lease_mgr and not lease_mgr.check_fence(config_settings["fencing_token"]):
+            logger.warning("... The HA lease was lost, the update is left to the new leader")
+            merge_handler_results(handler_results, dict.fromkeys(handler_results, "CONTINUE"))
+            break
+
+        if not config_settings["scheduler"].acquire_update(
+            planned_update.provider, planned_update.credential
+        ):
+            logger.warning(
+                f"... {planned_update.provider} update budget of this token or account exhausted (RATE_LIMITS), "
+                "trying on next loop..."
             )
+            merge_handler_results(handler_results, dict.fromkeys(handler_results, "CONTINUE"))
+            break
+
+        method = request_queries.get("request_method", None)
+        headers = request_queries.get("query_headers", None)
+        data = request_queries.get("query_data", None)
+
+        request_start = time.monotonic()
+        response = NetworkMgr().request_ip_update(query, method, headers, data)
+        metrics_mgr.update_request_seconds.observe(
+            time.monotonic() - request_start, provider=planned_update.provider
+        )
+        # 429, 5xx and No-IP's 911 are transient whatever the body says, e.g. a CloudFlare
+        # 429 comes with success: false
+        query_retry_after = get_retry_after(response)
+        if query_retry_after is None:
+            query_results = planned_update.handle_response(response)
+        else:
+            query_results = dict.fromkeys(handler_results, "CONTINUE")
+        merge_handler_results(handler_results, query_results)
 
-            method = request_queries.get("request_method", None)
-            headers = request_queries.get("query_headers", None)
-            data = request_queries.get("query_data", None)
+        results = set(query_results.values())
+        if len(results) > 1:
+            for result in ("OK", "CONTINUE", "CANCEL"):
+                logger.info(
+                    "... %s: %s",
+                    result,
+                    [
+                        domain
+                        for domain_handler, handler_result in query_results.items()
+                        if handler_result == result
+                        for domain in domain_handler.domains
+                    ],
+                )
 
-            query_response = domain_handler.handle_response(
-                NetworkMgr().request_ip_update(query, method, headers, data)
+        if "OK" in results:
+            logger.info("Update request accepted successfully!")
+            # The cached answers are now stale, ask again on next check
+            NetworkMgr().invalidate_dns_cache(planned_update.domains)
+        if "CONTINUE" in results:
+            if query_retry_after is None:
+                logger.info("Update request failed, trying on next loop...")
+            else:
+                logger.info("Update request failed, it will be retried soon")
+                retry_after = max(retry_after or 0, query_retry_after)
+        if "CANCEL" in results:
+            split_updates = planned_update.split(current_ipv4, current_ipv6)
+            if split_updates:
+                break
+            if config_settings["continue_on_provider_fail"]:
+                logger.warning(
+                    "Update request rejected by provider. Check your authentication credentials and domain names. "
+                    "Due to 'continue_on_provider_fail', the domain will attempt updates in the next loop. "
+                    "If not fixed, this can trigger a ban or rate-limit."
+                )
+            else:
+                logger.error(
+                    "Update request rejected by provider. Check your authentication credentials and domain names. "
+                    "The update process for these domains is halted to prevent bans or rate-limits."
+                )
+            break
+
+    if split_updates:
+        logger.info(
+            "... The merged request was rejected as a whole, sending %s domain entries one by one",
+            len(split_updates),
+        )
+        handler_results = {}
+        for split_update in split_updates:
+            handler_results.update(
+                process_domain_handler(
+                    split_update, current_ipv4, current_ipv6, dns_answers, abandoned
+                )
             )
+        return handler_results
+
+    for domain_handler, handler_result in handler_results.items():
+        if handler_result == "OK":
+            config_settings["updated_record_types"][domain_handler.handler_id] = (
+                domain_handler.get_stale_record_types(current_ipv4, current_ipv6)
+            )
+            domain_handler.save_update_state(current_ipv4, current_ipv6)
+        elif handler_result == "CONTINUE" and retry_after is not None:
+            config_settings["retry_hints"][domain_handler.handler_id] = retry_after
+
+    return handler_results
+
+
+def merge_handler_results(handler_results: dict, query_results: dict):
+    """Keep the worst answer of every handler across its requests, CANCEL over CONTINUE over OK."""
+
+    for domain_handler, result in query_results.items():
+        if result_severity[result] > result_severity[handler_results[domain_handler]]:
+            handler_results[domain_handler] = result
+
+
+def get_exit_code(handler_results: dict) -> int:
+    """The --once exit code, a rejected update is worse than a failed one."""
 
-            match query_response:
-                case "OK":
-                    logger.info("Update request accepted successfully!")
-                case "CONTINUE":
-                    logger.info("Update request failed, trying on next loop...")
-                case "CANCEL":
-                    if config_settings["continue_on_provider_fail"]:
-                        logger.warning(
-                            "Update request rejected by provider. Check your authentication credentials and domain names. "
-                            "Due to 'continue_on_provider_fail', the domain will attempt updates in the next loop. "
-                            "If not fixed, this can trigger a ban or rate-limit."
-                        )
-                    else:
-                        logger.error(
-                            "Update request rejected by provider. Check your authentication credentials and domain names. "
-                            "The update process for these domains is halted to prevent bans or rate-limits."
-                        )
-                        config_settings["domain_handlers"].remove(domain_handler)
-                    break
+    results = set(handler_results.values())
+    if "CANCEL" in results:
+        return EXIT_REJECTED
+    if "CONTINUE" in results or not (config_settings["last_ipv4"] or config_settings["last_ipv6"]):
+        return EXIT_RETRY
 
+    return EXIT_OK
 
 
+def run_once(timing: bool = False) -> int:
+    """Check every domain once, for cron, systemd timers and network hooks."""
+
+    cycle_start = time.perf_counter()
+    lease_mgr = config_settings["lease_mgr"]
+    try:
+        if lease_mgr and not lease_mgr.renew():
+            logger.info("HA - Another instance holds the lease, nothing to do")
+            return EXIT_OK
+        handler_results = run_ip_check_cycle()
+    except Exception as e:
+        logger.exception(f"A fatal error occurred: {e}")
+        return EXIT_CONFIG_ERROR
+    finally:
+        if config_settings["shard_mgr"]:
+            config_settings["shard_mgr"].stop()
+        if lease_mgr:
+            lease_mgr.release()
+
+    if timing:
+        print_timing(f"Cycle: {round((time.perf_counter() - cycle_start) * 1000)} ms")
+
+    return get_exit_code(handler_results)
+
+
+def print_timing(message: str):
+    """Printed on stderr, not logged, so the timings show whatever log_level is."""
+
+    print(message, file=sys.stderr, flush=True)
+
+
+def print_startup_timings():
+    print_timing(
+        f"Startup: {round((time.perf_counter() - startup_start) * 1000)} ms - "
+        f"imports {round(startup_timings['imports'] * 1000)} ms, "
+        f"config {round(startup_timings['read_config'] * 1000)} ms, "
+        f"handlers {round(startup_timings['build_handlers'] * 1000)} ms, "
+        f"load_config {round(startup_timings['load_config'] * 1000)} ms"
+    )
 
-def main():
-    load_config()
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser(
+        description="Keep the DNS records of your domains updated with your public IPs."
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="check every domain once and exit, 0 if up to date, 1 on config errors, "
+        "2 if an update failed for now, 3 if a provider rejected an update",
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="print how long the startup and the check take on stderr",
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None):
+    args = parse_args(argv)
+
+    startup_timings["imports"] = time.perf_counter() - startup_start
+    load_config(daemon=not args.once)
+    if args.timing:
+        print_startup_timings()
+
+    if args.once:
+        sys.exit(run_once(args.timing))
+
+    if hasattr(signal, "SIGHUP"):
+        # The handler runs on the main thread, which may hold the scheduler lock
+        signal.signal(
+            signal.SIGHUP, lambda signum, frame: threading.Thread(target=request_reload).start()
+        )
 
     try:
         while True:
+            due_handlers = config_settings["scheduler"].wait_due_handlers(
+                config_settings["domain_handlers"]
+            )
+            if reload_requested.is_set():
+                reload_requested.clear()
+                reload_config()
+                # The removed handlers must not be checked
+                due_handlers = [
+                    domain_handler
+                    for domain_handler in due_handlers
+                    if domain_handler in config_settings["domain_handlers"]
+                ]
+            if config_settings["control_mgr"]:
+                # Asked through the control API
+                for domain_handler in config_settings["control_mgr"].take_triggered(
+                    config_settings["domain_handlers"]
+                ):
+                    if domain_handler not in due_handlers:
+                        due_handlers.append(domain_handler)
+            if config_settings["lease_mgr"] and not config_settings["lease_mgr"].is_leader():
+                # Standby, only the leader checks the domains
+                sync_standby_state()
+                continue
+            if not due_handlers:
+                continue
+
             logger.info("Starting IPs checking cycle...")
-            run_ip_check_cycle()
-            logger.info(f"Sleeping for {config_settings['update_delay']} seconds")
-            time.sleep(config_settings["update_delay"])
+            run_ip_check_cycle(due_handlers)
+
+            next_run = config_settings["scheduler"].get_next_run()
+            if next_run is not None:
+                logger.info(f"Sleeping for {round(next_run)} seconds")
     except KeyboardInterrupt:
         logger.info("Program terminated by user.")
     except Exception as e:
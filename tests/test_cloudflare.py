@@ -0,0 +1,134 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import sys
+
+import pytest
+
+import domain_mgr
+from domain_mgr import DomainMgr
+from network_mgr import NetworkMgr
+from state_mgr import StateMgr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from fake_servers import FakeHTTPHandler, FakeHTTPServer, RequestCounter  # noqa: E402
+
+
+@pytest.fixture
+def state(tmp_path):
+    state_mgr = StateMgr(str(tmp_path / "state.json"))
+    state_mgr.replace({})
+    return state_mgr
+
+
+def test_legacy_record_only_saves_the_record_type_it_patches(state):
+    domain_handler = DomainMgr(
+        "CLOUDFLARE",
+        {"token": "secret", "zone_id": "zone", "dns_record_id": "record", "names": ["home.example"]},
+    )
+    dns_answers = {("home.example", False): "192.0.2.1", ("home.example", True): "2001:db8::1"}
+
+    request_queries = domain_handler.get_update_query("203.0.113.7", "2001:db8::7", dns_answers)
+    assert request_queries["query_data"]["type"] == "AAAA"
+    assert request_queries["query_data"]["content"] == "2001:db8::7"
+
+    domain_handler.save_update_state("203.0.113.7", "2001:db8::7")
+    assert state.get_record(domain_handler.handler_id, "A") is None
+    assert state.get_record(domain_handler.handler_id, "AAAA")["ip"] == "2001:db8::7"
+
+
+@pytest.fixture
+def cloudflare(monkeypatch):
+    NetworkMgr(["127.0.0.1"], [], [])
+    counter = RequestCounter()
+    http_server = FakeHTTPServer(FakeHTTPHandler, counter, "203.0.113.7", "2001:db8::7").start()
+    monkeypatch.setattr(domain_mgr, "cloudflare_api_url", f"{http_server.url}/cloudflare")
+    monkeypatch.setattr(domain_mgr, "cloudflare_zones", {})
+    yield http_server
+    http_server.shutdown()
+    http_server.server_close()
+
+
+def zone_handler(cloudflare, records, names):
+    cloudflare.cloudflare_records["zone"] = {
+        record_id: {"id": record_id, "name": name, "type": "A", "content": content}
+        for record_id, (name, content) in records.items()
+    }
+    return DomainMgr(
+        "CLOUDFLARE",
+        {"token": "secret", "zone_id": "zone", "ip_version": "ipv4", "names": names},
+    )
+
+
+def test_bulk_update_only_patches_changed_records(state, cloudflare):
+    domain_handler = zone_handler(
+        cloudflare,
+        {"same": ("same.example", "203.0.113.7"), "stale": ("stale.example", "192.0.2.1")},
+        ["same.example", "stale.example", "new.example"],
+    )
+
+    request_queries = domain_handler.get_update_query("203.0.113.7")
+    assert request_queries["query_urls"][0].endswith("/zones/zone/dns_records/batch")
+    assert request_queries["query_data"] == {
+        "patches": [{"id": "stale", "content": "203.0.113.7"}],
+        "posts": [{"name": "new.example", "type": "A", "content": "203.0.113.7", "ttl": 1}],
+    }
+
+    response = NetworkMgr().request_ip_update(
+        request_queries["query_urls"][0],
+        request_queries["request_method"],
+        request_queries["query_headers"],
+        request_queries["query_data"],
+    )
+    assert domain_handler.handle_response(response) == "OK"
+    assert {
+        record["name"]: record["content"] for record in cloudflare.cloudflare_records["zone"].values()
+    } == dict.fromkeys(["same.example", "stale.example", "new.example"], "203.0.113.7")
+
+    # The zone is listed again and nothing is left to patch
+    cloudflare.counter.reset()
+    assert domain_handler.get_update_query("203.0.113.7") == {}
+    assert cloudflare.counter.counts == {"CLOUDFLARE": 1}
+
+
+def test_bulk_update_skips_unchanged_records(state, cloudflare):
+    domain_handler = zone_handler(
+        cloudflare,
+        {"first": ("first.example", "203.0.113.7"), "second": ("Second.example", "203.0.113.7")},
+        ["first.example", "second.example"],
+    )
+
+    assert domain_handler.get_update_query("203.0.113.7") == {}
+    assert cloudflare.counter.counts == {"CLOUDFLARE": 1}
+    assert state.get_record(domain_handler.handler_id, "A")["ip"] == "203.0.113.7"
+
+    # Up to date records aren't listed again until dns_verify_interval
+    assert domain_handler.get_update_query("203.0.113.7") == {}
+    assert cloudflare.counter.counts == {"CLOUDFLARE": 1}
+
+
+def test_bulk_update_saves_the_unchanged_record_types(state, cloudflare):
+    cloudflare.cloudflare_records["zone"] = {
+        "a": {"id": "a", "name": "home.example", "type": "A", "content": "203.0.113.7"},
+        "aaaa": {"id": "aaaa", "name": "home.example", "type": "AAAA", "content": "2001:db8::1"},
+    }
+    domain_handler = DomainMgr(
+        "CLOUDFLARE", {"token": "secret", "zone_id": "zone", "names": ["home.example"]}
+    )
+
+    request_queries = domain_handler.get_update_query("203.0.113.7", "2001:db8::7")
+    assert request_queries["query_data"] == {"patches": [{"id": "aaaa", "content": "2001:db8::7"}]}
+    assert domain_handler.get_stale_record_types("203.0.113.7", "2001:db8::7") == ["AAAA"]
@@ -0,0 +1,88 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import io
+import os
+
+import pytest
+import yaml
+
+from config_mgr import load_yaml_stream
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def safe_load(file):
+    """yaml.safe_load with the parser of load_yaml_stream, libyaml when available."""
+
+    return yaml.load(file, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def load_both(text: str):
+    """The results of load_yaml_stream and safe_load, a raised error as its type."""
+
+    results = []
+    for load in (load_yaml_stream, safe_load):
+        try:
+            results.append(load(io.StringIO(text)))
+        except yaml.YAMLError as error:
+            # The messages depend on the parser, libyaml or not
+            results.append(type(error))
+
+    return results
+
+
+def test_config_yaml_dev_matches_safe_load():
+    with open(os.path.join(repo_dir, "config.yaml.dev")) as file:
+        text = file.read()
+
+    stream_config, safe_config = load_both(text)
+    assert isinstance(stream_config, dict)
+    assert stream_config == safe_config
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "--- 5\n",
+        "a: 1\n...\n",
+        "a: 1\na: 2\n",
+        "a: [1, 2.5, true, null, ~, 0x1f, 1e3, .inf, 2024-01-02]\n",
+        "a: '1'\nb: !!str 2\nc: !!int '3'\nd: !!binary aGVsbG8=\n",
+        "a: &base {x: 1, y: 2}\nb: *base\n",
+        "base: &base {x: 1, y: 2}\nother: &other {y: 3, z: 4}\nc:\n  <<: [*base, *other]\n  x: 5\n",
+        "list: &items [1, 2]\nagain: *items\n",
+        "a: *missing\n",
+        "? [1, 2]\n: value\n",
+        "a: 1\n---\nb: 2\n",
+        "---\na: 1\n---\n",
+        "a: !!set {x, y}\n",
+        "a: !!omap [x: 1, y: 2]\n",
+        "a: !!pairs [x: 1, x: 2]\n",
+        "a: !!seq {x: 1}\n",
+        "a: !custom [1]\n",
+        "a: !custom 1\n",
+        "a: [1, 2\n",
+        "a: {b: 1}: c\n",
+    ],
+)
+def test_edge_cases_match_safe_load(text):
+    stream_result, safe_result = load_both(text)
+    assert stream_result == safe_result
+
+
+def test_aliases_are_the_same_object():
+    config = load_yaml_stream(io.StringIO("a: &base {x: 1}\nb: *base\n"))
+    assert config["a"] is config["b"]
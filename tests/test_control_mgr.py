@@ -0,0 +1,91 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from control_mgr import ControlMgr
+from network_mgr import NetworkMgr
+
+
+@pytest.fixture
+def control():
+    pushed_ips = []
+    control_mgr = ControlMgr(
+        lambda: None,
+        lambda: {"handlers": {}},
+        pushed_ips.append,
+        NetworkMgr(["127.0.0.1"], [], []).check_ip_validity,
+        debounce=60,
+        token="secret",
+    )
+    control_mgr.start(0)
+    control_mgr.pushed_ips = pushed_ips
+    control_mgr.url = f"http://127.0.0.1:{control_mgr.server.server_address[1]}"
+    yield control_mgr
+    control_mgr.server.shutdown()
+    control_mgr.server.server_close()
+
+
+def post(control_mgr, path, body, token="secret"):
+    return requests.post(
+        f"{control_mgr.url}{path}", json=body, headers={"Authorization": f"Bearer {token}"}, timeout=5
+    )
+
+
+def test_ips_are_pushed_together(control):
+    response = post(control, "/ip", {"ipv4": "203.0.113.7", "ipv6": "2001:db8::7"})
+    assert response.status_code == 202
+    assert control.pushed_ips == ["203.0.113.7", "2001:db8::7"]
+    assert control.trigger_all
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"ipv4": "203.0.113.7", "ipv6": "2001:db8::zz"},
+        {"ipv4": "203.0.113.7", "ipv6": "203.0.113.8"},
+        {"ipv4": "2001:db8::7"},
+        {"ipv4": ["203.0.113.7"]},
+        {"ipv4": "203.0.113.7", "provider": 7},
+        {},
+    ],
+)
+def test_invalid_ip_request_pushes_nothing(control, body):
+    response = post(control, "/ip", body)
+    assert response.status_code == 400
+    assert control.pushed_ips == []
+    assert not control.trigger_all
+
+
+@pytest.mark.parametrize("body", [{"provider": 7}, {"provider": ["DUCKDNS"]}, {"handler": {"id": 1}}])
+def test_sync_rejects_non_string_targets(control, body):
+    assert post(control, "/sync", body).status_code == 400
+    assert not control.trigger_all and not control.providers and not control.handler_ids
+
+
+def test_sync_triggers_the_requested_handlers(control):
+    duckdns = SimpleNamespace(provider="DUCKDNS", handler_id="DUCKDNS|a.example")
+    noip = SimpleNamespace(provider="NOIP", handler_id="NOIP|b.example")
+    assert post(control, "/sync", {"provider": "DUCKDNS"}).status_code == 202
+    assert post(control, "/sync", {"handler": "NOIP|b.example"}).status_code == 202
+    assert control.take_triggered([duckdns, noip]) == [duckdns, noip]
+    assert control.take_triggered([duckdns, noip]) == []
+
+
+def test_token_is_required(control):
+    assert post(control, "/sync", {}, token="wrong").status_code == 401
+    assert requests.get(f"{control.url}/status", timeout=5).status_code == 401
@@ -0,0 +1,213 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import socket
+import struct
+import threading
+
+import pytest
+
+from dns_client import (
+    CNAME,
+    FLAG_AA,
+    DNSClient,
+    encode_name,
+    get_answer_records,
+    parse_response,
+    read_name,
+    record_types,
+)
+
+parse_errors = (ValueError, IndexError, struct.error)
+
+
+def build_response(
+    transaction_id: int,
+    domain: str,
+    record_type: str,
+    answers: list,
+    flags: int = 0x8180,
+) -> bytes:
+    """answers are (name or compressed name bytes, type number, ttl, rdata) tuples."""
+
+    header = struct.pack("!HHHHHH", transaction_id, flags, 1, len(answers), 0, 0)
+    question = encode_name(domain) + struct.pack("!HH", record_types[record_type], 1)
+    records = b""
+    for name, answer_type, ttl, rdata in answers:
+        if isinstance(name, str):
+            name = encode_name(name)
+        records += name + struct.pack("!HHIH", answer_type, 1, ttl, len(rdata)) + rdata
+
+    return header + question + records
+
+
+# Pointer to the question's name, right after the header
+question_pointer = b"\xc0\x0c"
+
+
+def test_parse_a_and_aaaa():
+    response = parse_response(
+        build_response(
+            1,
+            "home.example.org",
+            "A",
+            [(question_pointer, 1, 300, bytes([203, 0, 113, 7]))],
+        )
+    )
+    assert response["question"] == ("home.example.org", 1)
+    assert get_answer_records(response, "A") == [("203.0.113.7", 300)]
+
+    ipv6 = socket.inet_pton(socket.AF_INET6, "2001:db8::7")
+    response = parse_response(
+        build_response(2, "home.example.org", "AAAA", [(question_pointer, 28, 60, ipv6)])
+    )
+    assert get_answer_records(response, "AAAA") == [("2001:db8::7", 60)]
+
+
+def test_cname_chain_keeps_lowest_ttl():
+    target = encode_name("target.example.net")
+    response = parse_response(
+        build_response(
+            1,
+            "home.example.org",
+            "A",
+            [
+                (question_pointer, CNAME, 30, target),
+                ("target.example.net", 1, 300, bytes([203, 0, 113, 7])),
+            ],
+        )
+    )
+    assert get_answer_records(response, "A") == [("203.0.113.7", 30)]
+
+
+def test_ns_names_follow_compression():
+    # ns1.<the question's name>
+    rdata = b"\x03ns1" + question_pointer
+    response = parse_response(
+        build_response(1, "example.org", "NS", [(question_pointer, 2, 3600, rdata)])
+    )
+    assert get_answer_records(response, "NS") == [("ns1.example.org", 3600)]
+
+
+@pytest.mark.parametrize("rdata", [b"\xcb\x00\x71", b"\xcb\x00\x71\x07\x00", b""])
+def test_a_record_of_wrong_length_is_rejected(rdata):
+    response = parse_response(
+        build_response(1, "home.example.org", "A", [(question_pointer, 1, 300, rdata)])
+    )
+    with pytest.raises(ValueError):
+        get_answer_records(response, "A")
+
+
+def test_aaaa_record_of_wrong_length_is_rejected():
+    response = parse_response(
+        build_response(1, "home.example.org", "AAAA", [(question_pointer, 28, 300, bytes(4))])
+    )
+    with pytest.raises(ValueError):
+        get_answer_records(response, "AAAA")
+
+
+def test_truncated_packets_are_rejected():
+    data = build_response(1, "home.example.org", "A", [(question_pointer, 1, 300, bytes(4))])
+    for length in range(len(data)):
+        with pytest.raises(parse_errors):
+            parse_response(data[:length])
+
+
+def test_record_longer_than_packet_is_rejected():
+    data = build_response(1, "home.example.org", "A", [(question_pointer, 1, 300, bytes(4))])
+    # rdlength of 200 for the 4 bytes left
+    data = data[:-6] + struct.pack("!H", 200) + data[-4:]
+    with pytest.raises(ValueError):
+        parse_response(data)
+
+
+def test_compression_pointer_loops_are_rejected():
+    # A pointer to itself, and two pointers to each other
+    with pytest.raises(ValueError):
+        read_name(b"\xc0\x00", 0)
+    with pytest.raises(ValueError):
+        read_name(b"\xc0\x02\xc0\x00", 0)
+
+
+def test_pointer_out_of_packet_and_reserved_labels_are_rejected():
+    with pytest.raises(parse_errors):
+        read_name(b"\xc0\xff", 0)
+    with pytest.raises(ValueError):
+        read_name(b"\x40abc\x00", 0)
+    with pytest.raises(ValueError):
+        read_name(b"\x3fabc", 0)
+
+
+class FakeDNSServer:
+    """Answer every question with the reply built by respond(query ID, domain, type)."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.port = self.socket.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                data, address = self.socket.recvfrom(65535)
+            except OSError:
+                return
+            transaction_id = struct.unpack_from("!H", data)[0]
+            domain, offset = read_name(data, 12)
+            type_number = struct.unpack_from("!H", data, offset)[0]
+            record_type = next(
+                name for name, number in record_types.items() if number == type_number
+            )
+            self.socket.sendto(self.respond(transaction_id, domain, record_type), address)
+
+    def close(self):
+        self.socket.close()
+
+
+def test_malformed_answer_is_a_failed_lookup():
+    server = FakeDNSServer(
+        lambda transaction_id, domain, record_type: build_response(
+            transaction_id, domain, record_type, [(question_pointer, 1, 300, b"\x01\x02\x03")]
+        )
+    )
+    try:
+        results = DNSClient(["127.0.0.1"], server.port, timeout=1).resolve(
+            [("home.example.org", "A")]
+        )
+    finally:
+        server.close()
+
+    assert results == {("home.example.org", "A"): None}
+
+
+def test_valid_answer_is_resolved():
+    server = FakeDNSServer(
+        lambda transaction_id, domain, record_type: build_response(
+            transaction_id,
+            domain,
+            record_type,
+            [(question_pointer, 1, 300, bytes([203, 0, 113, 7]))],
+            flags=0x8180 | FLAG_AA,
+        )
+    )
+    try:
+        results = DNSClient(["127.0.0.1"], server.port, timeout=1).resolve(
+            [("home.example.org", "A")]
+        )
+    finally:
+        server.close()
+
+    assert results[("home.example.org", "A")]["answers"] == [("203.0.113.7", 300)]
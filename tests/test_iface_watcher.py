@@ -0,0 +1,110 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import queue
+import socket
+import threading
+import time
+
+import pytest
+
+import iface_watcher
+from iface_watcher import IfaceWatcher, get_interfaces_ipv6
+
+# address, index, prefix length, scope, flags, interface as in /proc/net/if_inet6
+first_ipv6_line = "26064700000000000000000000001111 02 40 00 80 eth0\n"
+second_ipv6_line = "26064700000000000000000000002222 02 40 00 80 eth0\n"
+
+
+@pytest.fixture
+def if_inet6(tmp_path, monkeypatch):
+    path = tmp_path / "if_inet6"
+    path.write_text(first_ipv6_line)
+    monkeypatch.setattr(
+        iface_watcher,
+        "get_interfaces_ipv6",
+        lambda interfaces=None: get_interfaces_ipv6(interfaces, str(path)),
+    )
+    return path
+
+
+class FakeEventSource:
+    """Hand out the queued address events, as netlink_wait does."""
+
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def __call__(self, timeout):
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return set()
+
+
+def test_get_interfaces_ipv6_skips_temporary_and_local_addresses(tmp_path):
+    path = tmp_path / "if_inet6"
+    path.write_text(
+        "26064700000000000000000000003333 02 40 00 01 eth0\n"  # temporary
+        "fe800000000000000000000000000001 02 40 20 80 eth0\n"  # link local
+        + first_ipv6_line
+        + "00000000000000000000000000000001 01 80 10 80 lo\n"
+    )
+    assert get_interfaces_ipv6(None, str(path)) == {"eth0": "2606:4700::1111"}
+    assert get_interfaces_ipv6(["lo"], str(path)) == {}
+
+
+def test_burst_of_events_is_debounced(if_inet6):
+    changes = []
+    event_source = FakeEventSource()
+    watcher = IfaceWatcher(
+        ["eth0"],
+        lambda: changes.append(watcher.current_ipv6),
+        debounce=0.2,
+        poll_interval=0.05,
+        event_source=event_source,
+    )
+    watcher.start()
+    try:
+        if_inet6.write_text(second_ipv6_line)
+        for family in (socket.AF_INET6, socket.AF_INET6, socket.AF_INET):
+            event_source.events.put({family})
+
+        time.sleep(0.5)
+        assert changes == ["2606:4700::2222"]
+
+        # An IPv6 event that changes nothing doesn't wake the main loop
+        event_source.events.put({socket.AF_INET6})
+        time.sleep(0.4)
+        assert changes == ["2606:4700::2222"]
+    finally:
+        watcher.stop()
+        watcher._thread.join()
+
+
+def test_polls_if_inet6_without_netlink(if_inet6, monkeypatch):
+    monkeypatch.delattr(socket, "AF_NETLINK", raising=False)
+    changed = threading.Event()
+    watcher = IfaceWatcher(["eth0"], changed.set, debounce=0.05, poll_interval=0.05)
+    watcher.start()
+    try:
+        assert watcher.event_source == watcher.poll_wait
+        assert watcher.current_ipv6 == "2606:4700::1111"
+        assert not changed.wait(0.3)
+
+        if_inet6.write_text(second_ipv6_line)
+        assert changed.wait(2)
+        assert watcher.current_ipv6 == "2606:4700::2222"
+    finally:
+        watcher.stop()
+        watcher._thread.join()
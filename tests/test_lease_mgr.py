@@ -0,0 +1,125 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import pytest
+
+import lease_mgr
+from lease_mgr import LeaseMgr
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(lease_mgr, "time", fake_clock)
+    return fake_clock
+
+
+@pytest.fixture
+def lease_path(tmp_path):
+    return str(tmp_path / "lease.db")
+
+
+def test_single_leader_and_takeover_on_expiry(clock, lease_path):
+    changes = []
+    first = LeaseMgr(lease_path, "first", 30, lambda leader: changes.append(("first", leader)))
+    second = LeaseMgr(lease_path, "second", 30, lambda leader: changes.append(("second", leader)))
+
+    assert first.renew()
+    assert not second.renew()
+    assert first.token == 1 and second.token is None
+    assert second.check_fence(1)
+
+    # first is paused past its lease
+    clock.now += 31
+    assert second.renew()
+    assert second.token == 2
+    assert not first.is_leader()
+    assert not first.renew()
+    assert changes == [("first", True), ("second", True), ("first", False)]
+
+
+def test_stale_fencing_token_is_refused(clock, lease_path):
+    first = LeaseMgr(lease_path, "first", 30)
+    second = LeaseMgr(lease_path, "second", 30)
+    first.renew()
+    stale_token = first.token
+
+    clock.now += 31
+    second.renew()
+    assert not first.check_fence(stale_token)
+    assert not first.publish_state(stale_token, {"stale": True})
+    assert second.check_fence(second.token)
+    assert not second.check_fence(None)
+
+
+def test_expired_lease_fails_the_fence(clock, lease_path):
+    leader = LeaseMgr(lease_path, "leader", 30)
+    leader.renew()
+    clock.now += 31
+    assert not leader.check_fence(leader.token)
+    assert not leader.publish_state(leader.token, {})
+
+
+def test_leader_steps_down_before_expiry(clock, lease_path):
+    leader = LeaseMgr(lease_path, "leader", 30)
+    leader.renew()
+    clock.now += 21
+    assert not leader.is_leader()
+    # Renewing keeps the same token
+    assert leader.renew()
+    assert leader.token == 1
+
+
+def test_restarted_holder_gets_a_new_token(clock, lease_path):
+    LeaseMgr(lease_path, "leader", 30).renew()
+    restarted = LeaseMgr(lease_path, "leader", 30)
+    assert restarted.renew()
+    assert restarted.token == 2
+    assert not restarted.check_fence(1)
+
+
+def test_release_hands_over_right_away(clock, lease_path):
+    first = LeaseMgr(lease_path, "first", 30)
+    second = LeaseMgr(lease_path, "second", 30)
+    first.renew()
+    first.release()
+    assert first.token is None
+    assert second.renew()
+    assert second.token == 2
+
+
+def test_published_state_is_read_once(clock, lease_path):
+    leader = LeaseMgr(lease_path, "leader", 30)
+    standby = LeaseMgr(lease_path, "standby", 30)
+    leader.renew()
+
+    assert standby.read_state() is None
+    assert leader.publish_state(leader.token, {"handler": {"A": {"ip": "203.0.113.7"}}})
+    assert standby.read_state() == {"handler": {"A": {"ip": "203.0.113.7"}}}
+    assert standby.read_state() is None
+
+    clock.now += 1
+    assert leader.publish_state(leader.token, {})
+    assert standby.read_state() == {}
@@ -0,0 +1,67 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import pytest
+
+from domain_mgr import DomainMgr
+from propagation_mgr import PropagationMgr
+from state_mgr import StateMgr
+
+
+@pytest.fixture
+def state(tmp_path):
+    state_mgr = StateMgr(str(tmp_path / "state.json"))
+    state_mgr.replace({})
+    return state_mgr
+
+
+def duckdns_handler():
+    return DomainMgr("DUCKDNS", {"token": "token", "names": ["a.example", "b.example"]})
+
+
+def test_only_changed_record_types_are_stale(state):
+    domain_handler = duckdns_handler()
+    dns_answers = {
+        ("a.example", False): "203.0.113.7",
+        ("b.example", False): "203.0.113.7",
+        ("a.example", True): "2001:db8::1",
+        ("b.example", True): "2001:db8::7",
+    }
+
+    assert domain_handler.check_need_update("203.0.113.7", "2001:db8::7", dns_answers)
+    assert domain_handler.get_stale_record_types("203.0.113.7", "2001:db8::7") == ["AAAA"]
+
+    domain_handler.save_update_state("203.0.113.7", "2001:db8::7")
+    assert domain_handler.get_stale_record_types("203.0.113.7", "2001:db8::7") == []
+
+
+def test_track_only_watches_the_given_record_types():
+    propagation = PropagationMgr(lambda dns_queries, authoritative: {})
+    propagation.track(duckdns_handler(), "203.0.113.7", "2001:db8::7", ["AAAA"])
+    assert {key: record["ip"] for key, record in propagation.records.items()} == {
+        ("a.example", True): "2001:db8::7",
+        ("b.example", True): "2001:db8::7",
+    }
+
+
+def test_propagation_time_is_recorded_per_source():
+    answers = {("a.example", False): ["203.0.113.7"]}
+    propagation = PropagationMgr(lambda dns_queries, authoritative: answers, initial_delay=0)
+    propagation.track(
+        DomainMgr("DUCKDNS", {"token": "token", "names": ["a.example"]}), "203.0.113.7", None, ["A"]
+    )
+
+    propagation.check_records(propagation.wait_due_records())
+    assert propagation.records == {}
+    assert propagation.providers["DUCKDNS"]["propagated"] == 1
@@ -0,0 +1,145 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import copy
+
+import pytest
+import yaml
+
+import sync_ddns
+from state_mgr import StateMgr
+
+base_config = {
+    "GENERAL": {
+        "update_delay": 300,
+        "hide_update_queries_on_logs": True,
+        "continue_on_provider_fail": True,
+        "log_level": "WARNING",
+        "async_logging": False,
+        "watch_config": False,
+        "dns_servers": ["127.0.0.1"],
+        "ipv4_servers": ["http://127.0.0.1:9/ipv4"],
+        "ipv6_servers": [],
+    },
+    "DOMAIN_INFO": [
+        {
+            "provider": "DUCKDNS",
+            "domain_list": [
+                {"domain_data": {"token": "first", "names": ["first.example"]}},
+                {"domain_data": {"token": "second", "names": ["second.example"]}},
+            ],
+        },
+        {
+            "provider": "FREEDNS",
+            "domain_list": [{"domain_data": {"token": "third", "names": ["third.example"]}}],
+        },
+    ],
+}
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    config_path = tmp_path / "config.yaml"
+    monkeypatch.setattr(sync_ddns, "config_path", str(config_path))
+    monkeypatch.setattr(sync_ddns, "config_snapshot_path", None)
+    monkeypatch.setattr(sync_ddns, "state_path", str(tmp_path / "state.json"))
+    monkeypatch.setattr(sync_ddns, "getter_health_path", str(tmp_path / "getter_health.json"))
+
+    config = copy.deepcopy(base_config)
+    config_path.write_text(yaml.safe_dump(config))
+    sync_ddns.load_config(daemon=False)
+    config["path"] = config_path
+    return config
+
+
+def write_config(config: dict):
+    config["path"].write_text(yaml.safe_dump({key: value for key, value in config.items() if key != "path"}))
+
+
+def handlers_by_name():
+    return {
+        domain_handler.domains[0]: domain_handler
+        for domain_handler in sync_ddns.config_settings["domain_handlers"]
+    }
+
+
+def test_reload_keeps_untouched_handlers(config):
+    before = handlers_by_name()
+    StateMgr().set_record(before["second.example"].handler_id, "A", "203.0.113.7")
+    sync_ddns.config_settings["handler_status"][before["second.example"].handler_id] = {"result": "OK"}
+
+    config["GENERAL"]["update_delay"] = 60
+    config["DOMAIN_INFO"][0]["domain_list"][1]["domain_data"]["names"] = ["renamed.example"]
+    write_config(config)
+    assert sync_ddns.reload_config()
+
+    after = handlers_by_name()
+    assert sorted(after) == ["first.example", "renamed.example", "third.example"]
+    assert after["first.example"] is before["first.example"]
+    assert after["third.example"] is before["third.example"]
+    assert sync_ddns.config_settings["scheduler"].default_interval == 60
+
+    # The removed handler is forgotten
+    assert StateMgr().get_record(before["second.example"].handler_id, "A") is None
+    assert before["second.example"].handler_id not in sync_ddns.config_settings["handler_status"]
+
+
+@pytest.mark.parametrize(
+    "break_config",
+    [
+        lambda config: config["DOMAIN_INFO"][0]["domain_list"][0]["domain_data"].pop("token"),
+        lambda config: config["GENERAL"].update(update_delay="soon"),
+        lambda config: config.update(RATE_LIMITS={"DUCKDNS": {"burst": -1}}),
+        lambda config: config["DOMAIN_INFO"][1].update(provider="UNKNOWN"),
+    ],
+)
+def test_invalid_config_is_rejected(config, break_config):
+    domain_handlers = sync_ddns.config_settings["domain_handlers"]
+    running_config = sync_ddns.config_settings["config"]
+
+    break_config(config)
+    write_config(config)
+    assert not sync_ddns.reload_config()
+    assert sync_ddns.config_settings["domain_handlers"] is domain_handlers
+    assert sync_ddns.config_settings["config"] is running_config
+
+
+def test_invalid_yaml_is_rejected(config):
+    domain_handlers = sync_ddns.config_settings["domain_handlers"]
+    config["path"].write_text("GENERAL: [")
+    assert not sync_ddns.reload_config()
+    assert sync_ddns.config_settings["domain_handlers"] is domain_handlers
+
+
+def test_failed_settings_are_rolled_back(config, monkeypatch):
+    retry_mgr = sync_ddns.config_settings["retry_mgr"]
+    configure = retry_mgr.configure
+    calls = []
+
+    def failing_configure(**options):
+        calls.append(options)
+        if len(calls) == 1:
+            raise ValueError("can't apply the retry settings")
+        configure(**options)
+
+    monkeypatch.setattr(retry_mgr, "configure", failing_configure)
+    config["GENERAL"]["update_delay"] = 60
+    config["GENERAL"]["retry_attempts"] = 5
+    write_config(config)
+
+    assert not sync_ddns.reload_config()
+    assert [options["attempts"] for options in calls] == [5, 3]
+    assert sync_ddns.config_settings["scheduler"].default_interval == 300
+    assert retry_mgr.attempts == 3
+    assert sync_ddns.config_settings["update_delay"] == 300
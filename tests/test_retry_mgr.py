@@ -0,0 +1,127 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import email.utils
+import time
+
+import pytest
+
+import retry_mgr
+from domain_mgr import DomainMgr
+from retry_mgr import RetryMgr, get_backoff_delay, get_retry_after
+from scheduler_mgr import SchedulerMgr
+
+
+class FakeScheduler:
+    def __init__(self, retries: int = 100):
+        self.retries = retries
+        self.retry_delays = []
+
+    def acquire_retry(self, provider, credential=None):
+        self.retries -= 1
+        return self.retries >= 0
+
+    def schedule_retry(self, domain_handler, delay):
+        self.retry_delays.append((domain_handler.handler_id, delay))
+
+
+@pytest.fixture
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(retry_mgr.random, "uniform", lambda low, high: high)
+
+
+def duckdns_handler(name="home.example", token="token"):
+    return DomainMgr("DUCKDNS", {"token": token, "names": [name]})
+
+
+@pytest.mark.parametrize(
+    "response, retry_after",
+    [
+        ({"status_code": 500, "response_text": "", "error": "timeout"}, 0),
+        ({"status_code": 503, "response_text": ""}, 0),
+        ({"status_code": 429, "response_text": "", "headers": {"Retry-After": "120"}}, 120),
+        ({"status_code": 502, "response_text": "", "headers": {"Retry-After": "soon"}}, 0),
+        ({"status_code": 200, "response_text": "911"}, 1800),
+        ({"status_code": 200, "response_text": "911\n911\n"}, 1800),
+        ({"status_code": 200, "response_text": "911", "headers": {"Retry-After": "3600"}}, 3600),
+        # Retrying won't help, the handler's own answer decides
+        ({"status_code": 200, "response_text": "KO"}, None),
+        ({"status_code": 401, "response_text": "badauth", "headers": {"Retry-After": "60"}}, None),
+        ({"status_code": 200, "response_text": "good 203.0.113.7\n911"}, None),
+    ],
+)
+def test_get_retry_after(response, retry_after):
+    assert get_retry_after(response) == retry_after
+
+
+def test_retry_after_http_date():
+    retry_date = email.utils.formatdate(time.time() + 600, usegmt=True)
+    response = {"status_code": 503, "response_text": "", "headers": {"Retry-After": retry_date}}
+    assert 590 <= get_retry_after(response) <= 600
+
+
+def test_noip_911_is_retried_but_other_errors_are_cancelled():
+    noip_handler = DomainMgr("NOIP", {"username": "user", "password": "secret", "names": ["a.example"]})
+    assert noip_handler.handle_response({"response_text": "911"}) == "CONTINUE"
+    assert noip_handler.handle_response({"response_text": "nohost"}) == "CANCEL"
+
+
+def test_backoff_doubles_up_to_max_delay(no_jitter):
+    assert [get_backoff_delay(attempt, 5, 60) for attempt in range(6)] == [5, 10, 20, 40, 60, 60]
+
+
+def test_backoff_jitter(monkeypatch):
+    monkeypatch.setattr(retry_mgr.random, "uniform", lambda low, high: low)
+    assert get_backoff_delay(2, 5, 300) == 10
+
+
+def test_retries_stop_after_attempts_in_a_row(no_jitter):
+    scheduler = FakeScheduler()
+    retries = RetryMgr(scheduler, attempts=2, base_delay=5)
+    domain_handler = duckdns_handler()
+
+    assert retries.schedule(domain_handler, 0) == 5
+    assert retries.schedule(domain_handler, 0) == 10
+    assert retries.schedule(domain_handler, 0) is None
+    # The next failure after giving up starts over
+    assert retries.schedule(domain_handler, 0) == 5
+    assert scheduler.retry_delays == [(domain_handler.handler_id, delay) for delay in (5, 10, 5)]
+
+    retries.reset(domain_handler.handler_id)
+    assert retries.schedule(domain_handler, 0) == 5
+
+
+def test_retry_waits_for_retry_after(no_jitter):
+    retries = RetryMgr(FakeScheduler(), attempts=3, base_delay=5)
+    assert retries.schedule(duckdns_handler(), 1800) == 1800
+
+
+def test_retries_are_disabled_with_zero_attempts():
+    scheduler = FakeScheduler()
+    assert RetryMgr(scheduler, attempts=0).schedule(duckdns_handler(), 0) is None
+    assert scheduler.retry_delays == []
+
+
+def test_retry_budget_is_per_credential(no_jitter):
+    scheduler = SchedulerMgr(300, {"DUCKDNS": {"retry_burst": 1}})
+    retries = RetryMgr(scheduler, attempts=3, base_delay=5)
+    first = duckdns_handler("first.example", "first")
+    second = duckdns_handler("second.example", "first")
+    other = duckdns_handler("other.example", "other")
+
+    assert retries.schedule(first, 0) == 5
+    assert retries.schedule(second, 0) is None
+    assert retries.schedule(other, 0) == 5
+    # A retry refused for the budget doesn't count as an attempt
+    assert second.handler_id not in retries.handler_attempts
@@ -0,0 +1,118 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from types import SimpleNamespace
+
+import pytest
+
+import scheduler_mgr
+from scheduler_mgr import SchedulerMgr, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(scheduler_mgr, "time", fake_clock)
+    return fake_clock
+
+
+def handler(handler_id, provider="DUCKDNS", check_interval=None):
+    return SimpleNamespace(handler_id=handler_id, provider=provider, check_interval=check_interval)
+
+
+def test_token_bucket_refills_up_to_burst(clock):
+    bucket = TokenBucket(updates_per_hour=4, burst=2)
+    assert [bucket.try_acquire() for _ in range(3)] == [True, True, False]
+
+    clock.now += 900
+    assert [bucket.try_acquire() for _ in range(2)] == [True, False]
+
+    clock.now += 10 * 3600
+    assert bucket.take(5) == 2
+    bucket.refund(5)
+    assert bucket.take(5) == 2
+
+
+def test_update_budgets_are_per_credential_with_defaults(clock):
+    scheduler = SchedulerMgr(300)
+    assert [scheduler.acquire_update("NOIP", "first") for _ in range(3)] == [True, True, False]
+    assert scheduler.acquire_update("NOIP", "second")
+    assert sum(scheduler.acquire_update("CLOUDFLARE", "zone") for _ in range(30)) == 20
+    assert scheduler.grant_updates("OTHER", None, 50) == 50
+
+
+def test_rate_limits_override_the_defaults(clock):
+    scheduler = SchedulerMgr(300, {"DUCKDNS": {"burst": 1}})
+    assert [scheduler.acquire_update("DUCKDNS", "token") for _ in range(2)] == [True, False]
+
+    # 12 updates per hour of the defaults still apply
+    clock.now += 300
+    assert scheduler.acquire_update("DUCKDNS", "token")
+
+    # The budgets of the providers whose limits didn't change are kept
+    assert scheduler.acquire_update("FREEDNS", "token")
+    scheduler.configure(300, {"DUCKDNS": {"burst": 5}})
+    assert scheduler.grant_updates("DUCKDNS", "token", 10) == 5
+    assert scheduler.grant_updates("FREEDNS", "token", 10) == 2
+
+
+def test_jobs_run_at_their_own_pace(clock):
+    scheduler = SchedulerMgr(300, {"NOIP": {"check_interval": 600}})
+    duckdns = handler("duck")
+    noip = handler("noip", "NOIP")
+    fast = handler("fast", check_interval=60)
+    domain_handlers = [duckdns, noip, fast]
+
+    assert scheduler.wait_due_handlers(domain_handlers) == domain_handlers
+    assert scheduler.get_next_run() == 60
+
+    clock.now += 60
+    assert scheduler.wait_due_handlers(domain_handlers) == [fast]
+    clock.now += 240
+    assert scheduler.wait_due_handlers(domain_handlers) == [duckdns, fast]
+    clock.now += 300
+    assert scheduler.wait_due_handlers(domain_handlers) == domain_handlers
+
+
+def test_retry_is_a_one_off_job(clock):
+    scheduler = SchedulerMgr(300)
+    first = handler("first")
+    second = handler("second", check_interval=1000)
+    domain_handlers = [first, second]
+    scheduler.wait_due_handlers(domain_handlers)
+
+    scheduler.schedule_retry(second, 30)
+    assert scheduler.get_next_run() == 30
+    clock.now += 30
+    assert scheduler.wait_due_handlers(domain_handlers) == [second]
+    assert scheduler.get_next_run() == 270
+
+
+def test_jobs_of_removed_handlers_are_dropped(clock):
+    scheduler = SchedulerMgr(300)
+    removed = handler("removed", check_interval=60)
+    scheduler.wait_due_handlers([handler("kept"), removed])
+
+    clock.now += 60
+    assert scheduler.wait_due_handlers([handler("kept")]) == []
+    assert scheduler.get_next_run() == 240
+    assert ("handler", "removed") not in scheduler.scheduled_jobs
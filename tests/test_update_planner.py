@@ -0,0 +1,71 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from domain_mgr import DomainMgr
+from update_planner import PlannedUpdate, split_batches
+
+
+def duckdns_handler(*names):
+    return DomainMgr("DUCKDNS", {"token": "shared", "names": list(names)})
+
+
+def test_rejected_duckdns_merge_is_split_per_handler():
+    domain_handlers = [duckdns_handler("good.example"), duckdns_handler("typo.example")]
+    planned_update = PlannedUpdate(
+        domain_handlers,
+        domain_handlers[0].build_update_query(["good.example", "typo.example"], "203.0.113.7"),
+    )
+
+    # DuckDNS answers a single KO for the whole request
+    assert planned_update.handle_response({"response_text": "KO"}) == dict.fromkeys(
+        domain_handlers, "CANCEL"
+    )
+
+    split_updates = planned_update.split("203.0.113.7", None)
+    assert [split_update.domain_handlers for split_update in split_updates] == [
+        [domain_handler] for domain_handler in domain_handlers
+    ]
+    assert all(
+        len(split_update.request_queries["query_urls"]) == 1 for split_update in split_updates
+    )
+
+
+def test_single_handler_and_noip_are_not_split():
+    assert PlannedUpdate([duckdns_handler("home.example")]).split("203.0.113.7", None) == []
+
+    noip_handlers = [
+        DomainMgr("NOIP", {"username": "user", "password": "secret", "names": [name]})
+        for name in ("a.example", "b.example")
+    ]
+    assert PlannedUpdate(noip_handlers).split("203.0.113.7", None) == []
+
+
+def test_noip_answers_go_to_their_own_handler():
+    noip_handlers = [
+        DomainMgr("NOIP", {"username": "user", "password": "secret", "names": [name]})
+        for name in ("a.example", "b.example")
+    ]
+    results = PlannedUpdate(noip_handlers).handle_response(
+        {"response_text": "good 203.0.113.7\nnohost\n", "status_code": 200}
+    )
+    assert results == {noip_handlers[0]: "OK", noip_handlers[1]: "CANCEL"}
+
+
+def test_split_batches_never_splits_a_handler():
+    domain_handlers = [
+        duckdns_handler(*[f"host{index}-{name}.example" for name in range(3)]) for index in range(5)
+    ]
+    batches = split_batches(domain_handlers, 7)
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert sum(batches, []) == domain_handlers
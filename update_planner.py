@@ -0,0 +1,185 @@
+#    Copyright 2024 JDavid(Blackhack) <davidaristi.0504@gmail.com>
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import logger_mgr
+
+logger = logger_mgr.initialize_logger(__name__)
+
+# Most domains in one merged request: No-IP accepts about 20 hostnames per request,
+# and the domains= list of DuckDNS makes the URL longer with every domain
+max_merged_domains = {"DUCKDNS": 50, "NOIP": 20}
+# A handler with several answers keeps the worst one
+result_severity = {"OK": 0, "CONTINUE": 1, "CANCEL": 2}
+# Providers rejecting a merged request with a single answer, e.g. DuckDNS' KO for one
+# unknown domain. Its handlers are then sent one by one to find the rejected ones.
+# FreeDNS merged handlers share the same record, its answer holds for every one.
+split_on_rejection = {"DUCKDNS"}
+
+
+class PlannedUpdate:
+    """
+    The update requests of one or more handlers of the same provider.
+
+    request_queries is None when it must be asked to the handler while processing it,
+    e.g. CloudFlare, whose check needs its own API requests.
+    """
+
+    def __init__(self, domain_handlers: list, request_queries: dict = None):
+        self.domain_handlers = domain_handlers
+        self.request_queries = request_queries
+        self.provider = domain_handlers[0].provider
+        # Merged handlers share their token or account, see DomainMgr.get_merge_key
+        self.credential = domain_handlers[0].get_credential()
+        self.domains = list(
+            dict.fromkeys(
+                domain for domain_handler in domain_handlers for domain in domain_handler.domains
+            )
+        )
+        self.handler_id = ";".join(domain_handler.handler_id for domain_handler in domain_handlers)
+
+    def handle_response(self, response) -> dict:
+        """Return domain_handler -> OK, CONTINUE or CANCEL, read from the provider's answer."""
+
+        if self.provider == "NOIP":
+            return self.handle_noip_response(response)
+
+        # Same provider, any handler reads the answer the same way
+        return dict.fromkeys(self.domain_handlers, self.domain_handlers[0].handle_response(response))
+
+    def split(self, new_ipv4: str, new_ipv6: str) -> list:
+        """
+        One PlannedUpdate per handler, when the provider rejected the merged request
+        without saying which domains, see split_on_rejection. Empty if not needed.
+        """
+
+        if len(self.domain_handlers) < 2 or self.provider not in split_on_rejection:
+            return []
+
+        return [
+            PlannedUpdate(
+                [domain_handler],
+                domain_handler.build_update_query(domain_handler.domains, new_ipv4, new_ipv6),
+            )
+            for domain_handler in self.domain_handlers
+        ]
+
+    def handle_noip_response(self, response) -> dict:
+        """
+        No-IP answers one line per hostname, in the order of the request. Every handler
+        gets the worst answer of its own hostnames.
+        """
+
+        def handle_line(line):
+            return self.domain_handlers[0].handle_response({**response, "response_text": line})
+
+        lines = [line.strip() for line in (response.get("response_text") or "").splitlines()]
+        lines = [line for line in lines if line]
+        if len(lines) != len(self.domains):
+            # e.g. badauth for the whole request, every handler gets the worst line
+            result = max(map(handle_line, lines or [""]), key=result_severity.get)
+            return dict.fromkeys(self.domain_handlers, result)
+
+        domain_results = dict(zip(self.domains, map(handle_line, lines)))
+        return {
+            domain_handler: max(
+                (domain_results[domain] for domain in domain_handler.domains), key=result_severity.get
+            )
+            for domain_handler in self.domain_handlers
+        }
+
+
+def plan_updates(domain_handlers: list, new_ipv4: str, new_ipv6: str, dns_answers: dict):
+    """
+    Collect the updates needed by every handler, then merge the compatible ones.
+
+    Handlers of the same DuckDNS token or No-IP account get a single request with all
+    their domains, up to max_merged_domains, FreeDNS handlers of the same token (the
+    same record) get their requests once.
+
+    Returns:
+    tuple: the PlannedUpdate list to process, and the handler -> None dictionary of the
+    handlers needing no update.
+    """
+
+    planned_updates = []
+    skipped_handlers = {}
+    # merge key -> handlers needing an update
+    merged_handlers = {}
+    requests_before = 0
+
+    for domain_handler in domain_handlers:
+        merge_key = domain_handler.get_merge_key(new_ipv4, new_ipv6)
+        if merge_key is None:
+            planned_updates.append(PlannedUpdate([domain_handler]))
+            continue
+
+        logger.info(
+            "Checking %s changes for %s - %s",
+            get_ip_type(domain_handler),
+            domain_handler.provider,
+            domain_handler.domains,
+        )
+        if not domain_handler.check_need_update(new_ipv4, new_ipv6, dns_answers):
+            logger.info("... No updates were performed.")
+            skipped_handlers[domain_handler] = None
+            continue
+
+        merged_handlers.setdefault(merge_key, []).append(domain_handler)
+        requests_before += len(
+            domain_handler.build_update_query(domain_handler.domains, new_ipv4, new_ipv6)["query_urls"]
+        )
+
+    requests_after = 0
+    for handlers in merged_handlers.values():
+        for batch in split_batches(handlers, max_merged_domains.get(handlers[0].provider)):
+            planned_update = PlannedUpdate(batch)
+            planned_update.request_queries = batch[0].build_update_query(
+                planned_update.domains, new_ipv4, new_ipv6
+            )
+            requests_after += len(planned_update.request_queries["query_urls"])
+            planned_updates.append(planned_update)
+
+    if requests_after < requests_before:
+        logger.info(
+            "Merged %s update requests into %s, %s requests saved",
+            requests_before,
+            requests_after,
+            requests_before - requests_after,
+        )
+
+    return planned_updates, skipped_handlers
+
+
+def split_batches(domain_handlers: list, max_domains: int = None) -> list:
+    """Split the merged handlers in batches of up to max_domains domains, a handler is never split."""
+
+    if not max_domains:
+        return [domain_handlers]
+
+    batches = [[]]
+    batch_domains = 0
+    for domain_handler in domain_handlers:
+        if batches[-1] and batch_domains + len(domain_handler.domains) > max_domains:
+            batches.append([])
+            batch_domains = 0
+        batches[-1].append(domain_handler)
+        batch_domains += len(domain_handler.domains)
+
+    return batches
+
+
+def get_ip_type(domain_handler) -> str:
+    if domain_handler.update_ipv4 and domain_handler.update_ipv6:
+        return "IPv4 and IPv6"
+    return "IPv4" if domain_handler.update_ipv4 else "IPv6"